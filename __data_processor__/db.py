@@ -0,0 +1,51 @@
+# data_processor/db.py
+
+# SQLite write configuration for the bulk loads
+# The connection itself is set up in settings.DATABASES: WAL journaling so the layer views keep reading
+# while a file is being loaded, a busy timeout so a writer waits for the lock inside SQLite instead of
+# failing with "database is locked", and IMMEDIATE transactions so a writer takes the write lock when
+# its transaction begins rather than failing half way through it.
+# On top of that a bulk load lowers the durability to synchronous=NORMAL (safe with WAL, the last
+# commits can only be lost on a power failure, never corrupted) and puts it back afterwards.
+#
+# SQLite only has one writer at a time. The loads of an upload run on several threads, a thread that
+# waited for the lock in SQLite longer than the busy timeout would fail with "database is locked".
+# The loads therefore parse their file first and only open their write transaction through
+# write_transaction(), which queues the writers of this process on a lock without a timeout.
+# Writers in other processes (the management commands) still wait on the busy timeout.
+
+import logging
+import threading
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def bulk_load():
+    """ Run a bulk load with synchronous=NORMAL on SQLite. The pragma cannot be changed inside a
+    transaction, so nothing is changed when the load already runs inside one """
+    if connection.vendor != "sqlite" or connection.in_atomic_block:
+        yield
+        return
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA synchronous")
+        synchronous = cursor.fetchone()[0]
+        cursor.execute("PRAGMA synchronous = NORMAL")
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA synchronous = {int(synchronous)}")
+
+
+_write_lock = threading.RLock()
+
+
+@contextmanager
+def write_transaction():
+    """ transaction.atomic() entered once the other writers of this process are done """
+    with _write_lock, transaction.atomic():
+        yield
@@ -0,0 +1,62 @@
+# data_processor/diagnostics.py
+
+# Debug artifacts of the layer transformations
+# The County, Zip code and City layers can dump their intermediate data to spreadsheets
+# (before_grouping_county.xlsx, school_code_groups.xlsx, zip_code_map.xlsx, log_data.xlsx, ...).
+# Writing an .xlsx file costs more than the transformation itself, so this is off unless
+# DATA_PROCESSOR_DIAGNOSTICS is set. When it is on, every layer run gets its own directory under
+# DATA_PROCESSOR_DIAGNOSTICS_DIR and the files are written by a background thread, off the hot path.
+
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# One writer thread is enough: the artifacts are only for debugging and this keeps
+# several runs from fighting over the disk
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="diagnostics")
+
+
+def diagnostics_enabled():
+    return getattr(settings, "DATA_PROCESSOR_DIAGNOSTICS", False)
+
+
+def flush_diagnostics():
+    """ Wait until the queued files are written. The writer thread dies with its process, so a worker
+    process of run_all_layers calls this before it returns """
+    # The single writer thread runs the tasks in order, the no-op finishes after every file queued before it
+    _writer.submit(lambda: None).result()
+
+
+def _write_excel(path, rows):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pd.DataFrame(rows).to_excel(path, index=False)
+        logger.info(f"Diagnostics written to {path}")
+    except Exception as e:
+        logger.error(f"Error writing diagnostics file {path}: {e}")
+
+
+class DiagnosticsRun:
+    """ Debug artifacts of one layer run, written asynchronously into a per-run directory """
+
+    def __init__(self, layer):
+        self.enabled = diagnostics_enabled()
+        self.directory = None
+        if self.enabled:
+            base_dir = getattr(settings, "DATA_PROCESSOR_DIAGNOSTICS_DIR", os.path.join(settings.BASE_DIR, "diagnostics"))
+            stamp = datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+            self.directory = os.path.join(base_dir, f"{stamp}-{re.sub(r'[^A-Za-z0-9]+', '-', layer).strip('-').lower()}")
+
+    def write_excel(self, filename, rows):
+        """ Queue a list of dicts to be written as filename in the run directory.
+        The rows must not be modified afterwards, they are read by the writer thread """
+        if not self.enabled:
+            return None
+        return _writer.submit(_write_excel, os.path.join(self.directory, filename), rows)
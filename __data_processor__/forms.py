@@ -4,4 +4,8 @@ class UploadFileForm(forms.Form):
     file = forms.FileField(label="Main File", required=True)
     stratifications_file = forms.FileField(label="Stratifications File (Optional)", required=False)
     county_geoid_file = forms.FileField(label="County GEOID File (Optional)", required=False)
-    school_address_file = forms.FileField(label="School Address File (Optional)", required=False)
\ No newline at end of file
+    school_address_file = forms.FileField(label="School Address File (Optional)", required=False)
+    upsert = forms.BooleanField(
+        label="Upsert (add new rows and update changed counts instead of replacing all the data)",
+        required=False,
+    )
@@ -0,0 +1,122 @@
+# data_processor/jobs.py
+
+# BACKGROUND JOBS
+# Loading the uploads and building the layers can take longer than a reverse proxy waits for a response.
+# With DATA_PROCESSOR_BACKGROUND_JOBS on, the views only create a Job and hand the work to a local pool
+# of DATA_PROCESSOR_JOB_WORKERS threads, then send the user to the job page which polls the job status.
+# The uploaded files only live as long as the request, so they are first copied to a directory of the
+# job (DATA_PROCESSOR_JOBS_DIR) and handed to the loaders from there. The directory is removed afterwards.
+# Jobs run in this process: a job that was queued or running when the server stopped is not resumed.
+# It is marked as failed when the worker pool of the next server process starts (see start_workers).
+
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import connection
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# Jobs created before this process started belong to a server process that is gone
+_started_at = timezone.now()
+_workers = None
+_workers_lock = threading.Lock()
+
+
+def start_workers():
+    """ The worker pool of this process, started on first use. The jobs a stopped server left queued
+    or running are marked as failed then, so their job page stops polling """
+    global _workers
+    with _workers_lock:
+        if _workers is None:
+            fail_orphaned_jobs()
+            _workers = ThreadPoolExecutor(
+                max_workers=getattr(settings, "DATA_PROCESSOR_JOB_WORKERS", 2), thread_name_prefix="job"
+            )
+        return _workers
+
+
+def fail_orphaned_jobs():
+    """ Mark the queued and running jobs created before this process started as failed, returns their number """
+    orphaned = Job.objects.filter(status__in=[Job.QUEUED, Job.RUNNING], created_at__lt=_started_at).update(
+        status=Job.FAILED,
+        message="The server was stopped before the job finished. Please run it again.",
+        finished_at=timezone.now(),
+    )
+    if orphaned:
+        logger.warning(f"{orphaned} jobs of a stopped server were marked as failed")
+    return orphaned
+
+
+def background_jobs_enabled():
+    return getattr(settings, "DATA_PROCESSOR_BACKGROUND_JOBS", False)
+
+
+def job_directory(job_id):
+    base_dir = getattr(settings, "DATA_PROCESSOR_JOBS_DIR", os.path.join(settings.BASE_DIR, "uploads", "jobs"))
+    return os.path.join(base_dir, str(job_id))
+
+
+class SpooledUpload(UploadedFile):
+    """ An upload copied to the job directory, handed to the loaders in place of the original upload """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def _spool_uploads(job, uploads):
+    """ Copy the uploaded files to the job directory. Returns {argument: (path, original name)} """
+    spooled = {}
+    for argument, upload in uploads.items():
+        if not upload:
+            continue
+        directory = job_directory(job.id)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, argument)
+        with open(path, "wb") as destination:
+            for chunk in upload.chunks():
+                destination.write(chunk)
+        spooled[argument] = (path, upload.name)
+    return spooled
+
+
+def submit(kind, description, target, uploads=None, **kwargs):
+    """ Create a Job running target(**uploads, **kwargs) on the worker pool and return it.
+    target returns {"message": ..., "next_url": ...} and raises (or returns "success": False) on failure """
+    job = Job.objects.create(kind=kind, description=description)
+    spooled = _spool_uploads(job, uploads or {})
+    start_workers().submit(_run, job.id, target, spooled, kwargs)
+    logger.info(f"Job {job.id} queued: {description}")
+    return job
+
+
+def _run(job_id, target, spooled, kwargs):
+    Job.objects.filter(id=job_id).update(status=Job.RUNNING, started_at=timezone.now())
+    files = {argument: SpooledUpload(open(path, "rb"), name=name) for argument, (path, name) in spooled.items()}
+    try:
+        outcome = target(**files, **kwargs)
+        status = Job.SUCCEEDED if outcome.get("success", True) else Job.FAILED
+        Job.objects.filter(id=job_id).update(
+            status=status,
+            message=outcome.get("message", ""),
+            next_url=outcome.get("next_url", "") if status == Job.SUCCEEDED else "",
+            finished_at=timezone.now(),
+        )
+        logger.info(f"Job {job_id} {status}")
+    except Exception as e:
+        logger.exception(f"Job {job_id} failed")
+        Job.objects.filter(id=job_id).update(status=Job.FAILED, message=str(e), finished_at=timezone.now())
+    finally:
+        for upload in files.values():
+            upload.close()
+        if spooled:
+            shutil.rmtree(job_directory(job_id), ignore_errors=True)
+        # The worker threads are reused, do not keep their connection open between jobs
+        connection.close()
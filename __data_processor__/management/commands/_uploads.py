@@ -0,0 +1,27 @@
+# data_processor/management/commands/_uploads.py
+
+# Helpers shared by the ingest and build commands: they hand a file on disk to the same loaders the
+# upload views use, and print how long every stage took.
+
+import os
+import time
+from contextlib import contextmanager
+
+from django.core.management.base import CommandError
+
+from __data_processor__.jobs import SpooledUpload
+
+
+def open_upload(path):
+    """ Open a CSV file on disk as an upload for the loaders of views.py """
+    if not os.path.isfile(path):
+        raise CommandError(f"File not found: {path}")
+    return SpooledUpload(open(path, "rb"), name=os.path.basename(path))
+
+
+@contextmanager
+def stage(command, label):
+    """ Print the time taken by one stage of a command """
+    started = time.perf_counter()
+    yield
+    command.stdout.write(f"{label}: {time.perf_counter() - started:.2f} s")
@@ -0,0 +1,54 @@
+# data_processor/management/commands/build_layers.py
+
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from __data_processor__.transformers import DataTransformer
+
+# Short names accepted by --layers
+LAYER_NAMES = {
+    "tri-county": "Tri-County",
+    "county": "County-Layer",
+    "statewide": "Metopio Statewide",
+    "zip": "Zipcode",
+    "city": "City-Town",
+}
+
+
+class Command(BaseCommand):
+    help = "Build the Metopio layers from the loaded data, like the All Layers transformation"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--layers", default=",".join(LAYER_NAMES),
+            help=f"Comma separated layers to build, out of {', '.join(LAYER_NAMES)} (default: all)",
+        )
+        parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes building the layers in parallel")
+        parser.add_argument("--force", action="store_true", help="Rebuild the layers even if their inputs did not change")
+
+    def handle(self, *args, **options):
+        names = [name.strip().lower() for name in options["layers"].split(",") if name.strip()]
+        unknown = [name for name in names if name not in LAYER_NAMES]
+        if unknown:
+            raise CommandError(f"Unknown layers: {', '.join(unknown)}. Choose from {', '.join(LAYER_NAMES)}")
+        if options["jobs"] < 1:
+            raise CommandError("--jobs must be at least 1")
+
+        result = DataTransformer().run_all_layers(
+            force=options["force"], layers=[LAYER_NAMES[name] for name in names], jobs=options["jobs"]
+        )
+        # One line per layer with its timing, then the total
+        for layer_result in result.results:
+            status = "skipped, unchanged" if layer_result.skipped else ("ok" if layer_result else "FAILED")
+            self.stdout.write(
+                f"{layer_result.layer}: {layer_result.seconds:.2f} s, {layer_result.records} records, "
+                f"{layer_result.queries} queries ({status})"
+            )
+            # The layers log one warning per record, show each distinct warning once
+            for warning, count in Counter(layer_result.warnings).items():
+                self.stderr.write(f"  {warning}" + (f" ({count} times)" if count > 1 else ""))
+        self.stdout.write(f"Total: {result.seconds:.2f} s, {result.records} records, {result.queries} queries")
+        if not result:
+            raise CommandError("Some layers failed to build, see the errors above")
+        self.stdout.write(self.style.SUCCESS("Layers built successfully."))
@@ -0,0 +1,25 @@
+# data_processor/management/commands/ingest_addresses.py
+
+from django.core.management.base import BaseCommand, CommandError
+
+from __data_processor__.views import load_school_address_file
+from ._uploads import open_upload, stage
+
+
+class Command(BaseCommand):
+    help = "Load the school address file, like the upload page does"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="School address CSV file")
+
+    def handle(self, *args, **options):
+        with open_upload(options["file"]) as f:
+            try:
+                with stage(self, "Ingest school addresses"):
+                    loaded = load_school_address_file(f)
+            except Exception as e:
+                raise CommandError(f"Error loading {options['file']}: {e}")
+        if not loaded:
+            self.stdout.write("This file was already ingested, the data was left as it is.")
+            return
+        self.stdout.write(self.style.SUCCESS("School address file loaded."))
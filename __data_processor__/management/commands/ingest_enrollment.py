@@ -0,0 +1,31 @@
+# data_processor/management/commands/ingest_enrollment.py
+
+from django.core.management.base import BaseCommand, CommandError
+
+from __data_processor__.views import handle_uploaded_file, ingest_message
+from ._uploads import open_upload, stage
+
+
+class Command(BaseCommand):
+    help = "Load the main enrollment file (and optionally a stratification file), like the upload page does"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="Main enrollment CSV file")
+        parser.add_argument("--stratifications", help="Stratification CSV file, replaces the stored stratifications")
+        parser.add_argument(
+            "--upsert", action="store_true",
+            help="Update the changed rows and insert the new ones instead of replacing the whole table",
+        )
+
+    def handle(self, *args, **options):
+        stratifications_file = open_upload(options["stratifications"]) if options["stratifications"] else None
+        with open_upload(options["file"]) as f:
+            try:
+                with stage(self, "Ingest enrollment"):
+                    report = handle_uploaded_file(f, stratifications_file=stratifications_file, upsert=options["upsert"])
+            except Exception as e:
+                raise CommandError(f"Error loading {options['file']}: {e}")
+            finally:
+                if stratifications_file:
+                    stratifications_file.close()
+        self.stdout.write(self.style.SUCCESS(ingest_message(report) or f"{report['inserted']} records inserted."))
@@ -0,0 +1,25 @@
+# data_processor/management/commands/ingest_geoids.py
+
+from django.core.management.base import BaseCommand, CommandError
+
+from __data_processor__.views import load_county_geoid_file
+from ._uploads import open_upload, stage
+
+
+class Command(BaseCommand):
+    help = "Load the County GEOID file, like the upload page does"
+
+    def add_arguments(self, parser):
+        parser.add_argument("file", help="County GEOID CSV file (Layer, Name and GEOID columns)")
+
+    def handle(self, *args, **options):
+        with open_upload(options["file"]) as f:
+            try:
+                with stage(self, "Ingest County GEOIDs"):
+                    loaded = load_county_geoid_file(f)
+            except Exception as e:
+                raise CommandError(f"Error loading {options['file']}: {e}")
+        if not loaded:
+            self.stdout.write("This file was already ingested, the data was left as it is.")
+            return
+        self.stdout.write(self.style.SUCCESS("County GEOID file loaded."))
@@ -0,0 +1,22 @@
+# Generated by Django 5.1.4 on 2026-10-16 22:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("__data_processor__", "0021_remove_schooldata_address_details"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LayerBuild",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("layer", models.CharField(max_length=50, unique=True)),
+                ("fingerprint", models.CharField(max_length=64)),
+                ("built_at", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.4 on 2026-10-16 22:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("__data_processor__", "0022_layerbuild"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="IngestedFile",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("kind", models.CharField(max_length=20)),
+                ("name", models.CharField(max_length=255)),
+                ("sha256", models.CharField(max_length=64)),
+                ("mode", models.CharField(default="replace", max_length=10)),
+                ("table_state", models.CharField(max_length=200)),
+                ("ingested_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
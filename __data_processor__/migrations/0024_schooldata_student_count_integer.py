@@ -0,0 +1,70 @@
+# Generated by Django 5.1.4 on 2026-10-16 22:50
+
+import math
+
+from django.db import migrations, models
+
+
+def parse_student_count(value):
+    # Same rule as models.parse_student_count, copied so the migration does not depend on the current models
+    try:
+        count = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(count) if math.isfinite(count) else None
+
+
+def forwards(apps, schema_editor):
+    SchoolData = apps.get_model("__data_processor__", "SchoolData")
+    batch = []
+    for record in SchoolData.objects.only("id", "student_count").iterator(chunk_size=5000):
+        record.student_count_value = parse_student_count(record.student_count)
+        batch.append(record)
+        if len(batch) >= 5000:
+            SchoolData.objects.bulk_update(batch, ["student_count_value"])
+            batch = []
+    SchoolData.objects.bulk_update(batch, ["student_count_value"])
+
+
+def backwards(apps, schema_editor):
+    SchoolData = apps.get_model("__data_processor__", "SchoolData")
+    batch = []
+    for record in SchoolData.objects.only("id", "student_count_value").iterator(chunk_size=5000):
+        record.student_count = "" if record.student_count_value is None else str(record.student_count_value)
+        batch.append(record)
+        if len(batch) >= 5000:
+            SchoolData.objects.bulk_update(batch, ["student_count"])
+            batch = []
+    SchoolData.objects.bulk_update(batch, ["student_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("__data_processor__", "0023_ingestedfile"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="schooldata",
+            name="student_count_value",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        # Nullable while it is converted, so reversing the RemoveField can add the column
+        # back to a filled table before backwards() refills it
+        migrations.AlterField(
+            model_name="schooldata",
+            name="student_count",
+            field=models.CharField(max_length=20, null=True),
+        ),
+        migrations.RunPython(forwards, backwards),
+        migrations.RemoveField(
+            model_name="schooldata",
+            name="student_count",
+        ),
+        migrations.RenameField(
+            model_name="schooldata",
+            old_name="student_count_value",
+            new_name="student_count",
+        ),
+    ]
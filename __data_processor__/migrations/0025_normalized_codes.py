@@ -0,0 +1,50 @@
+# Generated by Django 5.1.4 on 2026-10-16 22:56
+
+from django.db import migrations, models
+
+
+def normalize_code(code):
+    # Same rule as models.normalize_code, copied so the migration does not depend on the current models
+    if code is None:
+        return None
+    return str(code).strip().lstrip("0")
+
+
+def normalize_codes(apps, schema_editor):
+    # Rows loaded with bulk_create before this migration still have their leading zeros
+    for model_name, code_fields in [
+        ("SchoolData", ["district_code", "school_code"]),
+        ("SchoolAddressFile", ["lea_code", "school_code"]),
+    ]:
+        model = apps.get_model("__data_processor__", model_name)
+        batch = []
+        for record in model.objects.only("id", *code_fields).iterator(chunk_size=5000):
+            codes = [getattr(record, field) for field in code_fields]
+            if codes == [normalize_code(code) for code in codes]:
+                continue
+            for field, code in zip(code_fields, codes):
+                setattr(record, field, normalize_code(code))
+            batch.append(record)
+            if len(batch) >= 5000:
+                model.objects.bulk_update(batch, code_fields)
+                batch = []
+        model.objects.bulk_update(batch, code_fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("__data_processor__", "0024_schooldata_student_count_integer"),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_codes, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="schooladdressfile",
+            index=models.Index(fields=["lea_code", "school_code"], name="schooladdress_codes_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="schooldata",
+            index=models.Index(fields=["district_code", "school_code"], name="schooldata_codes_idx"),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.4 on 2026-10-16 22:57
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def build_school_geography(apps, schema_editor):
+    # Same as views.rebuild_school_geography, so the crosswalk exists without uploading the files again
+    CountyGEOID = apps.get_model("__data_processor__", "CountyGEOID")
+    SchoolAddressFile = apps.get_model("__data_processor__", "SchoolAddressFile")
+    SchoolGeography = apps.get_model("__data_processor__", "SchoolGeography")
+
+    geoids = defaultdict(dict)
+    for layer, name, geoid in CountyGEOID.objects.order_by("id").values_list("layer", "name", "geoid"):
+        geoids[layer][name] = geoid
+    county_geoids = {name.split(" County, WI")[0].strip(): geoid for name, geoid in geoids["County"].items()}
+
+    schools = {}
+    addresses = SchoolAddressFile.objects.order_by("id").values_list("lea_code", "school_code", "zip_code", "city", "county")
+    for lea_code, school_code, zip_code, city, county in addresses:
+        schools[lea_code, school_code] = SchoolGeography(
+            lea_code=lea_code,
+            school_code=school_code,
+            zip_code=zip_code,
+            city=city,
+            county=county,
+            zip_geoid=geoids["Zip code"].get(zip_code),
+            city_geoid=geoids["City or town"].get(f"{city}, WI"),
+            county_geoid=county_geoids.get(county),
+        )
+    SchoolGeography.objects.bulk_create(schools.values())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("__data_processor__", "0025_normalized_codes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SchoolGeography",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("lea_code", models.CharField(max_length=10, verbose_name="LEA Code")),
+                ("school_code", models.CharField(max_length=10, verbose_name="School Code")),
+                ("zip_code", models.CharField(max_length=10, verbose_name="Zip")),
+                ("city", models.CharField(max_length=100, verbose_name="City")),
+                ("county", models.CharField(max_length=100, verbose_name="County")),
+                ("zip_geoid", models.CharField(blank=True, max_length=50, null=True)),
+                ("city_geoid", models.CharField(blank=True, max_length=50, null=True)),
+                ("county_geoid", models.CharField(blank=True, max_length=50, null=True)),
+            ],
+            options={
+                "constraints": [models.UniqueConstraint(fields=("lea_code", "school_code"), name="schoolgeography_codes_unique")],
+            },
+        ),
+        migrations.RunPython(build_school_geography, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 5.1.4 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+# Tables whose generation the layer cache and the duplicate upload check read
+LAYER_INPUT_TABLES = [
+    "__data_processor___schooldata",
+    "__data_processor___stratification",
+    "__data_processor___countygeoid",
+    "__data_processor___schooladdressfile",
+]
+
+
+def create_generations(apps, schema_editor):
+    InputGeneration = apps.get_model("__data_processor__", "InputGeneration")
+    InputGeneration.objects.bulk_create(InputGeneration(table=table) for table in LAYER_INPUT_TABLES)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("__data_processor__", "0027_job"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="InputGeneration",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("table", models.CharField(max_length=50, unique=True)),
+                ("generation", models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_generations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.4 on 2026-10-17 10:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("__data_processor__", "0028_inputgeneration"),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name="schooladdressfile",
+            name="schooladdress_codes_idx",
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-17 14:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("__data_processor__", "0029_remove_schooladdress_codes_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="layerbuild",
+            name="records",
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
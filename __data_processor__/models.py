@@ -1,6 +1,97 @@
+import math
+
 from django.db import models
+from django.db.models import F
+
+# District (LEA) and school codes are stored without their leading zeros ("0150" -> "150"), so SchoolData
+# and SchoolAddressFile can be joined on them directly. save() and the bulk loaders in views.py both use this
+def normalize_code(code):
+    if code is None:
+        return None
+    return str(code).strip().lstrip("0")
+
+
+# LAYER INPUT GENERATIONS
+# The layers are built from SchoolData, Stratification, CountyGEOID and SchoolAddressFile and cached on the
+# generation of these tables (see cached_layer in transformers.py). Every write to one of them bumps its
+# generation: save() and delete() of a single row (admin edits) as well as the delete, update, bulk_create
+# and bulk_update of their querysets, which is what the loaders use. Writers going around the ORM call
+# bump_input_generation themselves. The bumps are overridden methods rather than post_save/post_delete
+# signals because a post_delete receiver makes Django fetch every row before a bulk delete.
+class InputGeneration(models.Model):
+    table = models.CharField(max_length=50, unique=True)
+    generation = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.table} - {self.generation}"
+
+
+def bump_input_generation(model):
+    """ Mark the rows of a layer input table as changed """
+    table = model._meta.db_table
+    if not InputGeneration.objects.filter(table=table).update(generation=F("generation") + 1):
+        InputGeneration.objects.get_or_create(table=table)
+        InputGeneration.objects.filter(table=table).update(generation=F("generation") + 1)
+
+
+def input_generations(input_models):
+    """ Current generation of each of the given layer input tables, as "table:generation" strings """
+    generations = dict(
+        InputGeneration.objects.filter(table__in=[model._meta.db_table for model in input_models])
+        .values_list("table", "generation")
+    )
+    return [f"{model._meta.db_table}:{generations.get(model._meta.db_table, 0)}" for model in input_models]
+
+
+class LayerInputQuerySet(models.QuerySet):
+    """ QuerySet of a layer input table, its bulk writes bump the generation of the table """
+
+    def delete(self):
+        result = super().delete()
+        bump_input_generation(self.model)
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
 
-class Stratification(models.Model):
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        bump_input_generation(self.model)
+        return rows
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        created = super().bulk_create(objs, *args, **kwargs)
+        bump_input_generation(self.model)
+        return created
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        rows = super().bulk_update(objs, fields, *args, **kwargs)
+        bump_input_generation(self.model)
+        return rows
+
+    bulk_update.alters_data = True
+
+
+class LayerInputModel(models.Model):
+    """ Base of the tables the layers are built from, every write bumps the generation of the table """
+    objects = LayerInputQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        bump_input_generation(type(self))
+
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        bump_input_generation(type(self))
+        return result
+
+
+class Stratification(LayerInputModel):
     group_by = models.CharField(max_length=100, default="Default Group")
     group_by_value = models.CharField(max_length=200, default="Default Group")
     label_name = models.CharField(max_length=200, default="Default Group")
@@ -8,7 +99,7 @@ class Stratification(models.Model):
     def __str__(self):
         return f"{self.group_by} - {self.group_by_value}"
 
-class CountyGEOID(models.Model):
+class CountyGEOID(LayerInputModel):
     layer = models.CharField(max_length=50)
     name = models.CharField(max_length=100)
     geoid = models.CharField(max_length=50, unique=True)
@@ -16,7 +107,7 @@ class CountyGEOID(models.Model):
     def __str__(self):
         return f"{self.layer} - {self.name} - {self.geoid}"
 #SchoolAddressFile model is being used for the ZipCodeLayerTransformation model   
-class SchoolAddressFile(models.Model):
+class SchoolAddressFile(LayerInputModel):
     lea_code = models.CharField(max_length=10, verbose_name="LEA Code")  # Unique constraint for one to many relationship
     district_name = models.CharField(max_length=255, verbose_name="District Name")
     school_code = models.CharField(max_length=10, verbose_name="School Code")  # Unique constraint for one to many relationship    
@@ -45,12 +136,22 @@ class SchoolAddressFile(models.Model):
         return f"{self.school_name} ({self.district_name})"
     
     def save(self, *args, **kwargs):
-        self.school_code = self.school_code.lstrip("0")
-        self.lea_code = self.lea_code.lstrip("0")
+        self.school_code = normalize_code(self.school_code)
+        self.lea_code = normalize_code(self.lea_code)
         super(SchoolAddressFile, self).save(*args, **kwargs)
     
+# STUDENT_COUNT is parsed once when the file is loaded instead of in every layer
+# Whole numbers are kept as they are, decimals are truncated and anything else ('*', '') becomes None
+def parse_student_count(value):
+    try:
+        count = float(value)
+    except (TypeError, ValueError):
+        return None
+    return int(count) if math.isfinite(count) else None
+
+
 # Main Model is the School Data Model
-class SchoolData(models.Model):
+class SchoolData(LayerInputModel):
     school_year = models.CharField(max_length=7)
     agency_type = models.CharField(max_length=50)
     cesa = models.CharField(max_length=10)
@@ -63,7 +164,7 @@ class SchoolData(models.Model):
     school_name = models.CharField(max_length=100)
     group_by = models.CharField(max_length=50)
     group_by_value = models.CharField(max_length=200)
-    student_count = models.CharField(max_length=20)
+    student_count = models.IntegerField(null=True, blank=True)  # See parse_student_count
     percent_of_group = models.CharField(max_length=20)
     place = models.CharField(max_length=100, null=True, blank=True)
     stratification = models.ForeignKey(Stratification, on_delete=models.SET_NULL, null=True, blank=True)
@@ -103,10 +204,14 @@ class SchoolData(models.Model):
         #If you're confident that all your SchoolData rows will always match a corresponding
         # SchoolAddressFile entry, you can replace district_code and school_code with ForeignKey fields.
         # However, this approach offers flexibility and avoids potential data or migration
+    # The upsert looks up the stored rows of each batch by their district and school codes (see views.py)
+    class Meta:
+        indexes = [models.Index(fields=["district_code", "school_code"], name="schooldata_codes_idx")]
+
     #REMOVING LEADING ZEROS FROM THE SCHOOL_CODE AND DISTRICT_CODE
     def save(self, *args, **kwargs):
-        self.school_code = self.school_code.lstrip("0")
-        self.district_code = self.district_code.lstrip("0")
+        self.school_code = normalize_code(self.school_code)
+        self.district_code = normalize_code(self.district_code)
         super(SchoolData, self).save(*args, **kwargs)
 
 
@@ -185,4 +290,88 @@ class MetopioCityLayerTransformation(models.Model):
     class Meta:
         verbose_name = 'City Layer Transformation'
         verbose_name_plural = 'City Layer Transformations'
-        ordering = ['period']
\ No newline at end of file
+        ordering = ['period']
+
+
+# Bookkeeping for the layer result cache in transformers.py
+# One row per layer holding the fingerprint of the generations of the inputs (SchoolData, Stratification,
+# CountyGEOID and SchoolAddressFile) the layer was last built from successfully, and the number of rows
+# that build wrote. The stored layer is only served while its table still holds that many rows, so an
+# empty layer is cached too and a layer table cleared by hand is rebuilt
+class LayerBuild(models.Model):
+    layer = models.CharField(max_length=50, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    records = models.PositiveIntegerField(default=0)
+    built_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.layer} - {self.fingerprint[:12]} - {self.built_at}"
+
+
+# Log of the uploaded files that were ingested, used to skip re-ingesting a byte-identical file
+# kind is one of "main", "stratifications", "county_geoid" or "school_address".
+# table_state is the generation (see InputGeneration) of the tables the file was loaded into, taken right
+# after the load, so a file is only skipped while those tables still hold what it produced
+class IngestedFile(models.Model):
+    kind = models.CharField(max_length=20)
+    name = models.CharField(max_length=255)
+    sha256 = models.CharField(max_length=64)
+    mode = models.CharField(max_length=10, default="replace")
+    table_state = models.CharField(max_length=200)
+    ingested_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.kind} - {self.name} - {self.sha256[:12]} - {self.ingested_at}"
+
+
+# School -> geography crosswalk used by the Zip code and City layers
+# One row per (lea_code, school_code) of the school address file with the zip code and city of the school
+# and the GEOIDs they have in the County GEOID file. It is rebuilt by the address and GEOID loaders
+# (rebuild_school_geography in views.py), so the layers assign the geography with a single lookup
+class SchoolGeography(models.Model):
+    lea_code = models.CharField(max_length=10, verbose_name="LEA Code")
+    school_code = models.CharField(max_length=10, verbose_name="School Code")
+    zip_code = models.CharField(max_length=10, verbose_name="Zip")
+    city = models.CharField(max_length=100, verbose_name="City")
+    county = models.CharField(max_length=100, verbose_name="County")
+    zip_geoid = models.CharField(max_length=50, null=True, blank=True)      # GEOID of the "Zip code" entry named zip_code
+    city_geoid = models.CharField(max_length=50, null=True, blank=True)     # GEOID of the "City or town" entry named "<city>, WI"
+    county_geoid = models.CharField(max_length=50, null=True, blank=True)   # GEOID of the "County" entry named "<county> County, WI"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["lea_code", "school_code"], name="schoolgeography_codes_unique")
+        ]
+
+    def __str__(self):
+        return f"{self.lea_code}-{self.school_code} - {self.zip_code} - {self.city}"
+
+
+# Uploads and transformations run as background jobs (see jobs.py)
+# The POST only creates the Job and returns, the page then polls the job status until it is done
+class Job(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (SUCCEEDED, "Succeeded"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=20)                      # "ingest" or "transformation"
+    description = models.CharField(max_length=255)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    message = models.TextField(blank=True)                      # Outcome shown to the user, or the error
+    next_url = models.CharField(max_length=255, blank=True)     # Where the user goes once the job succeeded
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.kind} #{self.id} - {self.description} - {self.status}"
@@ -1,3 +1,1245 @@
-from django.test import TestCase
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+from django.urls import reverse
+from django.utils import timezone
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from . import jobs, transformers
+from .db import write_transaction
+from .diagnostics import DiagnosticsRun, flush_diagnostics
+from .models import (
+    CountyGEOID,
+    CountyLayerTransformation,
+    IngestedFile,
+    Job,
+    LayerBuild,
+    MetopioCityLayerTransformation,
+    MetopioStateWideLayerTransformation,
+    MetopioTriCountyLayerTransformation,
+    SchoolData,
+    SchoolGeography,
+    Stratification,
+    TransformedSchoolData,
+    ZipCodeLayerTransformation,
+    normalize_code,
+    parse_student_count,
+)
+from .transformers import DataTransformer, LayerInputs, input_fingerprint, missing_group_by_fill, unknown_fill
+from .views import (
+    SCHOOL_DATA_INSERT_FIELDS,
+    IngestError,
+    handle_uploaded_file,
+    ingest_uploads,
+    load_county_geoid_file,
+    load_school_address_file,
+    read_uploaded_csv,
+    rebuild_school_geography,
+    school_data_batches,
+    stratification_id_map,
+)
+
+MAIN_FILE_COLUMNS = [
+    "SCHOOL_YEAR", "AGENCY_TYPE", "CESA", "COUNTY", "DISTRICT_CODE", "SCHOOL_CODE", "GRADE_GROUP", "CHARTER_IND",
+    "DISTRICT_NAME", "SCHOOL_NAME", "GROUP_BY", "GROUP_BY_VALUE", "STUDENT_COUNT", "PERCENT_OF_GROUP",
+]
+
+
+def enrollment_row(school_code="0150", group_by="All Students", group_by_value="All Students", count="10",
+                   school_year="2023-24", county="Outagamie"):
+    """ One row of the main enrollment file as a list of CSV values """
+    return [
+        school_year, "Public school", "06", county, "02835", school_code, "Elementary School", "No",
+        "Kimberly Area", f"School {school_code}", group_by, group_by_value, count, "0.5",
+    ]
+
+
+def main_file(rows, name="enrollment.csv"):
+    lines = [",".join(MAIN_FILE_COLUMNS)] + [",".join(row) for row in rows]
+    return SimpleUploadedFile(name, ("\n".join(lines) + "\n").encode())
+
+
+def county_geoid_file(header="Layer,Name,GEOID", extra_lines=()):
+    lines = [header, 'County,"Outagamie County, WI",55087', "Zip code,54136,86000US54136", *extra_lines]
+    return SimpleUploadedFile("geoids.csv", ("\n".join(lines) + "\n").encode())
+
+
+SCHOOL_ADDRESS_COLUMNS = [
+    "LEA Code", "District Name", "School Code", "School Name", "Organization Type", "School Type", "Low Grade",
+    "High Grade", "Address", "City", "State", "Zip", "CESA", "Locale", "County", "Current Status",
+    "Categories And Programs", "Virtual School", "IB Program", "Phone Number", "Fax Number", "Charter Status",
+    "Website Url",
+]
+
+
+def school_address_file(schools):
+    """ School address file of the (school_code, city, zip_code) schools of the Kimberly Area district """
+    lines = [",".join(SCHOOL_ADDRESS_COLUMNS)]
+    for school_code, city, zip_code in schools:
+        values = dict.fromkeys(SCHOOL_ADDRESS_COLUMNS, "")
+        values.update({
+            "LEA Code": "02835", "District Name": "Kimberly Area", "School Code": school_code,
+            "School Name": f"School {school_code}", "City": city, "State": "WI", "Zip": zip_code,
+            "County": "Outagamie",
+        })
+        lines.append(",".join(values[column] for column in SCHOOL_ADDRESS_COLUMNS))
+    return SimpleUploadedFile("addresses.csv", ("\n".join(lines) + "\n").encode())
+
+
+def stratifications_file():
+    lines = [
+        "GROUP_BY,GROUP_BY_VALUE,Stratification",
+        "All Students,All Students,",
+        "Gender,Female,SEXF",
+        "Gender,Male,SEXM",
+        "Gender,Unknown,SEXU",
+    ]
+    return SimpleUploadedFile("stratifications.csv", ("\n".join(lines) + "\n").encode())
+
+
+# Random layer records for comparing the bulk helpers of transformers.py with the loops they replaced
+LAYER_GROUP_BYS = {
+    "Gender": ["Female", "Male", "Unknown"],
+    "Race/Ethnicity": ["Asian", "Black", "White", "Unknown"],
+    "Grade Level": ["KG", "1", "2"],
+}
+
+
+def layer_records(seed, schools=12):
+    rng = random.Random(seed)
+    records = []
+    for school in range(schools):
+        county = rng.choice(["Outagamie", "Winnebago", "Calumet"])
+        district_code = str(rng.randint(1, 4))
+        school_code = None if rng.random() < 0.15 else str(school)
+        rows = [("All Students", "All Students")] if rng.random() < 0.9 else []
+        for group_by, values in LAYER_GROUP_BYS.items():
+            if rng.random() < 0.8:
+                rows.extend((group_by, value) for value in rng.sample(values, rng.randint(1, len(values))))
+        # A school can be listed twice and the rows do not come grouped
+        rows.extend(rng.sample(rows, min(len(rows), rng.randint(0, 2))))
+        rng.shuffle(rows)
+        for group_by, group_by_value in rows:
+            records.append(SimpleNamespace(
+                county=county, district_code=district_code, school_code=school_code,
+                group_by=group_by, group_by_value=group_by_value,
+                student_count=rng.randint(0, 300 if group_by == "All Students" else 60),
+                stratification=f"{group_by}{group_by_value}",
+            ))
+    return records
+
+
+def first_positions(records, key):
+    positions = {}
+    for position, record in enumerate(records):
+        positions.setdefault(key(record), position)
+    return positions
+
+
+# The Unknown fill loops of the layers before unknown_fill, returning (position of the first record of
+# the key the Unknown was made from, difference) in the order the Unknown records were made
+def legacy_region_unknowns(records):
+    """ Statewide and Tri-County layers: one Unknown per distinct difference """
+    group_totals, all_students_totals = defaultdict(int), 0
+    for record in records:
+        group_totals[record.group_by] += record.student_count
+        if record.group_by == "All Students":
+            all_students_totals += record.student_count
+    positions = first_positions(records, lambda record: (record.county, record.group_by, record.group_by_value))
+    unknowns, unique_records = [], set()
+    for (county, group_by, group_by_value), position in positions.items():
+        total = group_totals[group_by]
+        if group_by == "All Students" or total >= all_students_totals:
+            continue
+        difference = all_students_totals - total
+        if ("Unknown", difference) not in unique_records:
+            unique_records.add(("Unknown", difference))
+            unknowns.append((position, difference))
+    return unknowns
+
+
+def legacy_county_unknowns(records):
+    """ County layer: one Unknown per county and group_by """
+    group_totals, all_students_totals = defaultdict(int), defaultdict(int)
+    for record in records:
+        group_totals[record.county, record.group_by] += record.student_count
+        if record.group_by == "All Students":
+            all_students_totals[record.county] += record.student_count
+    positions = first_positions(
+        records, lambda record: (record.county, record.group_by, record.group_by_value, record.stratification)
+    )
+    unknowns, unique_records = [], set()
+    for (county, group_by, group_by_value, stratification), position in positions.items():
+        total = group_totals[county, group_by]
+        if group_by == "All Students" or total >= all_students_totals[county] or group_by_value == "Unknown":
+            continue
+        if (county, group_by) not in unique_records:
+            unique_records.add((county, group_by))
+            unknowns.append((position, all_students_totals[county] - total))
+    return unknowns
+
+
+def legacy_school_unknowns(records):
+    """ Zip code and City layers: one Unknown per school and group_by, schools without a school_code do not count """
+    group_totals, all_students_totals = defaultdict(int), defaultdict(int)
+    for record in records:
+        if record.school_code is None:
+            continue
+        group_totals[record.district_code, record.school_code, record.group_by] += record.student_count
+        if record.group_by == "All Students":
+            all_students_totals[record.district_code, record.school_code] += record.student_count
+    positions = first_positions(records, lambda record: (
+        record.county, record.district_code, record.school_code, record.group_by, record.group_by_value,
+        record.stratification, record.student_count,
+    ))
+    unknowns, unique_records = [], set()
+    for (county, district_code, school_code, group_by, group_by_value, *rest), position in positions.items():
+        total = group_totals[district_code, school_code, group_by]
+        all_students = all_students_totals[district_code, school_code]
+        if total >= all_students or group_by_value == "Unknown":
+            continue
+        if (county, district_code, school_code, group_by) not in unique_records:
+            unique_records.add((county, district_code, school_code, group_by))
+            unknowns.append((position, all_students - total))
+    return unknowns
+
+
+class UnknownFillTests(SimpleTestCase):
+    SEEDS = range(40)
+
+    def test_region_layers_match_the_old_loop(self):
+        for seed in self.SEEDS:
+            records = layer_records(seed)
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                    unknown_fill(records, dedupe_on=["difference"], skip_unknown_values=False),
+                    legacy_region_unknowns(records),
+                )
+
+    def test_county_layer_matches_the_old_loop(self):
+        for seed in self.SEEDS:
+            records = layer_records(seed)
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                    unknown_fill(records, grain=["county"], dedupe_on=["county", "group_by"]),
+                    legacy_county_unknowns(records),
+                )
+
+    def test_school_layers_match_the_old_loop(self):
+        for seed in self.SEEDS:
+            records = layer_records(seed)
+            with self.subTest(seed=seed):
+                self.assertEqual(
+                    unknown_fill(
+                        records,
+                        grain=["district_code", "school_code"],
+                        dedupe_on=["county", "district_code", "school_code", "group_by"],
+                    ),
+                    legacy_school_unknowns(records),
+                )
+
+    def test_a_school_without_all_students_or_school_code_gets_no_unknown(self):
+        records = [
+            SimpleNamespace(county="Calumet", district_code="1", school_code=school_code, group_by=group_by,
+                            group_by_value=value, student_count=count, stratification=None)
+            for school_code, group_by, value, count in [
+                ("10", "Gender", "Female", 4),
+                (None, "All Students", "All Students", 50),
+                (None, "Gender", "Female", 5),
+                ("20", "All Students", "All Students", 30),
+                ("20", "Gender", "Female", 10),
+                ("20", "Gender", "Unknown", 2),
+                ("20", "Gender", "Male", 12),
+            ]
+        ]
+        self.assertEqual(
+            unknown_fill(records, grain=["district_code", "school_code"], dedupe_on=["school_code", "group_by"]),
+            [(4, 6)],
+        )
+
+    def test_no_records(self):
+        self.assertEqual(unknown_fill([]), [])
+
+
+# The missing group_by loop of the Zip code and City layers before missing_group_by_fill, returning
+# (position of the "All Students" record of the school, missing group_by, "All Students" total of the school)
+def legacy_missing_group_bys(records, group_by_keys):
+    all_students_totals = defaultdict(int)
+    for record in records:
+        if record.school_code is not None and record.group_by == "All Students":
+            all_students_totals[record.district_code, record.school_code] += record.student_count
+    school_code_groups = defaultdict(list)
+    for position, record in enumerate(records):
+        school_code_groups[record.school_code, record.district_code].append((position, record))
+
+    missing = []
+    for (school_code, district_code), school_records in school_code_groups.items():
+        existing_group_by_keys = {record.group_by for position, record in school_records}
+        for missing_group_by_key in set(group_by_keys) - existing_group_by_keys:
+            position, reference_record = next(
+                (position, record) for position, record in school_records if record.group_by == "All Students"
+            )
+            missing.append((
+                position,
+                missing_group_by_key,
+                all_students_totals[reference_record.district_code, reference_record.school_code],
+            ))
+    return missing
+
+
+class MissingGroupByFillTests(SimpleTestCase):
+    GROUP_BY_KEYS = ["All Students", *LAYER_GROUP_BYS, "Disability"]
+
+    def complete_records(self, seed):
+        """ layer_records without the schools that have no All Students record, which the old loop failed on """
+        records = layer_records(seed)
+        with_all_students = {
+            (record.district_code, record.school_code) for record in records if record.group_by == "All Students"
+        }
+        return [record for record in records if (record.district_code, record.school_code) in with_all_students]
+
+    def test_matches_the_old_loop(self):
+        for seed in range(40):
+            records = self.complete_records(seed)
+            with self.subTest(seed=seed):
+                # The old loop went through a set difference, so only the records made are compared, not their order
+                self.assertEqual(
+                    sorted(missing_group_by_fill(records, self.GROUP_BY_KEYS)),
+                    sorted(legacy_missing_group_bys(records, self.GROUP_BY_KEYS)),
+                )
+
+    def test_schools_in_record_order_and_group_bys_in_catalog_order(self):
+        records = [
+            SimpleNamespace(district_code="1", school_code=school_code, group_by=group_by, student_count=count)
+            for school_code, group_by, count in [
+                ("20", "Gender", 5),
+                ("20", "All Students", 40),
+                ("10", "All Students", 30),
+                ("20", "All Students", 2),
+                (None, "All Students", 9),
+            ]
+        ]
+        self.assertEqual(missing_group_by_fill(records, ["Gender", "Disability", "All Students"]), [
+            (1, "Disability", 42),
+            (2, "Gender", 30),
+            (2, "Disability", 30),
+            # A school without a school_code gets its records but does not count towards the totals
+            (4, "Gender", 0),
+            (4, "Disability", 0),
+        ])
+
+    def test_a_school_without_all_students_is_an_error(self):
+        records = [SimpleNamespace(district_code="1", school_code="10", group_by="Gender", student_count=3)]
+        with self.assertRaisesMessage(ValueError, "No All Students record for school 10 of district 1"):
+            missing_group_by_fill(records, ["Gender", "Disability"])
+
+    def test_nothing_missing(self):
+        records = [SimpleNamespace(district_code="1", school_code="10", group_by="Gender", student_count=3)]
+        self.assertEqual(missing_group_by_fill(records, ["Gender"]), [])
+        self.assertEqual(missing_group_by_fill([], ["Gender"]), [])
+
+
+class ParseStudentCountTests(SimpleTestCase):
+    def test_whole_numbers(self):
+        self.assertEqual(parse_student_count("12"), 12)
+        self.assertEqual(parse_student_count(" 7 "), 7)
+        self.assertEqual(parse_student_count("0"), 0)
+
+    def test_decimals_are_truncated(self):
+        self.assertEqual(parse_student_count("12.0"), 12)
+        self.assertEqual(parse_student_count("12.7"), 12)
+        self.assertEqual(parse_student_count("1e3"), 1000)
+
+    def test_redacted_and_blank_counts_are_none(self):
+        for value in ("*", "", "  ", None, "n/a", "nan", "inf"):
+            with self.subTest(value=value):
+                self.assertIsNone(parse_student_count(value))
+
+
+class NormalizeCodeTests(SimpleTestCase):
+    def test_leading_zeros_and_padding_are_dropped(self):
+        self.assertEqual(normalize_code("0150"), "150")
+        self.assertEqual(normalize_code(" 02835 "), "2835")
+        self.assertEqual(normalize_code("150"), "150")
+        self.assertEqual(normalize_code(150), "150")
+
+    def test_blank_and_all_zero_codes(self):
+        self.assertEqual(normalize_code(""), "")
+        self.assertEqual(normalize_code("   "), "")
+        self.assertEqual(normalize_code("0000"), "")
+        self.assertIsNone(normalize_code(None))
+
+    def test_inner_zeros_are_kept(self):
+        self.assertEqual(normalize_code("0100"), "100")
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False, DATA_PROCESSOR_SKIP_DUPLICATE_UPLOADS=False)
+class UpsertSchoolDataTests(TestCase):
+    def setUp(self):
+        self.rows = [
+            enrollment_row(count="30"),
+            enrollment_row(group_by="Gender", group_by_value="Female", count="12"),
+            enrollment_row(group_by="Gender", group_by_value="Male", count="15"),
+        ]
+        handle_uploaded_file(main_file(self.rows), stratifications_file=stratifications_file())
+
+    def stored_counts(self):
+        return sorted(SchoolData.objects.values_list("school_code", "group_by_value", "student_count"))
+
+    def test_changed_counts_are_updated_and_new_keys_inserted(self):
+        ids = dict(SchoolData.objects.values_list("group_by_value", "id"))
+        rows = [
+            enrollment_row(count="30"),
+            enrollment_row(group_by="Gender", group_by_value="Female", count="14"),
+            enrollment_row(group_by="Gender", group_by_value="Male", count="15"),
+            enrollment_row(school_code="0200", count="8"),
+        ]
+        report = handle_uploaded_file(main_file(rows), upsert=True)
+
+        self.assertEqual((report["inserted"], report["updated"], report["unchanged"]), (1, 1, 2))
+        self.assertEqual(report["changed_keys"], {
+            ("2023-24", "2835", "150", "Gender", "Female"),
+            ("2023-24", "2835", "200", "All Students", "All Students"),
+        })
+        self.assertEqual(self.stored_counts(), [
+            ("150", "All Students", 30), ("150", "Female", 14), ("150", "Male", 15), ("200", "All Students", 8),
+        ])
+        # The changed row is updated in place, not replaced
+        self.assertEqual(SchoolData.objects.get(group_by_value="Female").id, ids["Female"])
+
+    def test_rows_missing_from_the_file_are_left_alone(self):
+        report = handle_uploaded_file(main_file([enrollment_row(count="31")]), upsert=True)
+
+        self.assertEqual((report["inserted"], report["updated"], report["unchanged"]), (0, 1, 0))
+        self.assertEqual(self.stored_counts(), [("150", "All Students", 31), ("150", "Female", 12), ("150", "Male", 15)])
+
+    def test_stratifications_are_linked_on_insert_and_update(self):
+        rows = [enrollment_row(group_by="Gender", group_by_value="Unknown", count="3")]
+        handle_uploaded_file(main_file(rows), upsert=True)
+
+        record = SchoolData.objects.get(group_by_value="Unknown")
+        self.assertEqual(record.stratification.label_name, "SEXU")
+
+    @override_settings(DATA_PROCESSOR_INGEST_BATCH_SIZE=1)
+    def test_duplicate_keys_are_matched_in_order_across_batches(self):
+        duplicate = enrollment_row(group_by="Gender", group_by_value="Male", count="4")
+        handle_uploaded_file(main_file(self.rows + [duplicate]), upsert=True)
+        first_ids = list(SchoolData.objects.filter(group_by_value="Male").order_by("id").values_list("id", "student_count"))
+
+        # Loading the same rows again, one row per batch, matches both stored rows and changes nothing
+        report = handle_uploaded_file(main_file(self.rows + [duplicate], name="again.csv"), upsert=True)
+
+        self.assertEqual((report["inserted"], report["updated"], report["unchanged"]), (0, 0, 4))
+        self.assertEqual(
+            list(SchoolData.objects.filter(group_by_value="Male").order_by("id").values_list("id", "student_count")),
+            first_ids,
+        )
+        self.assertEqual([count for record_id, count in first_ids], [15, 4])
+
+    def test_an_update_in_place_invalidates_the_layer_cache(self):
+        transformer = DataTransformer()
+        self.assertTrue(transformer.apply_tri_county_layer_transformation())
+        self.assertTrue(transformer.apply_tri_county_layer_transformation().skipped)
+        fingerprint = input_fingerprint()
+
+        handle_uploaded_file(main_file([enrollment_row(count="40")]), upsert=True)
+
+        self.assertNotEqual(input_fingerprint(), fingerprint)
+        self.assertFalse(transformer.apply_tri_county_layer_transformation().skipped)
+
+    def test_an_edited_stratification_invalidates_the_layer_cache(self):
+        fingerprint = input_fingerprint()
+        stratification = Stratification.objects.get(label_name="SEXF")
+        stratification.label_name = "SEXF2"
+        stratification.save()
+
+        self.assertNotEqual(input_fingerprint(), fingerprint)
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False, DATA_PROCESSOR_SKIP_DUPLICATE_UPLOADS=False)
+class SchoolDataBatchesTests(TestCase):
+    def setUp(self):
+        handle_uploaded_file(main_file([enrollment_row()]), stratifications_file=stratifications_file())
+
+    def batch_rows(self, content):
+        rows = [
+            values for batch in school_data_batches(
+                read_uploaded_csv(SimpleUploadedFile("enrollment.csv", content)), stratification_id_map(), 2,
+            )
+            for values in batch
+        ]
+        # Plain Python values, the tuples are handed to the database driver as they are
+        for values in rows:
+            self.assertTrue(all(value is None or type(value) in (str, int) for value in values))
+        return rows
+
+    def test_byte_order_mark(self):
+        content = main_file([enrollment_row(), enrollment_row(group_by="Gender", group_by_value="Female")]).read()
+        rows = self.batch_rows(b"\xef\xbb\xbf" + content)
+        self.assertEqual([row[0] for row in rows], ["2023-24", "2023-24"])
+
+    def test_quoted_newlines(self):
+        row = enrollment_row()
+        row[9] = '"Kimberly\nElementary, North"'
+        rows = self.batch_rows(main_file([row, enrollment_row(school_code="0200")]).read())
+        self.assertEqual(rows[0][SCHOOL_DATA_INSERT_FIELDS.index("school_name")], "Kimberly\nElementary, North")
+        self.assertEqual(len(rows), 2)
+
+    def test_empty_values_and_skipped_counts(self):
+        rows = self.batch_rows(main_file([
+            enrollment_row(school_code="", count=""),
+            enrollment_row(group_by="Grade", group_by_value="KG", count="12.0"),
+            enrollment_row(group_by="Gender", group_by_value="Female", count="*"),
+            enrollment_row(group_by="Gender", group_by_value="Male", count="0"),
+            enrollment_row(group_by="Gender", group_by_value="Unknown", count="5"),
+        ]).read())
+        fields = [SCHOOL_DATA_INSERT_FIELDS.index(field) for field in ("school_code", "group_by", "student_count")]
+        self.assertEqual([tuple(row[index] for index in fields) for row in rows], [
+            ("", "All Students", None), ("150", "Grade Level", 12), ("150", "Gender", 5),
+        ])
+        stratification_ids = [row[-1] for row in rows]
+        self.assertEqual(stratification_ids[1], None)
+        self.assertEqual(stratification_ids[2], Stratification.objects.get(label_name="SEXU").id)
+
+    def test_replacing_the_table_links_the_rows_and_invalidates_the_layer_cache(self):
+        fingerprint = input_fingerprint()
+        report = handle_uploaded_file(main_file([
+            enrollment_row(count="7"), enrollment_row(group_by="Gender", group_by_value="Male", count="3"),
+        ]))
+        self.assertEqual(report["inserted"], 2)
+        self.assertEqual(
+            sorted(SchoolData.objects.values_list("student_count", "stratification__label_name")),
+            [(3, "SEXM"), (7, "")],
+        )
+        self.assertNotEqual(input_fingerprint(), fingerprint)
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False)
+class LoadStratificationsTests(TestCase):
+    def test_rows_are_linked_without_returning_ids_from_the_insert(self):
+        # Databases without RETURNING (SQLite before 3.35) leave the ids of bulk_create instances unset
+        with mock.patch.object(type(connection.features), "can_return_rows_from_bulk_insert", False):
+            handle_uploaded_file(
+                main_file([enrollment_row(group_by="Gender", group_by_value="Female")]),
+                stratifications_file=stratifications_file(),
+            )
+
+        self.assertEqual(SchoolData.objects.get().stratification.label_name, "SEXF")
+
+
+# The loads of an upload run on worker threads with their own connections, so these tests commit for real
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False)
+class IngestUploadsTests(TransactionTestCase):
+    def test_a_failed_load_names_the_files_that_were_committed(self):
+        with self.assertRaises(IngestError) as raised:
+            ingest_uploads(
+                main_file([enrollment_row()]),
+                stratifications_file=stratifications_file(),
+                county_geoid_file=county_geoid_file(header="Layer,Name,ID"),
+            )
+
+        self.assertEqual(raised.exception.failed, ["geoids.csv"])
+        self.assertEqual(raised.exception.committed, ["stratifications.csv", "enrollment.csv"])
+        self.assertIn("Missing required columns", str(raised.exception))
+        self.assertEqual(SchoolData.objects.count(), 1)
+        self.assertFalse(CountyGEOID.objects.exists())
+
+    def test_a_failed_main_file_leaves_the_other_loads_committed(self):
+        rows = main_file([enrollment_row()]).read().replace(b"STUDENT_COUNT", b"COUNT")
+        with self.assertRaises(IngestError) as raised:
+            ingest_uploads(SimpleUploadedFile("enrollment.csv", rows), county_geoid_file=county_geoid_file())
+
+        self.assertEqual(raised.exception.failed, ["enrollment.csv"])
+        self.assertEqual(raised.exception.committed, ["geoids.csv"])
+        self.assertEqual(CountyGEOID.objects.count(), 2)
+
+    def test_a_load_waits_for_the_other_writer_instead_of_failing(self):
+        results = []
+        loader = threading.Thread(target=lambda: results.append(load_county_geoid_file(county_geoid_file())))
+        with write_transaction():
+            loader.start()
+            # The loader parses its file and then queues behind the open write transaction
+            loader.join(timeout=0.5)
+            self.assertTrue(loader.is_alive())
+        loader.join()
+
+        self.assertEqual(results, [True])
+        self.assertEqual(CountyGEOID.objects.count(), 2)
+
+    def test_a_malformed_main_file_fails_without_waiting_for_the_other_writer(self):
+        rows = main_file([enrollment_row()]).read().replace(b"STUDENT_COUNT", b"COUNT")
+        errors = []
+
+        def load():
+            try:
+                handle_uploaded_file(SimpleUploadedFile("enrollment.csv", rows))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        loader = threading.Thread(target=load)
+        with write_transaction():
+            loader.start()
+            # The main file is parsed before the write lock is taken, so the error comes at once
+            loader.join(timeout=5)
+            self.assertFalse(loader.is_alive())
+        loader.join()
+
+        self.assertEqual([type(error) for error in errors], [KeyError])
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False)
+class SqlAggregationTests(TestCase):
+    def setUp(self):
+        rows = []
+        for school_code, county, total in [
+            ("0150", "Outagamie", 40), ("0200", "Calumet", 25), ("0300", "Dane", 9), ("", "[Statewide]", 900),
+        ]:
+            rows += [
+                enrollment_row(school_code=school_code, county=county, count=str(total)),
+                enrollment_row(school_code=school_code, county=county, group_by="Gender", group_by_value="Female", count="7"),
+                enrollment_row(school_code=school_code, county=county, group_by="Gender", group_by_value="Male", count="*"),
+            ]
+        # The statewide rows are the ones of the "[Statewide]" district
+        for row in rows[-3:]:
+            row[8] = "[Statewide]"
+        handle_uploaded_file(main_file(rows), stratifications_file=stratifications_file())
+
+    def layer_rows(self, model):
+        return sorted(model.objects.values_list("layer", "geoid", "stratification", "period", "value"))
+
+    def test_database_sums_match_the_python_grouping(self):
+        for layer, model in [
+            ("apply_tri_county_layer_transformation", MetopioTriCountyLayerTransformation),
+            ("transform_Metopio_StateWideLayer", MetopioStateWideLayerTransformation),
+        ]:
+            with self.subTest(layer=layer):
+                outputs = []
+                for enabled in (False, True):
+                    with self.settings(DATA_PROCESSOR_SQL_AGGREGATION=enabled):
+                        self.assertTrue(getattr(DataTransformer(), layer)(force=True))
+                    outputs.append(self.layer_rows(model))
+                self.assertTrue(outputs[0])
+                self.assertEqual(outputs[1], outputs[0])
+
+
+class DataTransformerTests(SimpleTestCase):
+    def test_the_legacy_request_argument_is_rejected(self):
+        # DataTransformer(request) used to bind the request to defer_writes, the layers were then never written
+        with self.assertRaises(TypeError):
+            DataTransformer(SimpleNamespace(method="GET"))
+        self.assertIsNone(DataTransformer().pending_writes)
+        self.assertEqual(DataTransformer(defer_writes=True).pending_writes, [])
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False, DATA_PROCESSOR_SKIP_DUPLICATE_UPLOADS=False)
+class LayerCacheTests(TestCase):
+    def setUp(self):
+        statewide = enrollment_row(school_code="", county="[Statewide]", count="900")
+        statewide[9] = "[Statewide]"
+        districtwide = enrollment_row(school_code="", count="30")
+        districtwide[9] = "[Districtwide]"
+        handle_uploaded_file(
+            main_file([enrollment_row(count="30"), districtwide, statewide]), stratifications_file=stratifications_file(),
+        )
+        load_county_geoid_file(county_geoid_file())
+
+    def test_the_statewide_v01_cache_ignores_the_tri_county_rows(self):
+        transformer = DataTransformer()
+        self.assertTrue(transformer.transform_statewide())
+        TransformedSchoolData.objects.filter(place='WI').delete()
+        self.assertTrue(transformer.transform_tri_county())
+        self.assertTrue(TransformedSchoolData.objects.filter(place='Tri-County').exists())
+
+        # Only the Tri-County rows are left in the shared table, so the Statewide V01 layer is rebuilt
+        result = transformer.transform_statewide()
+
+        self.assertFalse(result.skipped)
+        self.assertEqual(result.records, 1)
+        self.assertEqual(TransformedSchoolData.objects.filter(place='WI').count(), 1)
+
+    def test_an_empty_output_clears_the_stale_layer_rows(self):
+        for layer, model in [
+            ("apply_tri_county_layer_transformation", MetopioTriCountyLayerTransformation),
+            ("apply_county_layer_transformation", CountyLayerTransformation),
+        ]:
+            with self.subTest(layer=layer):
+                handle_uploaded_file(main_file([enrollment_row(count="30")]))
+                self.assertTrue(getattr(DataTransformer(), layer)())
+                self.assertTrue(model.objects.exists())
+
+                # Zero counts are not written, so the new build has no rows
+                handle_uploaded_file(main_file([enrollment_row(count="0")]))
+                result = getattr(DataTransformer(), layer)()
+
+                self.assertTrue(result)
+                self.assertEqual(result.records, 0)
+                self.assertFalse(model.objects.exists())
+
+
+class InlineExecutor:
+    """ Stands in for the ProcessPoolExecutor of run_all_layers: runs each layer right away in this process,
+    so the workers see the test database """
+
+    def __init__(self, max_workers=None, initializer=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False, DATA_PROCESSOR_SKIP_DUPLICATE_UPLOADS=False)
+class LayerProcessesTests(TestCase):
+    def setUp(self):
+        handle_uploaded_file(main_file([enrollment_row(count="0")]), stratifications_file=stratifications_file())
+        load_county_geoid_file(county_geoid_file())
+
+    def run_layers(self):
+        # The layers run inline inside the transaction of the test, their connection must stay open
+        with mock.patch.object(transformers, "ProcessPoolExecutor", InlineExecutor), \
+                mock.patch.object(transformers.connections, "close_all"):
+            return DataTransformer().run_all_layers(layers=["Tri-County", "County-Layer"], jobs=2)
+
+    def test_a_layer_built_without_rows_is_recorded(self):
+        MetopioTriCountyLayerTransformation.objects.create(
+            layer="Tri-County", geoid="stale", stratification="", period="2022", value=1,
+        )
+        result = self.run_layers()
+
+        self.assertTrue(result)
+        self.assertEqual([layer_result.skipped for layer_result in result.results], [False, False])
+        self.assertFalse(MetopioTriCountyLayerTransformation.objects.exists())
+        self.assertFalse(CountyLayerTransformation.objects.exists())
+        self.assertEqual(
+            sorted(LayerBuild.objects.values_list("layer", "records")), [("County-Layer", 0), ("Tri-County", 0)]
+        )
+        # The empty layers are served from the cache on the next run
+        self.assertEqual([layer_result.skipped for layer_result in self.run_layers().results], [True, True])
+
+    def test_the_diagnostics_are_written_before_the_worker_returns(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(DATA_PROCESSOR_DIAGNOSTICS=True, DATA_PROCESSOR_DIAGNOSTICS_DIR=directory):
+                # The County layer writes its intermediate data, the worker flushes the writer thread
+                with mock.patch.object(transformers, "flush_diagnostics", wraps=flush_diagnostics) as flushed:
+                    self.assertTrue(self.run_layers())
+                self.assertEqual(flushed.call_count, 2)
+                written = [name for _, _, names in os.walk(directory) for name in names]
+            self.assertTrue(written)
+            self.assertTrue(all(name.endswith(".xlsx") for name in written))
+
+    def test_flush_waits_for_the_queued_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with self.settings(DATA_PROCESSOR_DIAGNOSTICS=True, DATA_PROCESSOR_DIAGNOSTICS_DIR=directory):
+                run = DiagnosticsRun("County-Layer")
+                run.write_excel("rows.xlsx", [{"county": "Outagamie", "count": 30}])
+                flush_diagnostics()
+                self.assertTrue(os.path.exists(os.path.join(run.directory, "rows.xlsx")))
+
+
+def spooled_upload_name(file):
+    with file.open() as upload:
+        return {"message": f"{file.name}: {upload.read().decode()}", "next_url": "/done/"}
+
+
+def failing_target():
+    raise ValueError("Missing required columns: GEOID")
+
+
+# The jobs run on the worker threads with their own connections, so these tests commit for real
+class JobsTests(TransactionTestCase):
+    def wait_for(self, job):
+        """ Poll the status endpoint like the job page does, returns the last status """
+        deadline = time.monotonic() + 10
+        while True:
+            status = self.client.get(reverse("job_status", args=[job.id])).json()
+            if status["done"] or time.monotonic() > deadline:
+                return status
+            time.sleep(0.05)
+
+    def test_a_job_runs_to_success_and_its_uploads_are_removed(self):
+        with tempfile.TemporaryDirectory() as directory, self.settings(DATA_PROCESSOR_JOBS_DIR=directory):
+            job = jobs.submit(
+                "ingest", "Upload of geoids.csv", spooled_upload_name,
+                uploads={"file": SimpleUploadedFile("geoids.csv", b"Layer,Name,GEOID")},
+            )
+            self.assertEqual(job.status, Job.QUEUED)
+            status = self.wait_for(job)
+
+            self.assertEqual(status["status"], Job.SUCCEEDED)
+            self.assertEqual(status["message"], "geoids.csv: Layer,Name,GEOID")
+            self.assertEqual(status["next_url"], "/done/")
+            self.assertIsNotNone(status["elapsed"])
+            # The directory is removed right after the status is saved
+            deadline = time.monotonic() + 10
+            while os.path.exists(jobs.job_directory(job.id)) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            self.assertFalse(os.path.exists(jobs.job_directory(job.id)))
+
+    def test_a_failed_job_reports_its_error(self):
+        job = jobs.submit("ingest", "Upload of geoids.csv", failing_target)
+        status = self.wait_for(job)
+
+        self.assertEqual(status["status"], Job.FAILED)
+        self.assertTrue(status["done"])
+        self.assertEqual(status["message"], "Missing required columns: GEOID")
+        self.assertEqual(status["next_url"], "")
+
+    def test_an_unknown_job_is_not_found(self):
+        self.assertEqual(self.client.get(reverse("job_status", args=[404])).status_code, 404)
+
+    def test_the_jobs_of_a_stopped_server_are_failed_when_the_workers_start(self):
+        running = Job.objects.create(kind="ingest", description="Upload", status=Job.RUNNING)
+        queued = Job.objects.create(kind="transformation", description="All Layers")
+        # A new server process: its worker pool is not started yet
+        with mock.patch.object(jobs, "_workers", None), mock.patch.object(jobs, "_started_at", timezone.now()):
+            status = self.client.get(reverse("job_status", args=[running.id])).json()
+            new = Job.objects.create(kind="ingest", description="Upload")
+            jobs.start_workers().shutdown()
+
+            self.assertEqual(jobs.fail_orphaned_jobs(), 0)
+
+        self.assertEqual((status["status"], status["done"]), (Job.FAILED, True))
+        self.assertIn("server was stopped", status["message"])
+        self.assertEqual(Job.objects.get(id=queued.id).status, Job.FAILED)
+        self.assertEqual(Job.objects.get(id=new.id).status, Job.QUEUED)
+
+
+# View name -> layer table of the layer views, every one of them is built by _materialize_layer
+LAYER_VIEWS = {
+    "tri_county_view": MetopioTriCountyLayerTransformation,
+    "county_layer_view": CountyLayerTransformation,
+    "metopio_statewide_layer_view": MetopioStateWideLayerTransformation,
+    "metopio_zipcode_layer_view": ZipCodeLayerTransformation,
+    "metopio_city_town_view": MetopioCityLayerTransformation,
+}
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False, DATA_PROCESSOR_MATERIALIZED_VIEWS=True)
+class LayerViewsTests(TestCase):
+    def setUp(self):
+        statewide = enrollment_row(school_code="", county="[Statewide]", count="900")
+        statewide[8] = "[Statewide]"
+        handle_uploaded_file(main_file([enrollment_row(count="30"), statewide]), stratifications_file=stratifications_file())
+        load_county_geoid_file(county_geoid_file())
+        self.assertTrue(DataTransformer().run_all_layers())
+
+    def stored_ids(self, model):
+        return sorted(model.objects.values_list("id", flat=True))
+
+    def test_a_get_serves_the_stored_layer(self):
+        for view, model in LAYER_VIEWS.items():
+            with self.subTest(view=view):
+                ids = self.stored_ids(model)
+                # The layer is not computed again: its inputs are never loaded
+                with mock.patch.object(transformers, "LayerInputs") as inputs:
+                    response = self.client.get(reverse(view))
+
+                self.assertEqual(response.status_code, 200)
+                inputs.assert_not_called()
+                self.assertEqual(self.stored_ids(model), ids)
+
+    def test_the_stored_rows_are_shown(self):
+        response = self.client.get(reverse("tri_county_view"))
+
+        self.assertEqual(
+            [(row.stratification, row.value) for row in response.context["data"]],
+            list(MetopioTriCountyLayerTransformation.objects.values_list("stratification", "value")),
+        )
+        self.assertTrue(response.context["data"])
+
+    def test_a_refresh_rebuilds_the_layer_and_redirects(self):
+        for view, model in LAYER_VIEWS.items():
+            with self.subTest(view=view):
+                before = dict(LayerBuild.objects.values_list("layer", "built_at"))
+                with mock.patch.object(transformers, "LayerInputs", wraps=transformers.LayerInputs) as inputs:
+                    response = self.client.post(reverse(view))
+
+                self.assertEqual(response.status_code, 302)
+                self.assertTrue(response["Location"].startswith(reverse(view) + "?type="))
+                inputs.assert_called_once_with()
+                # Only the layer of the view was built again
+                changed = [
+                    layer for layer, when in LayerBuild.objects.values_list("layer", "built_at") if when != before[layer]
+                ]
+                self.assertEqual(len(changed), 1)
+
+
+# Layer name of DataTransformer.LAYERS -> its table
+LAYER_MODELS = {
+    "Tri-County": MetopioTriCountyLayerTransformation,
+    "County-Layer": CountyLayerTransformation,
+    "Metopio Statewide": MetopioStateWideLayerTransformation,
+    "Zipcode": ZipCodeLayerTransformation,
+    "City-Town": MetopioCityLayerTransformation,
+}
+
+GEOID_LINES = ['County,"Calumet County, WI",55015', 'City or town,"Kimberly, WI",1600000US5539900']
+
+
+def load_layer_fixtures():
+    """ Enrollment of two Kimberly Area schools, a Calumet school and the state, with their geography """
+    rows = []
+    for school_code, county, total in [("0150", "Outagamie", 40), ("0200", "Outagamie", 25), ("0300", "Calumet", 18)]:
+        rows += [
+            enrollment_row(school_code=school_code, county=county, count=str(total)),
+            enrollment_row(school_code=school_code, county=county, group_by="Gender", group_by_value="Female", count="7"),
+            enrollment_row(school_code=school_code, county=county, group_by="Gender", group_by_value="Male", count="9"),
+        ]
+    statewide = enrollment_row(school_code="", county="[Statewide]", count="900")
+    statewide[8] = "[Statewide]"
+    handle_uploaded_file(main_file(rows + [statewide]), stratifications_file=stratifications_file())
+    load_county_geoid_file(county_geoid_file(extra_lines=GEOID_LINES))
+    load_school_address_file(school_address_file([("0150", "Kimberly", "54136"), ("0200", "Combined Locks", "54113")]))
+
+
+def layer_tables():
+    return {
+        layer: sorted(model.objects.values_list("layer", "geoid", "stratification", "period", "value"))
+        for layer, model in LAYER_MODELS.items()
+    }
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False)
+class RunAllLayersTests(TestCase):
+    def setUp(self):
+        load_layer_fixtures()
+
+    def test_the_shared_run_matches_the_layers_built_one_by_one(self):
+        self.assertTrue(DataTransformer().run_all_layers(force=True))
+        shared = layer_tables()
+        for layer, method in DataTransformer.LAYERS.items():
+            with self.subTest(layer=layer):
+                self.assertTrue(getattr(DataTransformer(), method)(force=True))
+                self.assertTrue(shared[layer])
+
+        self.assertEqual(layer_tables(), shared)
+
+    def test_skipped_layers_load_no_inputs(self):
+        self.assertTrue(DataTransformer().run_all_layers())
+        created = []
+
+        def layer_inputs(*args, **kwargs):
+            created.append(LayerInputs(*args, **kwargs))
+            return created[-1]
+
+        with mock.patch.object(transformers, "LayerInputs", side_effect=layer_inputs):
+            result = DataTransformer().run_all_layers()
+
+        self.assertTrue(result)
+        self.assertTrue(all(layer_result.skipped for layer_result in result.results))
+        # Nothing was read through the shared LayerInputs: none of its cached properties were filled
+        self.assertEqual([vars(inputs) for inputs in created], [{"shared": True}])
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False, DATA_PROCESSOR_SKIP_DUPLICATE_UPLOADS=True)
+class IngestedFileTests(TestCase):
+    def setUp(self):
+        self.rows = [enrollment_row(count="30"), enrollment_row(group_by="Gender", group_by_value="Female", count="12")]
+        handle_uploaded_file(main_file(self.rows), stratifications_file=stratifications_file())
+        self.assertEqual(IngestedFile.objects.count(), 2)
+
+    def stored_rows(self):
+        return sorted(SchoolData.objects.values_list("id", "group_by_value", "student_count"))
+
+    def test_an_identical_file_over_unchanged_tables_is_skipped(self):
+        rows = self.stored_rows()
+        # The content is compared, not the name
+        report = handle_uploaded_file(main_file(self.rows, name="enrollment (1).csv"), stratifications_file())
+
+        self.assertTrue(report["skipped"])
+        self.assertEqual(report["inserted"], 0)
+        self.assertEqual(self.stored_rows(), rows)
+        self.assertEqual(IngestedFile.objects.count(), 2)
+
+    def test_an_identical_file_is_imported_again_once_its_table_changed(self):
+        record = SchoolData.objects.get(group_by_value="Female")
+        record.student_count = 99
+        record.save()
+
+        report = handle_uploaded_file(main_file(self.rows))
+
+        self.assertFalse(report["skipped"])
+        self.assertEqual(report["inserted"], 2)
+        self.assertEqual(SchoolData.objects.get(group_by_value="Female").student_count, 12)
+        # The reload is recorded, a third copy is skipped again
+        self.assertTrue(handle_uploaded_file(main_file(self.rows))["skipped"])
+
+    def test_the_main_file_is_imported_again_once_the_stratifications_changed(self):
+        Stratification.objects.filter(label_name="SEXF").update(label_name="SEXF2")
+
+        self.assertFalse(handle_uploaded_file(main_file(self.rows))["skipped"])
+
+    def test_a_replace_after_an_upsert_of_the_same_file_is_not_skipped(self):
+        self.assertTrue(handle_uploaded_file(main_file(self.rows), upsert=True)["skipped"])
+        handle_uploaded_file(main_file(self.rows + [enrollment_row(school_code="0200")], name="more.csv"), upsert=True)
+        self.assertTrue(handle_uploaded_file(main_file(self.rows + [enrollment_row(school_code="0200")]), upsert=True)["skipped"])
+
+        # Replacing the table with the upserted file must still drop the rows it does not have
+        report = handle_uploaded_file(main_file(self.rows + [enrollment_row(school_code="0200")]))
+
+        self.assertFalse(report["skipped"])
+        self.assertEqual(SchoolData.objects.count(), 3)
+
+    def test_the_geoid_file_is_skipped_until_its_table_changed(self):
+        self.assertTrue(load_county_geoid_file(county_geoid_file()))
+        self.assertFalse(load_county_geoid_file(county_geoid_file()))
+
+        CountyGEOID.objects.get(layer="Zip code").delete()
+
+        self.assertTrue(load_county_geoid_file(county_geoid_file()))
+        self.assertEqual(CountyGEOID.objects.count(), 2)
+
+
+def crosswalk():
+    return sorted(SchoolGeography.objects.values_list(
+        "lea_code", "school_code", "zip_code", "city", "county", "zip_geoid", "city_geoid", "county_geoid",
+    ))
+
+
+# The crosswalk of the GEOID_LINES and the addresses of load_layer_fixtures
+EXPECTED_CROSSWALK = [
+    ("2835", "150", "54136", "Kimberly", "Outagamie", "86000US54136", "1600000US5539900", "55087"),
+    ("2835", "200", "54113", "Combined Locks", "Outagamie", None, None, "55087"),
+]
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False)
+class SchoolGeographyTests(TestCase):
+    def setUp(self):
+        load_layer_fixtures()
+
+    def test_the_crosswalk_joins_the_addresses_to_their_geoids(self):
+        self.assertEqual(crosswalk(), EXPECTED_CROSSWALK)
+
+    def test_the_last_address_of_a_school_wins(self):
+        load_school_address_file(school_address_file([
+            ("0150", "Kimberly", "54113"), ("150", "Kimberly", "54136"), ("0200", "Combined Locks", "54113"),
+        ]))
+
+        self.assertEqual(crosswalk(), EXPECTED_CROSSWALK)
+
+    def test_either_load_rebuilds_the_crosswalk(self):
+        load_county_geoid_file(county_geoid_file(extra_lines=GEOID_LINES + ["Zip code,54113,86000US54113"]))
+        self.assertEqual(SchoolGeography.objects.get(school_code="200").zip_geoid, "86000US54113")
+
+        load_school_address_file(school_address_file([("0150", "Kimberly", "54136")]))
+        self.assertEqual(crosswalk(), EXPECTED_CROSSWALK[:1])
+
+    def test_rebuild_replaces_the_rows(self):
+        SchoolGeography.objects.update(zip_geoid="stale")
+        rebuild_school_geography()
+
+        self.assertEqual(crosswalk(), EXPECTED_CROSSWALK)
+
+    def test_the_zip_code_and_city_layers_read_the_crosswalk(self):
+        for method, model, field in [
+            ("transforms_Metopio_ZipCodeLayer", ZipCodeLayerTransformation, "zip_geoid"),
+            ("transform_Metopio_CityLayer", MetopioCityLayerTransformation, "city_geoid"),
+        ]:
+            with self.subTest(layer=method):
+                self.assertTrue(getattr(DataTransformer(), method)(force=True))
+                self.assertEqual(set(model.objects.values_list("geoid", flat=True)), {
+                    geoid for geoid in SchoolGeography.objects.values_list(field, flat=True) if geoid
+                })
+
+                # Only the crosswalk is changed, the address and GEOID tables are left as they are
+                SchoolGeography.objects.filter(school_code="150").update(**{field: "moved"})
+                self.assertTrue(getattr(DataTransformer(), method)(force=True))
+
+                self.assertEqual(set(model.objects.values_list("geoid", flat=True)), {"moved"})
+
+
+class SchoolGeographyMigrationTests(TransactionTestCase):
+    before = [("__data_processor__", "0025_normalized_codes")]
+    after = [("__data_processor__", "0026_schoolgeography")]
+
+    def tearDown(self):
+        # Back to the latest migration for the other tests
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_the_migration_backfills_the_crosswalk(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        apps = executor.loader.project_state(self.before).apps
+        CountyGEOID = apps.get_model("__data_processor__", "CountyGEOID")
+        SchoolAddressFile = apps.get_model("__data_processor__", "SchoolAddressFile")
+        for layer, name, geoid in [
+            ("County", "Outagamie County, WI", "55087"), ("Zip code", "54136", "86000US54136"),
+            ("City or town", "Kimberly, WI", "1600000US5539900"),
+        ]:
+            CountyGEOID.objects.create(layer=layer, name=name, geoid=geoid)
+        for school_code, city, zip_code in [("150", "Kimberly", "54136"), ("200", "Combined Locks", "54113")]:
+            SchoolAddressFile.objects.create(
+                lea_code="2835", school_code=school_code, city=city, zip_code=zip_code, county="Outagamie",
+                charter_status=False,
+            )
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+
+        apps = executor.loader.project_state(self.after).apps
+        rows = apps.get_model("__data_processor__", "SchoolGeography").objects.values_list(
+            "lea_code", "school_code", "zip_code", "city", "county", "zip_geoid", "city_geoid", "county_geoid",
+        )
+        self.assertEqual(sorted(rows), EXPECTED_CROSSWALK)
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False)
+class ManagementCommandsTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, upload):
+        """ Save an upload of the fixtures as a file for the commands, returns its path """
+        path = os.path.join(self.directory, upload.name)
+        with open(path, "wb") as f:
+            f.write(upload.read())
+        return path
+
+    def call(self, *args):
+        stdout, stderr = StringIO(), StringIO()
+        call_command(*args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue()
+
+    def load_all(self):
+        self.call("ingest_enrollment", self.write(main_file([enrollment_row(count="30")])),
+                  "--stratifications", self.write(stratifications_file()))
+        self.call("ingest_geoids", self.write(county_geoid_file(extra_lines=GEOID_LINES)))
+        self.call("ingest_addresses", self.write(school_address_file([("0150", "Kimberly", "54136")])))
+
+    def test_ingest_enrollment(self):
+        path = self.write(main_file([enrollment_row(count="30"), enrollment_row(school_code="0200", count="8")]))
+        output = self.call("ingest_enrollment", path, "--stratifications", self.write(stratifications_file()))
+
+        self.assertIn("Ingest enrollment:", output)
+        self.assertEqual(SchoolData.objects.count(), 2)
+        self.assertEqual(Stratification.objects.count(), 4)
+
+        rows = main_file([enrollment_row(count="31")], name="update.csv")
+        self.call("ingest_enrollment", self.write(rows), "--upsert")
+        self.assertEqual(sorted(SchoolData.objects.values_list("student_count", flat=True)), [8, 31])
+
+    def test_ingest_geoids_and_addresses(self):
+        self.load_all()
+
+        self.assertEqual(CountyGEOID.objects.count(), 4)
+        self.assertEqual(crosswalk(), EXPECTED_CROSSWALK[:1])
+        # The same file again is left out
+        output = self.call("ingest_geoids", self.write(county_geoid_file(extra_lines=GEOID_LINES)))
+        self.assertIn("already ingested", output)
+
+    def test_a_missing_or_invalid_file_is_an_error(self):
+        with self.assertRaisesMessage(CommandError, "File not found"):
+            self.call("ingest_addresses", os.path.join(self.directory, "missing.csv"))
+        with self.assertRaisesMessage(CommandError, "Missing required columns"):
+            self.call("ingest_geoids", self.write(county_geoid_file(header="Layer,Name,ID")))
+
+    def test_build_layers(self):
+        self.load_all()
+        output = self.call("build_layers", "--layers", "tri-county,zip")
+
+        self.assertIn("Tri-County:", output)
+        self.assertIn("Zipcode:", output)
+        self.assertNotIn("County-Layer:", output)
+        self.assertEqual(set(LayerBuild.objects.values_list("layer", flat=True)), {"Tri-County", "Zipcode"})
+        self.assertTrue(ZipCodeLayerTransformation.objects.exists())
+
+        # Unchanged inputs are skipped unless --force is given
+        self.assertIn("skipped, unchanged", self.call("build_layers", "--layers", "tri-county"))
+        self.assertIn("(ok)", self.call("build_layers", "--layers", "tri-county", "--force"))
+
+    def test_build_layers_in_worker_processes(self):
+        self.load_all()
+        # The workers run inline in the transaction of the test, see LayerProcessesTests
+        with mock.patch.object(transformers, "ProcessPoolExecutor", InlineExecutor), \
+                mock.patch.object(transformers.connections, "close_all"):
+            output = self.call("build_layers", "--jobs", "2")
+
+        self.assertIn("Layers built successfully.", output)
+        self.assertEqual(LayerBuild.objects.count(), len(DataTransformer.LAYERS))
+
+    def test_build_layers_rejects_unknown_layers_and_jobs(self):
+        with self.assertRaisesMessage(CommandError, "Unknown layers: census"):
+            self.call("build_layers", "--layers", "county,census")
+        with self.assertRaisesMessage(CommandError, "--jobs must be at least 1"):
+            self.call("build_layers", "--jobs", "0")
+        self.assertFalse(LayerBuild.objects.exists())
+
+
+
+# The queries of a layer build do not depend on the number of SchoolData rows: the inputs are read once
+# and the rows written with bulk_create. The fixtures write every layer in a single bulk_create batch.
+# Measured on rebuilds, the first build of a layer also creates its LayerBuild row
+FORCED_BUILD_QUERIES = 14
+CACHED_BUILD_QUERIES = 3  # The input generations, the LayerBuild row and the row count of the layer
+
+
+@override_settings(DATA_PROCESSOR_ARCHIVE_UPLOADS=False, DATA_PROCESSOR_SKIP_DUPLICATE_UPLOADS=False)
+class LayerQueriesTests(TestCase):
+    def setUp(self):
+        load_layer_fixtures()
+        self.assertTrue(DataTransformer().run_all_layers())
+
+    def forced_build_queries(self):
+        counts = {}
+        for layer, method in DataTransformer.LAYERS.items():
+            with CaptureQueriesContext(connection) as queries:
+                self.assertTrue(getattr(DataTransformer(), method)(force=True))
+            counts[layer] = len(queries)
+        return counts
+
+    def test_a_forced_build(self):
+        for layer, count in self.forced_build_queries().items():
+            with self.subTest(layer=layer):
+                self.assertLessEqual(count, FORCED_BUILD_QUERIES)
+
+    def test_a_forced_build_does_not_query_per_row(self):
+        counts = self.forced_build_queries()
+        # Ten times the schools, in the same counties, zip codes and cities
+        rows = []
+        for school in range(30):
+            county = "Calumet" if school % 3 else "Outagamie"
+            rows += [
+                enrollment_row(school_code=f"{school + 1000}", county=county, count="20"),
+                enrollment_row(school_code=f"{school + 1000}", county=county, group_by="Gender", group_by_value="Female", count="9"),
+            ]
+        handle_uploaded_file(main_file(rows), upsert=True)
+
+        self.assertEqual(self.forced_build_queries(), counts)
+
+    def test_a_cached_build(self):
+        for layer, method in DataTransformer.LAYERS.items():
+            with self.subTest(layer=layer), self.assertNumQueries(CACHED_BUILD_QUERIES):
+                self.assertTrue(getattr(DataTransformer(), method)().skipped)
+
+    def test_the_result_reports_the_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            result = DataTransformer().apply_tri_county_layer_transformation(force=True)
+
+        self.assertEqual(result.queries, len(queries))
@@ -11,27 +11,455 @@ from .models import (
     ZipCodeLayerTransformation,
     SchoolAddressFile,
     MetopioCityLayerTransformation,
-    Stratification
+    Stratification,
+    LayerBuild,
+    SchoolGeography,
+    input_generations,
 )
+from .diagnostics import DiagnosticsRun, flush_diagnostics
 
 
-from django.db import transaction
-from django.db import models
+from django.db import transaction, connection, connections
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import django
+import copy
+import functools
+import hashlib
 import logging
+import threading
+import time
 import traceback
-import pandas as pd
 from collections import defaultdict
-from django.db.models import Q, F
+from django.db.models import Q, F, Min, Sum
+from django.conf import settings
 from django.contrib import messages
+import pandas as pd
 logger = logging.getLogger(__name__)
-class DataTransformer:
-    def __init__(self, request):
-        self.request = request
 
+
+# LAYER RESULTS
+# The transformations do not talk to the HTTP request. Every layer method returns a LayerResult with
+# the outcome, the number of records in the layer table, the run time, the number of database queries,
+# the messages meant for the user and the warnings and errors the layer logged. It is truthy when the layer succeeded, so
+# `if transformer.apply_county_layer_transformation():` keeps working. The views turn the messages into
+# Django messages (add_result_messages in views.py), the jobs and commands read the result directly.
+class LayerResult:
+    def __init__(self, layer, success=False, records=0, seconds=0.0, skipped=False, messages=None, warnings=None):
+        self.layer = layer
+        self.success = success
+        self.records = records        # Rows in the layer table after the run
+        self.seconds = seconds
+        self.skipped = skipped        # True when the inputs were unchanged and the stored layer was kept
+        self.queries = 0              # Database queries of the run, they do not grow with the SchoolData rows
+        self.messages = messages or []  # (level, text) meant for the user
+        self.warnings = warnings or []  # Warnings and errors logged by the layer
+        self.results = []             # Results of the single layers, for run_all_layers
+        # Set when the layer was built in a worker process: the rows the parent process still has to write
+        # as [(model, rows)], and the input fingerprint to record once they are written
+        self.pending_writes = []
+        self.fingerprint = None
+
+    def __bool__(self):
+        return self.success
+
+    def __repr__(self):
+        status = "skipped" if self.skipped else ("ok" if self.success else "failed")
+        return f"<LayerResult {self.layer}: {status}, {self.records} records, {self.seconds:.2f}s, {self.queries} queries>"
+
+
+class _WarningCollector(logging.Handler):
+    """ Collects the warnings and errors logged by the thread running a layer """
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.thread_id = threading.get_ident()
+        self.records = []
+
+    def emit(self, record):
+        if record.thread == self.thread_id:
+            self.records.append(record.getMessage())
+
+
+class _QueryCounter:
+    """ Counts the queries sent to the database, installed with connection.execute_wrapper """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+# LAYER RESULT CACHE
+# Every layer is a pure function of four input tables. Each of them has a generation that every write
+# bumps, a reload as well as a row updated in place (see InputGeneration in models.py). Hashing the
+# four generations gives a fingerprint that costs one query instead of a full recompute and table rewrite.
+def input_fingerprint():
+    """ Fingerprint of the SchoolData, Stratification, CountyGEOID and SchoolAddressFile tables """
+    generations = input_generations([SchoolData, Stratification, CountyGEOID, SchoolAddressFile])
+    return hashlib.sha256("|".join(generations).encode()).hexdigest()
+
+
+def cached_layer(layer, output_model, output_filter=None):
+    """ Skip the recompute and write of a layer when its inputs match the last successful run.
+    output_filter selects the rows of the layer when output_model is shared with other transformations.
+    Pass force=True to the decorated method to rebuild regardless of the fingerprint.
+    The decorated method returns a LayerResult """
+    def decorator(method):
+        def output_rows():
+            rows = output_model.objects.all()
+            return rows.filter(output_filter) if output_filter is not None else rows
+
+        def build(self, *args, force=False, **kwargs):
+            started = time.perf_counter()
+            first_message = len(self.messages)
+            fingerprint = input_fingerprint()
+            last_build = None if force else LayerBuild.objects.filter(layer=layer, fingerprint=fingerprint).first()
+            if last_build is not None:
+                records = output_rows().count()
+                if records == last_build.records:
+                    logger.info(f"{layer} inputs are unchanged since the last build, skipping the transformation")
+                    return LayerResult(
+                        layer, success=True, skipped=True, records=records, seconds=time.perf_counter() - started,
+                    )
+
+            collector = _WarningCollector()
+            logger.addHandler(collector)
+            try:
+                success = bool(method(self, *args, **kwargs))
+            finally:
+                logger.removeHandler(collector)
+            result = LayerResult(
+                layer,
+                success=success,
+                seconds=time.perf_counter() - started,
+                messages=self.messages[first_message:],
+                warnings=collector.records,
+            )
+            if success and self.pending_writes is not None:
+                # Built in a worker process, the parent writes the rows and records the build
+                result.pending_writes, self.pending_writes = self.pending_writes, []
+                result.fingerprint = fingerprint
+                result.records = sum(len(rows) for model, rows in result.pending_writes)
+            elif success:
+                result.records = output_rows().count()
+                LayerBuild.objects.update_or_create(
+                    layer=layer, defaults={"fingerprint": fingerprint, "records": result.records}
+                )
+            return result
+
+        @functools.wraps(method)
+        def wrapper(self, *args, force=False, **kwargs):
+            # Every record reads its stratification from the map of LayerInputs, so the number of queries
+            # of a run only depends on the number of output rows inserted. It is reported on the result
+            queries = _QueryCounter()
+            with connection.execute_wrapper(queries):
+                result = build(self, *args, force=force, **kwargs)
+            result.queries += queries.count
+            return result
+        return wrapper
+    return decorator
+
+
+# The three counties of the Fox Valley region used by the Tri-County, Zip code and City layers
+TRI_COUNTIES = ['Outagamie', 'Winnebago', 'Calumet']
+
+
+# UNKNOWN FILL
+# Every layer adds "Unknown" rows for the students a group_by does not account for: at some grain (the whole
+# region, a county, a school) the "All Students" count minus the sum of the group_by. unknown_fill does that
+# with one groupby-sum per total on a DataFrame of the records instead of the dictionaries of every layer.
+# The layers differ in which records keep an Unknown:
+# - dedupe_on: the columns identifying one Unknown record, the first record (in order) of each wins.
+#   The region and statewide layers keep one Unknown per distinct difference, the others one per grain and group_by
+# - skip_unknown_values: records that already have the "Unknown" group_by_value do not make an Unknown themselves
+# Records with an empty grain column (schools without a school_code) do not count and never get an Unknown.
+def unknown_fill(records, grain=(), dedupe_on=("group_by",), skip_unknown_values=True):
+    """ Returns [(position of the record the Unknown is made from, difference)] in record order """
+    if not records:
+        return []
+    grain = list(grain)
+    columns = set(grain) | {column for column in dedupe_on if column != "difference"} | {"group_by", "group_by_value"}
+    frame = pd.DataFrame({column: [getattr(record, column) for record in records] for column in columns})
+    frame["student_count"] = pd.to_numeric(
+        pd.Series([record.student_count for record in records], dtype=object), errors="coerce"
+    ).fillna(0)
+
+    counted = frame[frame[grain].notna().all(axis=1)] if grain else frame
+    all_students = counted[counted["group_by"] == "All Students"]
+    if grain:
+        group_total = counted.groupby(grain + ["group_by"])["student_count"].transform("sum")
+        # "All Students" total of the grain of every record, 0 when the grain has none
+        all_total = (
+            counted[grain].merge(
+                all_students.groupby(grain, as_index=False)["student_count"].sum(), on=grain, how="left"
+            )["student_count"].fillna(0).set_axis(counted.index)
+        )
+    else:
+        group_total = counted.groupby("group_by")["student_count"].transform("sum")
+        all_total = all_students["student_count"].sum()
+
+    frame["difference"] = all_total - group_total  # NaN for the records that do not count
+    candidates = frame[(frame["difference"] > 0) & (frame["group_by"] != "All Students")]
+    if skip_unknown_values:
+        candidates = candidates[candidates["group_by_value"] != "Unknown"]
+    candidates = candidates.drop_duplicates(subset=list(dedupe_on), keep="first")
+    return list(zip(candidates.index.tolist(), candidates["difference"].astype("int64").tolist()))
+
+
+# MISSING GROUP_BY FILL
+# The zip code and city layers also give every school a record for each group_by of the stratification
+# catalog it has no record of: an "Unknown" carrying the "All Students" total of the school. The schools are
+# cross joined with the catalog and anti joined with the group_bys they have, instead of a set difference
+# and a scan for the "All Students" record per school.
+def missing_group_by_fill(records, group_by_keys):
+    """ Returns [(position of the first "All Students" record of the school, missing group_by,
+    "All Students" total of the school)], school by school in record order and then in catalog order """
+    if not records:
+        return []
+    frame = pd.DataFrame({
+        "district_code": [record.district_code for record in records],
+        "school_code": [record.school_code for record in records],
+        "group_by": [record.group_by for record in records],
+    })
+    frame["student_count"] = pd.to_numeric(
+        pd.Series([record.student_count for record in records], dtype=object), errors="coerce"
+    ).fillna(0)
+    # One number per (school_code, district_code) in order of appearance, a missing school_code included
+    frame["school"] = frame.groupby(["school_code", "district_code"], dropna=False, sort=False).ngroup()
+
+    catalog = pd.DataFrame({"group_by": list(group_by_keys)})
+    wanted = frame[["school"]].drop_duplicates().merge(catalog, how="cross")
+    missing = wanted.merge(frame[["school", "group_by"]].drop_duplicates(), how="left", indicator=True)
+    missing = missing[missing["_merge"] == "left_only"].drop(columns="_merge")
+    if missing.empty:
+        return []
+
+    all_students = frame[frame["group_by"] == "All Students"]
+    references = all_students.reset_index().drop_duplicates("school")[["school", "index"]]
+    # Schools without a school_code do not count towards the totals
+    totals = all_students[all_students["school_code"].notna()].groupby("school")["student_count"].sum()
+    missing = missing.merge(references, on="school", how="left")
+    if missing["index"].isna().any():
+        school = frame.loc[frame["school"] == missing.loc[missing["index"].isna(), "school"].iloc[0]].iloc[0]
+        raise ValueError(
+            f"No All Students record for school {school['school_code']} of district {school['district_code']}"
+        )
+    missing["total"] = missing["school"].map(totals).fillna(0)
+    return list(zip(
+        missing["index"].astype("int64").tolist(),
+        missing["group_by"].tolist(),
+        missing["total"].astype("int64").tolist(),
+    ))
+
+
+# LAYER RECORDS
+# The layers only read the SchoolData columns, realign the stratification, attach a zip code or a city and add
+# their "Unknown" rows in memory. They work on LayerRecord, a slotted record built from a values_list of the
+# columns, instead of SchoolData model instances, and make their Unknown rows as LayerRecords as well.
+class LayerRecord:
+    # SchoolData columns loaded for the layers, in the order of the values_list
+    FIELDS = (
+        "school_year", "agency_type", "cesa", "county", "district_code", "school_code", "grade_group",
+        "charter_ind", "district_name", "school_name", "group_by", "group_by_value", "student_count",
+        "percent_of_group", "place",
+    )
+    __slots__ = FIELDS + ("stratification", "zip_code", "zip_geoid", "city", "city_geoid")
+
+    def __init__(self, school_year=None, agency_type=None, cesa=None, county=None, district_code=None,
+                 school_code=None, grade_group=None, charter_ind=None, district_name=None, school_name=None,
+                 group_by=None, group_by_value=None, student_count=None, percent_of_group=None, place=None,
+                 stratification=None):
+        self.school_year = school_year
+        self.agency_type = agency_type
+        self.cesa = cesa
+        self.county = county
+        self.district_code = district_code
+        self.school_code = school_code
+        self.grade_group = grade_group
+        self.charter_ind = charter_ind
+        self.district_name = district_name
+        self.school_name = school_name
+        self.group_by = group_by
+        self.group_by_value = group_by_value
+        self.student_count = student_count
+        self.percent_of_group = percent_of_group
+        self.place = place
+        self.stratification = stratification
+        # Set by the zip code and city layers from the school geography crosswalk
+        self.zip_code = self.zip_geoid = self.city = self.city_geoid = None
+
+    def __copy__(self):
+        record = LayerRecord.__new__(LayerRecord)
+        for name in self.__slots__:
+            setattr(record, name, getattr(self, name))
+        return record
+
+
+# SQL AGGREGATION
+# The region and statewide layers only sum the student counts per stratification label (and period). With
+# DATA_PROCESSOR_SQL_AGGREGATION on, the sums are computed by the database with one GROUP BY joined to
+# Stratification, and only the group_by totals the Unknown fill needs are read as well, so what is
+# transferred grows with the number of output rows rather than the number of SchoolData rows.
+def sql_aggregation_enabled():
+    return getattr(settings, "DATA_PROCESSOR_SQL_AGGREGATION", False)
+
+
+def database_layer_groups(row_filter, strat_map, missing_label):
+    """ Student count per stratification label and school year of the SchoolData rows of row_filter, summed in
+    the database, followed by the Unknown rows of the same records (see unknown_fill: one Unknown per distinct
+    difference over all the rows). Returns [(label, school_year, value)] in the order of the first row of each
+    group, like the in-memory grouping. missing_label is the label of the rows without a stratification """
+    rows = SchoolData.objects.filter(row_filter)
+    groups = [
+        (
+            missing_label if group["stratification__label_name"] is None else group["stratification__label_name"],
+            group["school_year"],
+            group["value"] or 0,
+        )
+        for group in rows.values("stratification__label_name", "school_year")
+        .annotate(value=Sum("student_count"), first_id=Min("id"))
+        .order_by("first_id")
+    ]
+
+    # The Unknown fill only needs the total of every group_by, in the order of their first row
+    group_by_totals = [
+        LayerRecord(group_by=total["group_by"], student_count=total["value"])
+        for total in rows.values("group_by").annotate(value=Sum("student_count"), first_id=Min("id")).order_by("first_id")
+    ]
+    unknowns = unknown_fill(group_by_totals, dedupe_on=["difference"], skip_unknown_values=False)
+    if unknowns:
+        # The Unknown records carry the school year and, without an "Unknown" stratification of their
+        # group_by, the stratification of the last record
+        last = rows.order_by("-id").values("school_year", "stratification__label_name").first()
+        for position, difference in unknowns:
+            stratification = strat_map.get(group_by_totals[position].group_by + "Unknown")
+            if stratification:
+                label = stratification.label_name
+            else:
+                logger.warning(f"No stratification found for {group_by_totals[position].group_by}Unknown")
+                label = last["stratification__label_name"]
+                if label is None:
+                    label = missing_label
+            groups.append((label, last["school_year"], difference))
+    return groups
+
+
+def school_year_period(school_year):
+    """ 2023-24 -> 2023-2024 """
+    return f"{school_year.split('-')[0]}-20{school_year.split('-')[1]}" if "-" in school_year else school_year
+
+
+# SHARED LAYER INPUTS
+# Every layer used to query SchoolData, Stratification, CountyGEOID and SchoolAddressFile on its own.
+# LayerInputs loads each of them lazily and only once, so run_all_layers can derive all five layers
+# from one load. A layer that is run on its own gets a fresh LayerInputs and only loads what it reads.
+class LayerInputs:
+    def __init__(self, shared=False):
+        # When shared, SchoolData is loaded once for all the layers and each layer filters it in memory
+        self.shared = shared
+
+    def school_data(self, row_filter, keep):
+        """ SchoolData rows of one layer as LayerRecords. row_filter is the layer's queryset filter and keep
+        is the same test applied to an in-memory row, used when the rows come from the shared load.
+        Layers modify the records they get, so the shared rows are handed out as copies """
+        if not self.shared:
+            return self._load_records(row_filter)
+        return [copy.copy(record) for record in self._shared_school_data if keep(record)]
+
+    def _load_records(self, row_filter):
+        # Only the columns the layers read, the stratification comes from the map of the loaded stratifications
+        stratification_by_id = self.stratification_by_id
+        rows = (
+            SchoolData.objects.filter(row_filter)
+            .order_by("id")
+            .values_list(*LayerRecord.FIELDS, "stratification_id")
+        )
+        return [LayerRecord(*values, stratification_by_id.get(stratification_id)) for *values, stratification_id in rows]
+
+    @functools.cached_property
+    def _shared_school_data(self):
+        # Union of the row filters of all the layers: the region and county layer counties plus the statewide rows
+        counties = set(TRI_COUNTIES) | set(self.county_geoid_map.keys())
+        rows = self._load_records(Q(county__in=counties) | Q(district_name='[Statewide]'))
+        logger.info(f"Loaded {len(rows)} school data records shared by all the layers")
+        return rows
+
+    @functools.cached_property
+    def stratifications(self):
+        return list(Stratification.objects.all())
+
+    @functools.cached_property
+    def stratification_by_id(self):
+        return {strat.id: strat for strat in self.stratifications}
+
+    @functools.cached_property
+    def strat_map(self):
+        # group_by + group_by_value -> Stratification, used to realign the stratification of every record
+        return {f"{strat.group_by}{strat.group_by_value}": strat for strat in self.stratifications}
+
+    @functools.cached_property
+    def group_by_map(self):
+        # group_by -> Stratification, the catalog of group_by keys every school should have
+        return {f"{strat.group_by}": strat for strat in self.stratifications}
+
+    @functools.cached_property
+    def geoid_entries(self):
+        return list(CountyGEOID.objects.all())
+
+    @functools.cached_property
+    def county_geoid_map(self):
+        # "Outagamie" -> CountyGEOID entry of "Outagamie County, WI"
+        return {
+            entry.name.split(" County, WI")[0].strip(): entry
+            for entry in self.geoid_entries if entry.layer == 'County'
+        }
+
+    @functools.cached_property
+    def school_geography(self):
+        # (lea_code, school_code) -> SchoolGeography of the school: zip code, city and their GEOIDs
+        # The codes are stored without leading zeros, so they match the SchoolData codes as they are
+        return {(geo.lea_code, geo.school_code): geo for geo in SchoolGeography.objects.all()}
+
+
+class DataTransformer:
+    """ Builds the layers from the loaded data. It does not need a request: the layer methods return
+    a LayerResult and every message meant for the user is also kept in self.messages """
+
+    # Layers built by run_all_layers, in build order: layer name -> method building it
+    LAYERS = {
+        "Tri-County": "apply_tri_county_layer_transformation",
+        "County-Layer": "apply_county_layer_transformation",
+        "Metopio Statewide": "transform_Metopio_StateWideLayer",
+        "Zipcode": "transforms_Metopio_ZipCodeLayer",
+        "City-Town": "transform_Metopio_CityLayer",
+    }
+
+    def __init__(self, *, defer_writes=False):
+        # Keyword-only: the legacy DataTransformer(request) call must fail instead of deferring every write
+        self.messages = []  # (level, text) of every message of this transformer
+        # In a worker process of run_all_layers the layer rows are not written but collected here
+        self.pending_writes = [] if defer_writes else None
+
+    def _message(self, level, text):
+        self.messages.append((level, text))
+
+    def _write_layer(self, model, rows):
+        """ Replace the rows of a layer table in one transaction, or keep them for the parent process """
+        if self.pending_writes is not None:
+            self.pending_writes.append((model, rows))
+            return
+        with transaction.atomic():
+            model.objects.all().delete()  # Clear existing data
+            model.objects.bulk_create(rows)
+
+    # TransformedSchoolData also holds the place='Tri-County' rows of transform_tri_county
+    @cached_layer("Statewide V01", TransformedSchoolData, output_filter=Q(place='WI'))
     def transform_statewide(self):
         """ Transform 'Statewide' data from the SchoolData model """
         if not SchoolData.objects.exists():
-            messages.error(self.request, 'No data found in the SchoolData model. Please upload a file first.')
+            self._message(messages.ERROR, 'No data found in the SchoolData model. Please upload a file first.')
             return False  # Indicate failure
 
         # Clear existing data in the TransformedSchoolData to avoid duplicates
@@ -51,13 +479,13 @@ class DataTransformer:
             transformed_data.append(transformed_entry)
 
         TransformedSchoolData.objects.bulk_create(transformed_data)
-        messages.success(self.request, f"Statewide transformation completed successfully. {len(transformed_data)} records were transformed.")
+        self._message(messages.SUCCESS, f"Statewide transformation completed successfully. {len(transformed_data)} records were transformed.")
         return True
 
     def transform_tri_county(self):
         """ Transform 'Tri-County' data from the SchoolData model """
         if not SchoolData.objects.exists():
-            messages.error(self.request, "No data available in the database. Please upload a file before running the transformation.")
+            self._message(messages.ERROR, "No data available in the database. Please upload a file before running the transformation.")
             return False  # Indicate failure
 
         # Clear existing data in TransformedSchoolData to avoid duplicates
@@ -80,7 +508,7 @@ class DataTransformer:
             transformed_data.append(transformed_entry)
 
         TransformedSchoolData.objects.bulk_create(transformed_data)
-        messages.success(self.request, f"Tri-County transformation completed successfully. {len(transformed_data)} records were transformed.")
+        self._message(messages.SUCCESS, f"Tri-County transformation completed successfully. {len(transformed_data)} records were transformed.")
         return True
 
     def apply_transformation(self, transformation_type):
@@ -90,91 +518,148 @@ class DataTransformer:
         elif transformation_type == 'Tri-County':
             return self.apply_tri_county_layer_transformation()
         else:
-            messages.error(self.request, 'Unknown transformation type.')
-            return False
-
-    def apply_tri_county_layer_transformation(self):
+            self._message(messages.ERROR, 'Unknown transformation type.')
+            return LayerResult(transformation_type, messages=[(messages.ERROR, 'Unknown transformation type.')])
+
+    def run_all_layers(self, force=False, layers=None, jobs=1):
+        """ Build the Tri-County, County, Statewide, Zip code and City layers (or the given names of LAYERS).
+        With jobs > 1 the layers are built in that many worker processes (see _run_layers_in_processes) """
+        logger.info("Starting the build of all the layers...")
+        layers = [name for name in self.LAYERS if layers is None or name in layers]
+        started = time.perf_counter()
+        result = LayerResult("All Layers")
+        if jobs > 1 and len(layers) > 1:
+            result.results = self._run_layers_in_processes(layers, force, jobs)
+        else:
+            # One LayerInputs for all the layers: SchoolData, the stratifications, the GEOIDs and the
+            # address crosswalk are each read once. Layers whose inputs did not change skip the load entirely
+            inputs = LayerInputs(shared=True)
+            result.results = [getattr(self, self.LAYERS[layer])(inputs=inputs, force=force) for layer in layers]
+        result.success = all(result.results)
+        result.records = sum(layer_result.records for layer_result in result.results)
+        result.queries = sum(layer_result.queries for layer_result in result.results)
+        result.seconds = time.perf_counter() - started
+        for layer_result in result.results:
+            result.messages += layer_result.messages
+            result.warnings += layer_result.warnings
+        failed = [layer for layer, layer_result in zip(layers, result.results) if not layer_result]
+        if failed:
+            logger.error(f"Layers that failed to build: {', '.join(failed)}")
+            return result
+        logger.info("All the layers were built successfully.")
+        return result
+
+    # PARALLEL LAYER BUILDS
+    # The layers share their inputs but not their outputs, so they can be computed side by side on all the
+    # cores, one layer per worker process. Each worker reads its own inputs and hands the rows back instead
+    # of writing them: the parent process writes one layer at a time as the workers finish, so there is a
+    # single SQLite writer. A full refresh then takes about as long as the slowest layer.
+    def _run_layers_in_processes(self, layers, force, jobs):
+        # The workers must not inherit the open connections of this process
+        connections.close_all()
+        results = {}
+        with ProcessPoolExecutor(max_workers=min(jobs, len(layers)), initializer=_init_layer_worker) as pool:
+            futures = {pool.submit(_build_layer_in_process, layer, force): layer for layer in layers}
+            for future in as_completed(futures):
+                layer = futures[future]
+                try:
+                    layer_result = future.result()
+                except Exception as e:
+                    logger.error(f"Error building the {layer} layer in a worker process: {e}")
+                    layer_result = LayerResult(layer)
+                if layer_result.fingerprint is not None:
+                    # Built (not skipped): write its rows, none when the layer is empty, and record the build
+                    layer_result = self._write_pending_layer(layer_result)
+                self.messages += layer_result.messages
+                results[layer] = layer_result
+        return [results[layer] for layer in layers]
+
+    def _write_pending_layer(self, result):
+        """ Write the rows a worker process computed for a layer and record its build """
+        started = time.perf_counter()
+        queries = _QueryCounter()
+        try:
+            with connection.execute_wrapper(queries), transaction.atomic():
+                for model, rows in result.pending_writes:
+                    model.objects.all().delete()  # Clear existing data
+                    model.objects.bulk_create(rows)
+                LayerBuild.objects.update_or_create(
+                    layer=result.layer, defaults={"fingerprint": result.fingerprint, "records": result.records}
+                )
+        except Exception as e:
+            logger.error(f"Error writing the {result.layer} layer: {e}")
+            result.success = False
+            result.records = 0
+        result.pending_writes = []
+        result.seconds += time.perf_counter() - started
+        result.queries += queries.count
+        return result
+
+    @cached_layer("Tri-County", MetopioTriCountyLayerTransformation)
+    def apply_tri_county_layer_transformation(self, inputs=None):
         """ Apply Tri-County Layer Transformation """
         try:
             logger.info("Starting Tri-County Layer Transformation...")
+            inputs = inputs or LayerInputs()
+
+            # Summed in the database, only the Unknown fill is done here
+            if sql_aggregation_enabled():
+                grouped_data = {}
+                for strat_label, school_year, value in database_layer_groups(
+                    Q(county__in=TRI_COUNTIES) & ~Q(school_name='[Districtwide]'), inputs.strat_map, "Unknown"
+                ):
+                    grouped_data.setdefault(strat_label, {
+                        "layer": "Region",
+                        "geoid": "fox-valley",
+                        "topic": "FVDEYLCV",
+                        "period": school_year_period(school_year),
+                        "value": 0,
+                        "stratification": strat_label
+                    })["value"] += value
+                return self._write_tri_county_layer(grouped_data)
 
             # Fetch filtered school data, including 'Unknown' county and school_name
-            school_data = SchoolData.objects.filter(
-                county__in=['Outagamie', 'Winnebago', 'Calumet'],
-             ).exclude(school_name='[Districtwide]')
-            logger.info(f"Filtered school data count: {school_data.count()}")
+            school_data = inputs.school_data(
+                Q(county__in=TRI_COUNTIES) & ~Q(school_name='[Districtwide]'),
+                lambda record: record.county in TRI_COUNTIES and record.school_name != '[Districtwide]',
+            )
+            logger.info(f"Filtered school data count: {len(school_data)}")
 
             #Add the UNKOWNN VALUES TO THE MAIN DATA SET
-
-            #COnstruct a dictionary to store the group totals
-            group_totals = defaultdict(int)
-            all_students_totals = 0
-
-            #Compute totals per GROUP_BY and track "All Students" total
-
-            for record in school_data:
-                group_totals[record.group_by] += int(record.student_count)
-                if record.group_by == "All Students":
-                    all_students_totals += int(record.student_count)
-
-            
-            group_by_totals = {}
-
-
-            for record in school_data:
-                key = (record.county, record.group_by, record.group_by_value)
-                group_by_totals[key] = group_totals[record.group_by]
-
-
+            # "All Students" minus the sum of every group_by over the whole region, one Unknown per distinct difference.
+            # Besides the county and the group_by, the Unknown records carry the fields of the last record
             new_unknown_records = []
-            unique_records = set()
-
-            for (record.county, record.group_by, record.group_by_value), total in group_by_totals.items():
-                if record.group_by == "All Students":
-                    continue
-                if total < all_students_totals:
-                    difference = all_students_totals - total
-                    unique_key = ("Unknown", difference)
-
-                    if unique_key not in unique_records:
-                        unique_records.add(unique_key)
-                        new_unknown_records.append(
-                            SchoolData(
-                                  school_name=record.school_name,
-                                    county=record.county,
-                                    group_by=record.group_by,
-                                    group_by_value="Unknown",
-                                    school_year=record.school_year,
-                                    student_count=str(difference),  # Keep redacted data
-                                    stratification=record.stratification,
-                                    agency_type=record.agency_type,
-                                    cesa=record.cesa,
-                                    district_code=record.district_code,
-                                    school_code=record.school_code,
-                                    grade_group=record.grade_group,
-                                    charter_ind=record.charter_ind,
-                                    district_name=record.district_name,
-                                    percent_of_group=record.percent_of_group,
-                            ))
-                        logger.info(f"Added new unique unknown record for {unique_key}")
-                    else:
-                        logger.info(f"Duplicate unknown record for {unique_key}")
-
+            for position, difference in unknown_fill(school_data, dedupe_on=["difference"], skip_unknown_values=False):
+                key_record, record = school_data[position], school_data[-1]
+                new_unknown_records.append(
+                    LayerRecord(
+                        school_name=record.school_name,
+                        county=key_record.county,
+                        group_by=key_record.group_by,
+                        group_by_value="Unknown",
+                        school_year=record.school_year,
+                        student_count=difference,  # Keep redacted data
+                        stratification=record.stratification,
+                        agency_type=record.agency_type,
+                        cesa=record.cesa,
+                        district_code=record.district_code,
+                        school_code=record.school_code,
+                        grade_group=record.grade_group,
+                        charter_ind=record.charter_ind,
+                        district_name=record.district_name,
+                        percent_of_group=record.percent_of_group,
+                    ))
+                logger.info(f"Added new unique unknown record for {('Unknown', difference)}")
             
             for record in new_unknown_records:
                 logger.info(f"New unknown record: {record.county:<{15}} {record.group_by:<{20}} {record.group_by_value:<{35}} {record.student_count}")
 
             # Create a combined dataset in memory
-            combined_dataset = list(school_data)  # Convert QuerySet to list
+            combined_dataset = list(school_data)
 
             # Add the new unknown records to the combined dataset
             if new_unknown_records:
-                
-
-                strat_map = {
-                    f"{strat.group_by}{strat.group_by_value}": strat
-                    for strat in Stratification.objects.all()
-                }
+                strat_map = inputs.strat_map
 
 
                 for record in new_unknown_records:
@@ -196,7 +681,7 @@ class DataTransformer:
                 group_by, group_by_value = record.group_by, record.group_by_value
                 
                 # Convert student_count to integer if it is a digit, else default to 0
-                total_value = int(float(record.student_count)) if record.student_count.replace('.', '', 1).isdigit() else 0
+                total_value = record.student_count or 0
                 
                 # Group by stratification, period, group_by, and group_by_value    
                 strat_key = (strat_label)
@@ -212,26 +697,7 @@ class DataTransformer:
                     "stratification": strat_label
                 })["value"] += total_value
 
-            # Bulk Insert Transformed Data
-
-            transformed_data = [MetopioTriCountyLayerTransformation(**{
-                "layer": data["layer"],
-                "geoid": data["geoid"],
-                "topic": data["topic"],
-                "stratification": data["stratification"],
-                "period": data["period"],
-                "value": data["value"]
-            }) for data in grouped_data.values() if data["value"]!=0] # Exclude zero values during bulk insertion
-
-            if transformed_data:
-                with transaction.atomic():
-                    MetopioTriCountyLayerTransformation.objects.all().delete()
-                    MetopioTriCountyLayerTransformation.objects.bulk_create(transformed_data)
-                logger.info(f"Successfully transformed {len(transformed_data)} records.")
-            else:
-                logger.info("No transformed data to insert.")
-
-            return True
+            return self._write_tri_county_layer(grouped_data)
 
         except Exception as e:
             tb= traceback.extract_tb(e.__traceback__)
@@ -239,105 +705,82 @@ class DataTransformer:
             logger.error(f"Error during Tri-County Layer Transformation: {e} at line number {line_number}")  
             return False
 
+    def _write_tri_county_layer(self, grouped_data):
+        # Bulk Insert Transformed Data
+
+        transformed_data = [MetopioTriCountyLayerTransformation(**{
+            "layer": data["layer"],
+            "geoid": data["geoid"],
+            "topic": data["topic"],
+            "stratification": data["stratification"],
+            "period": data["period"],
+            "value": data["value"]
+        }) for data in grouped_data.values() if data["value"]!=0] # Exclude zero values during bulk insertion
+
+        # Written even when empty: the build is recorded, so stale rows of an earlier run must not be kept
+        self._write_layer(MetopioTriCountyLayerTransformation, transformed_data)
+        if transformed_data:
+            logger.info(f"Successfully transformed {len(transformed_data)} records.")
+        else:
+            logger.info("No transformed data to insert, the layer table was cleared.")
+
+        return True
+
 # Apply the county Layer Transformation 
 
-    def apply_county_layer_transformation(self):
+    @cached_layer("County-Layer", CountyLayerTransformation)
+    def apply_county_layer_transformation(self, inputs=None):
         try:
             # Reinitialize school Data
             logger.info("Starting County Layer Transformation...")
+            inputs = inputs or LayerInputs()
+            diagnostics = DiagnosticsRun("County-Layer")
 
             # Fetch County GEOID entries
-            county_geoid_entries = CountyGEOID.objects.filter(layer='County')
-            county_geoid_map = {entry.name.split(" County, WI")[0].strip(): entry for entry in county_geoid_entries}
+            county_geoid_map = inputs.county_geoid_map
 
             logger.info(f"County GEOID entries count: {len(county_geoid_map)}")
 
             # STEP 2: Fetch dataset (No need to process "Unknown" separately)
-            school_data = SchoolData.objects.filter(
-                models.Q(county__in=county_geoid_map.keys())
-            ).exclude(school_name="[Districtwide]")
-            logger.info(f"Refetched school data count: {school_data.count()}")
+            school_data = inputs.school_data(
+                Q(county__in=county_geoid_map.keys()) & ~Q(school_name="[Districtwide]"),
+                lambda record: record.county in county_geoid_map and record.school_name != "[Districtwide]",
+            )
+            logger.info(f"Refetched school data count: {len(school_data)}")
             
             #HANDLE UNKOWN
-            combined_dataset = list(school_data)  # Convert QuerySet to list
-            group_totals =defaultdict(int)
-            all_students_totals = defaultdict(int)
-            
-            #Compute totals per GROUP_BY and track "All Students" total
-            # You have to nest it down to county level
-            
-            for record in combined_dataset:               
-                key = (record.county, record.group_by)   # using just the county and the group BY
-                group_totals[key] += int(record.student_count)
-                if record.group_by == "All Students":
-                    all_students_totals[record.county] += int(record.student_count)
-            
-            group_by_totals = {}
-            
-            # We are assigning this new group_totals dictionary to hold the objects of the remaining columsn
-            for record in combined_dataset:
-                key=(record.county,record.group_by,record.group_by_value,record.stratification)
-                group_by_totals[key] = group_totals[(record.county, record.group_by)]   
-            #logger.info(f"The Group_By_Totals length : {len(group_by_totals)}")
-            #logger.info(f"The Group_Totals length : {len(group_totals)}")
-            #logger.info(f"**********************Group by totals: {group_by_totals} ====== and **********************Group totals: {group_totals}")
-            
-            new_unknown_records = []
-            unique_records =set()
-            
-            for key, total in group_by_totals.items():
-                county, group_by, group_by_value, stratification = key
-                if group_by == "All Students":
-                    continue
-                if total < all_students_totals[(county)]:
-                    difference = all_students_totals[(county)] - total
-                #    logger.info(f"Difference {difference} for {record.county} {record.group_by} {record.group_by_value}= {all_students_totals} - {total}")
-                   
-                    unique_key = (county, group_by, "Unknown")
+            combined_dataset = list(school_data)
 
+            # "All Students" minus the sum of every group_by per county, one Unknown per county and group_by.
+            # It takes the stratification of its first record and the other fields of the last record
+            new_unknown_records = []
+            for position, difference in unknown_fill(combined_dataset, grain=["county"], dedupe_on=["county", "group_by"]):
+                key_record, record = combined_dataset[position], combined_dataset[-1]
+                new_unknown_records.append(
+                        LayerRecord(
+                            school_name=record.school_name,
+                            county=key_record.county,
+                            group_by=key_record.group_by,
+                            group_by_value="Unknown",
+                            school_year=record.school_year,
+                            student_count=difference,  # Keep redacted data
+                            stratification=key_record.stratification,
+                            agency_type=record.agency_type,
+                            cesa=record.cesa,
+                            district_code=record.district_code,
+                            school_code=record.school_code,
+                            grade_group=record.grade_group,
+                            charter_ind=record.charter_ind,
+                            district_name=record.district_name,
+                            percent_of_group=record.percent_of_group,
+                        ))
+                logger.info(f"Added new unique unknown record for {(key_record.county, key_record.group_by, 'Unknown')}")
 
-                    if key[2]=="Unknown":
-                        group_by_totals[key] += difference
-                        continue
-                    
-                   
-                #    #Only append if this combination hasnt been seen before
-                    if unique_key not in unique_records:
-                        unique_records.add(unique_key)
-                    #    #Create new "Unknown" record
-                        new_unknown_records.append(
-                                SchoolData(
-                                    school_name=record.school_name,
-                                    county=county,
-                                    group_by=group_by,
-                                    group_by_value="Unknown",
-                                    school_year=record.school_year,
-                                    student_count=str(difference),  # Keep redacted data
-                                    stratification=stratification,
-                                    agency_type=record.agency_type,
-                                    cesa=record.cesa,
-                                    district_code=record.district_code,
-                                    school_code=record.school_code,
-                                    grade_group=record.grade_group,
-                                    charter_ind=record.charter_ind,
-                                    district_name=record.district_name,
-                                    percent_of_group=record.percent_of_group,
-                                ))
-                        
-                        
-                        logger.info(f"Added new unique unknown record for {unique_key}")
-                    else:
-                        logger.info(f"Duplicate unknown record for {unique_key}")
-                        #logger.info(f"New unknown records count: {len(new_unknown_records)}")
-            
             #create a combined data set in memory
             combined_dataset.extend(new_unknown_records)  # Convert QuerySet to list
 
             #REALIGN ALL THE STRATIFICATION
-            strat_map = {
-                f"{strat.group_by}{strat.group_by_value}": strat
-                for strat in Stratification.objects.all()
-            }
+            strat_map = inputs.strat_map
 
             for record in combined_dataset:
                 combined_key = record.group_by + record.group_by_value
@@ -347,25 +790,26 @@ class DataTransformer:
                 else:
                     logger.warning(f"No stratification found for {combined_key}")
 
-            #Create the exel file for the data how it looks before the grouping
-            log_data =[]
-            for record in combined_dataset:
-                cleaned_group_by = record.group_by.replace(" ", "_")
-                cleaned_group_by_value = record.group_by_value.replace(" ", "_")
-                cleaned_county = record.county.replace(" ", "_")
-                log_data.append({
-                    "school_name": record.school_name,
-                    "county": cleaned_county,
-                    "group_by": cleaned_group_by,
-                    "group_by_value": cleaned_group_by_value,
-                    "Stratification": record.stratification.label_name,
-                    "student_count": record.student_count,
-                    
+            # Debug spreadsheet of the data before the grouping, only when diagnostics are on
+            if diagnostics.enabled:
+                #Create the exel file for the data how it looks before the grouping
+                log_data =[]
+                for record in combined_dataset:
+                    cleaned_group_by = record.group_by.replace(" ", "_")
+                    cleaned_group_by_value = record.group_by_value.replace(" ", "_")
+                    cleaned_county = record.county.replace(" ", "_")
+                    log_data.append({
+                        "school_name": record.school_name,
+                        "county": cleaned_county,
+                        "group_by": cleaned_group_by,
+                        "group_by_value": cleaned_group_by_value,
+                        "Stratification": record.stratification.label_name if record.stratification else "Unknown",
+                        "student_count": record.student_count,
 
-                })
 
-            df = pd.DataFrame(log_data)
-            df.to_excel("before_grouping_county.xlsx", index=False)
+                    })
+
+                diagnostics.write_excel("before_grouping_county.xlsx", log_data)
             
             # STEP 3: Group Data
             grouped_data = {}
@@ -388,10 +832,10 @@ class DataTransformer:
                         "topic": "FVDEYLCV",
                         "stratification": strat_label,
                         "period": period,
-                        "value": int(record.student_count) if record.student_count.isdigit() else 0,
+                        "value": record.student_count or 0,
                     }
                 else:
-                    grouped_data[strat_key]["value"] += int(record.student_count) if record.student_count.isdigit() else 0
+                    grouped_data[strat_key]["value"] += record.student_count or 0
             # STEP 4: Bulk Insert Transformed Data
             transformed_data = [
                 CountyLayerTransformation(
@@ -405,13 +849,12 @@ class DataTransformer:
             ]
 
             # Insert transformed data
+            # Written even when empty: the build is recorded, so stale rows of an earlier run must not be kept
+            self._write_layer(CountyLayerTransformation, transformed_data)
             if transformed_data:
-                with transaction.atomic():
-                    CountyLayerTransformation.objects.all().delete()  # Consider using bulk_update
-                    CountyLayerTransformation.objects.bulk_create(transformed_data)
                 logger.info(f"Successfully transformed {len(transformed_data)} records.")
             else:
-                logger.info("No transformed data to insert.")
+                logger.info("No transformed data to insert, the layer table was cleared.")
 
             return True
 
@@ -422,91 +865,81 @@ class DataTransformer:
             return False
 
 
-    def transform_Metopio_StateWideLayer(self):
+    @cached_layer("Metopio Statewide", MetopioStateWideLayerTransformation)
+    def transform_Metopio_StateWideLayer(self, inputs=None):
         """Apply StateWide Layer Transformation"""
         if not SchoolData.objects.exists():
-            messages.error(self.request, 'No data found in the SchoolData model. Please upload a file first.')
+            self._message(messages.ERROR, 'No data found in the SchoolData model. Please upload a file first.')
             return False
         try:
             logger.info("Starting Metopio StateWide Layer Transformation...")
-            # Clear the existing data in the MetopioStateWideLayerTransformation to avoid duplicates
-            MetopioStateWideLayerTransformation.objects.all().delete()
+            inputs = inputs or LayerInputs()
             
             #Define filters for DISTRICT_NAME =[Statewide]
             district_name_filter = '[Statewide]'
+
+            # Summed in the database, only the Unknown fill is done here
+            if sql_aggregation_enabled():
+                grouped_data = {}
+                for stratification, school_year, value in database_layer_groups(
+                    Q(district_name=district_name_filter), inputs.strat_map, "Error"
+                ):
+                    period = school_year_period(school_year)
+                    grouped_data.setdefault((stratification, period), {
+                        "layer": "State",
+                        "geoid": "WI",
+                        "topic": "FVDEYLCV",
+                        "stratification": stratification,
+                        "period": period,
+                        "value": 0,
+                    })["value"] += value
+                return self._write_statewide_layer(grouped_data)
             
             #Fetch filtered school data
             
-            school_data = SchoolData.objects.filter(district_name=district_name_filter)
-            logger.info(f"Filtered school data count: {school_data.count()}")
+            school_data = inputs.school_data(
+                Q(district_name=district_name_filter),
+                lambda record: record.district_name == district_name_filter,
+            )
+            logger.info(f"Filtered school data count: {len(school_data)}")
             
 
             #Handle unknown values
-            # Construct a dictionary to store the group totals
-            group_totals = defaultdict(int)
-            all_students_totals = 0
-
-            # Compute totals per GROUP_BY and track "All Students" total
-
-            for record in school_data:
-                group_totals[record.group_by] += int(record.student_count)
-                if record.group_by == "All Students":
-                    all_students_totals += int(record.student_count)
-
-            group_by_totals = {}
-
-            for record in school_data:
-                key = (record.group_by, record.group_by_value)
-                group_by_totals[key] = group_totals[record.group_by]
-
-
+            # "All Students" minus the sum of every group_by statewide, one Unknown per distinct difference.
+            # Besides the group_by, the Unknown records carry the fields of the last record
             new_unknown_records = []
-            unique_records = set()
-            #logger.info(f"Group by totals: {group_by_totals}")
-            for (record.group_by, record.group_by_value), total in group_by_totals.items():
-                if record.group_by == "All Students":
-                    continue
-                if total < all_students_totals:
-                    difference = all_students_totals - total
-                    unique_key = ("Unknown", difference)
-
-                    if unique_key not in unique_records:
-                        unique_records.add(unique_key)
-                        new_unknown_records.append(
-                            SchoolData(
-                                school_name=record.school_name,
-                                county=record.county,
-                                group_by=record.group_by,
-                                group_by_value="Unknown",
-                                school_year=record.school_year,
-                                student_count=str(difference),  # Keep redacted data
-                                stratification=record.stratification,
-                                agency_type=record.agency_type,
-                                cesa=record.cesa,
-                                district_code=record.district_code,
-                                school_code=record.school_code,
-                                grade_group=record.grade_group,
-                                charter_ind=record.charter_ind,
-                                district_name=record.district_name,
-                                percent_of_group=record.percent_of_group,
-                            ))
-                        logger.info(f"Added new unique unknown record for {unique_key}")
-                    else:
-                        logger.info(f"Duplicate unknown record for {unique_key}")
+            for position, difference in unknown_fill(school_data, dedupe_on=["difference"], skip_unknown_values=False):
+                key_record, record = school_data[position], school_data[-1]
+                new_unknown_records.append(
+                    LayerRecord(
+                        school_name=record.school_name,
+                        county=record.county,
+                        group_by=key_record.group_by,
+                        group_by_value="Unknown",
+                        school_year=record.school_year,
+                        student_count=difference,  # Keep redacted data
+                        stratification=record.stratification,
+                        agency_type=record.agency_type,
+                        cesa=record.cesa,
+                        district_code=record.district_code,
+                        school_code=record.school_code,
+                        grade_group=record.grade_group,
+                        charter_ind=record.charter_ind,
+                        district_name=record.district_name,
+                        percent_of_group=record.percent_of_group,
+                    ))
+                logger.info(f"Added new unique unknown record for {('Unknown', difference)}")
 
             for record in new_unknown_records:
                 logger.info(f"New unknown record: {record.group_by:<{20}} {record.group_by_value:<{35}} {record.student_count}")
 
             # Create a combined dataset in memory
-            combined_dataset = list(school_data)  # Convert QuerySet to list
+            combined_dataset = list(school_data)
 
             # Add the new unknown records to the combined dataset
             if new_unknown_records:
                 # Look up stratification for each new unknown record
-                strat_map = {
-                    f"{strat.group_by}{strat.group_by_value}": strat
-                    for strat in Stratification.objects.all()
-                }
+                strat_map = inputs.strat_map
 
                 for record in new_unknown_records:
                     combined_key = record.group_by + record.group_by_value
@@ -546,34 +979,35 @@ class DataTransformer:
                         "topic": "FVDEYLCV",
                         "stratification": stratification,
                         "period": period,
-                        "value": int(record.student_count) if record.student_count.isdigit() else 0,
+                        "value": record.student_count or 0,
                     }
                 else:
-                    grouped_data[strat_key]["value"] += int(record.student_count) if record.student_count.isdigit() else 0
+                    grouped_data[strat_key]["value"] += record.student_count or 0
                     
-            # Prepare transformed data for bulk insertion
-            transformed_data = [
-                MetopioStateWideLayerTransformation(
-                    layer=data["layer"],
-                    geoid=data["geoid"],
-                    topic=data["topic"],
-                    stratification=data["stratification"],
-                    period=data["period"],
-                    value=data["value"],
-                )
-                for data in grouped_data.values()
-            ]
-            
-            # Insert transformed data in bulk
-            with transaction.atomic():
-                MetopioStateWideLayerTransformation.objects.all().delete()  # Clear existing data
-                MetopioStateWideLayerTransformation.objects.bulk_create(transformed_data)
-            logger.info(f"Successfully transformed {len(transformed_data)} records.")
-            return True
+            return self._write_statewide_layer(grouped_data)
         
         except Exception as e:
             logger.error(f"Error during Metopio StateWide Layer Transformation: {e}")
             return False
+
+    def _write_statewide_layer(self, grouped_data):
+        # Prepare transformed data for bulk insertion
+        transformed_data = [
+            MetopioStateWideLayerTransformation(
+                layer=data["layer"],
+                geoid=data["geoid"],
+                topic=data["topic"],
+                stratification=data["stratification"],
+                period=data["period"],
+                value=data["value"],
+            )
+            for data in grouped_data.values()
+        ]
+        
+        # Insert transformed data in bulk
+        self._write_layer(MetopioStateWideLayerTransformation, transformed_data)
+        logger.info(f"Successfully transformed {len(transformed_data)} records.")
+        return True
             
 
 #Just need to extract the zip code but still I am using the generic splitter
@@ -1124,199 +1558,121 @@ class DataTransformer:
     #         logger.error(f"Traceback: {traceback.format_exc()}")
     #         return False
     
-    def transforms_Metopio_ZipCodeLayer(self):
-        try:
-            logger.info("Starting Metopio ZipCode Layer Transformation...")
-
-            # Fetch and filter County GEOID entries
-            county_geoid_entries = CountyGEOID.objects.filter(layer="Zip code")
-            logger.info(f"Filtered County GEOID entries count: {county_geoid_entries.count()}")
-
-            # Create a map to store the Zip Code and its corresponding GEOID from the CountyGEOID entries
-            zip_code_geoid_map = {entry.name: entry.geoid for entry in county_geoid_entries}
-            #logger.info(f"Zip Code GEOID map: {zip_code_geoid_map}")
-
-            # Fetch and join SchoolData with SchoolAddressFile dynamically
-            school_data = (
-                SchoolData.objects.filter(
-                    # Exclude records with school names in square brackets                   
-                    ~Q(school_name__startswith='['),
-                    county__in=['Outagamie', 'Winnebago', 'Calumet']
-                        # Filter for specified counties
-                )
-                # .prefetch_related('address_details')  # Fetch related address details in a single query
-                 .distinct()  # Ensure unique records
-            )
-            
-            # Check for null school_code values and log them
-            null_school_code_count = school_data.filter(school_code__isnull=True).count()
-            logger.info(f"Number of records with null school_code: {null_school_code_count}")
-            logger.info(f"Filtered school data count: {school_data.count()}")
-
-            # HANDLE UNKNOWNS
-            combined_dataset = list(school_data) # Convert QuerySet to list
-            group_totals = defaultdict(int)
-            all_students_totals = defaultdict(int)
-            
-            #NORMALIZING AFTER FETCHING THE DATA
-            for record in combined_dataset:
-                record.school_code=record.school_code.lstrip("0")
-                record.district_code=record.district_code.lstrip("0")
-
-            logger.info(f"#1 Normalized the school_code and district_code for {len(combined_dataset)} records")  ##3408
-            
-
-            # Compute totals per GROUP_BY and track "All Students" per zip code total
-            # We have to do this groupBy total for each school code which is not null
-
-            for record in combined_dataset:
-                if record.school_code is None:
-                    continue
-                key =(record.district_code,record.school_code, record.group_by)
-                group_totals[key] += int(record.student_count)
-                if record.group_by == "All Students":
-                    all_students_totals[record.district_code,record.school_code] += int(record.student_count)
-
-
-        
-
-            group_by_totals = {}
-
-            # We are assigning this new group_totals dictionary to group_by_totals dictionary  to 
-            # hold the objects of the remaining columns which we will need to refer when we are building the 
-            # transformed data . Essentially the group_by_totals is a more complex dictionary that uses a combination of the fields
-            # as the key to store the corresponding totals from the group totals
-            # Purpose of this dictionary is to store the totals of the group_by  for each unique combination of county , district_code, school_code, group_by, group_by_value
-            #Structure of this dictionary :  A dictionary with a tuple of (county, district_code, school_code, group_by, group_by_value, zip_code) as the key and the total of the group_by as the value
-            for record in combined_dataset:
-                key = (record.county, record.district_code, record.school_code, record.group_by, record.group_by_value,record.stratification, record.student_count)
-                group_by_totals[key] = group_totals[(record.district_code,record.school_code,record.group_by)]
-
-        
-            new_unknown_records = []
-            unique_records = set()
-            
-            # Create a combined dataset in memory
-             # Convert QuerySet to list
-            
-            # After we have built that dictionary then we are now trying to add the unknown entries in the data
-            # And we would be adding this entry by creating memory objects rather than directly adding to the database
-            # This is because we need to refer to the address details of the original record when we are building the transformed data
-            
-            for key, total in group_by_totals.items():
-                county, district_code, school_code, group_by, group_by_value,stratification,student_count = key
-
-                if total < all_students_totals[(district_code,school_code)]:   #Changed ::Added student_count == 0 in 2/23
-                    difference = all_students_totals[(district_code,school_code)] - total
-                    
-                    unique_key = (county, district_code, school_code, group_by, "Unknown")
-                    
-                    #If there is already an unknown record for this combination, update the student count
-                    if group_by_value == "Unknown":
-                            group_by_totals[key] += difference
-                            logger.info(f"Updated existing unknown record for {county}, {district_code}, {school_code}, {group_by} with difference {difference}")
-                            continue     
-                                       
-                    # Only append if this combination hasn't been seen before
-                    if unique_key not in unique_records:
-                        unique_records.add(unique_key)
-                        # Create new "Unknown" record
-                        record = next((r for r in combined_dataset if r.district_code == district_code and r.school_code == school_code and r.group_by == group_by), None)
-                        if record:
-                            # Create new "Unknown" record
-                            new_record = SchoolData(
-                                school_year=record.school_year,
-                                agency_type=record.agency_type or "Unknown",
-                                cesa=record.cesa,
-                                county=county,
-                                district_code=str(district_code).lstrip("0"),
-                                school_code=str(school_code).lstrip("0"),
-                                grade_group=record.grade_group or "Unknown",
-                                charter_ind=record.charter_ind or "Unknown",
-                                district_name=record.district_name or "Unknown",
-                                school_name=record.school_name or "Unknown",
-                                group_by=group_by,
-                                group_by_value="Unknown",
-                                student_count=str(difference),  
-                                percent_of_group=record.percent_of_group or "0",
-                                place=record.place or "",
-                                stratification=stratification,
-                                
-                            )
-                                # Copy address details from the original record
-                            new_unknown_records.append(new_record)
-                        else:
-                            logger.error(f"Record not found for {district_code}, {school_code}, {group_by}")
-                    else:
-                        logger.info(f"Duplicate unknown record for {unique_key}")     
-            logger.info(f"****New unknown records count: {len(new_unknown_records)}")
-
-            combined_dataset.extend(new_unknown_records)
-            logger.info(f"#3 Normalized the school_code and district_code for {len(combined_dataset)} records")  ##3560
-            
-            #Now in this combined data set list we need to loop through the group_by_map list and 
-            # check if the combined data set has a missing group_by record for every school code
-            # If it does not have a record then we need to add a new record with the group_by as 
-            # the one that is missing from the key of the map below which why is we are making the group_by_map a dictionary
-            group_by_map={
-                f"{strat.group_by}": strat
-                for strat in Stratification.objects.all()
-            }
-            logger.info(f"Stratification Mapping: {group_by_map}")
-
-            #loop through the combined data set and check for each school code if that record
-            #has missing group_by records and if it does then we need to add a new record for that group_by
-
-            #Create a dictionary to group records by school code and district code 
-            school_code_groups =defaultdict(list)
-            for record in combined_dataset:
-                school_code_groups[record.school_code,record.district_code].append(record)   ##Change Added the district code 
-      
-
-            #Loop through the grouped records and check for the missing group_by keys
-            for (school_code,district_code), records in school_code_groups.items():
-                existing_group_by_keys ={record.group_by for record in records}
-                missing_group_by_keys = set(group_by_map.keys()) - existing_group_by_keys
-
-                for missing_group_by_key in missing_group_by_keys:
-                    reference_record = next((r for r in records if r.group_by == "All Students"), None)
-                    # Create a new record for the missing group_by key
-                    new_record = SchoolData(
-                        school_year=reference_record.school_year,
-                        agency_type=reference_record.agency_type or "Unknown",
-                        cesa=reference_record.cesa,
-                        county=reference_record.county,
-                        district_code=reference_record.district_code,
-                        school_code=reference_record.school_code,
-                        grade_group=reference_record.grade_group or "Unknown",
-                        charter_ind=reference_record.charter_ind or "Unknown",
-                        district_name=reference_record.district_name or "Unknown",
-                        school_name=reference_record.school_name or "Unknown",
-                        group_by=missing_group_by_key,
-                        group_by_value="Unknown",
-                        student_count=str(all_students_totals[reference_record.district_code, reference_record.school_code]),
-                        percent_of_group=reference_record.percent_of_group or "0",
-                        place=reference_record.place or "",
-                        stratification=reference_record.stratification,
-                    )
-                    combined_dataset.append(new_record)
-                    logger.info(f"""Added new record for missing group_by: {missing_group_by_key} 
-                    #             for count {all_students_totals[(records[0].district_code,records[0].school_code)]}
-                    #             for school code: {school_code}
-                    #             for school name: {records[0].school_name}""")    
-
-            
-            
-            
-            
-            
-            logger.info(f"#3 Normalized the school_code and district_code for {len(combined_dataset)} records")   ##3422
-
+    # ZIP CODE AND CITY LAYERS
+    # Both layers take the records of the tri-county schools, add the same Unknown records, attach the
+    # geography of every school from the SchoolGeography crosswalk and sum the counts per stratification
+    # and GEOID of that geography. They only differ in the geography, described in SCHOOL_GEOGRAPHIES:
+    # the crosswalk fields of its name and GEOID, the "layer" of the output rows, the suffix of the
+    # diagnostics spreadsheets and whether records without a GEOID are logged.
+    SCHOOL_GEOGRAPHIES = {
+        "zip_code": {"geoid": "zip_geoid", "layer": "Zip code", "diagnostics_suffix": "", "log_missing_geoid": False},
+        "city": {"geoid": "city_geoid", "layer": "City or town", "diagnostics_suffix": "_city", "log_missing_geoid": True},
+    }
+
+    def _school_geography_layer(self, inputs, diagnostics, geography):
+        """ Records of the tri-county schools with their Unknowns, grouped per stratification and GEOID of the
+        school's geography ("zip_code" or "city"). Returns the records and the grouped rows """
+        geography_fields = self.SCHOOL_GEOGRAPHIES[geography]
+
+        # Zip code, city and their GEOIDs of every school, from the SchoolGeography crosswalk
+        school_geography = inputs.school_geography
+        logger.info(f"School geography entries count: {len(school_geography)}")
+
+        # Fetch SchoolData for the specified counties, excluding records with school names in square brackets
+        school_data = inputs.school_data(
+            Q(county__in=TRI_COUNTIES) & ~Q(school_name__startswith='['),
+            lambda record: record.county in TRI_COUNTIES and not record.school_name.startswith('['),
+        )
 
+        # Check for null school_code values and log them
+        null_school_code_count = sum(1 for record in school_data if record.school_code is None)
+        logger.info(f"Number of records with null school_code: {null_school_code_count}")
+        logger.info(f"Filtered school data count: {len(school_data)}")
+
+        # HANDLE UNKNOWNS
+        combined_dataset = list(school_data)
+
+        # Index the first record of every (district_code, school_code, group_by) once, so finding the
+        # reference record of a new "Unknown" is a dictionary lookup instead of a scan of the whole dataset
+        reference_records = {}
+        for record in combined_dataset:
+            reference_records.setdefault((record.district_code, record.school_code, record.group_by), record)
+
+        # "All Students" minus the sum of every group_by per school (records without a school_code are left out),
+        # one Unknown per school and group_by. It takes the county and the stratification of its first record
+        # and the other fields of the first record of its school and group_by
+        new_unknown_records = []
+        for position, difference in unknown_fill(
+            combined_dataset,
+            grain=["district_code", "school_code"],
+            dedupe_on=["county", "district_code", "school_code", "group_by"],
+        ):
+            key_record = combined_dataset[position]
+            record = reference_records[(key_record.district_code, key_record.school_code, key_record.group_by)]
+            # Create new "Unknown" record
+            new_unknown_records.append(
+                LayerRecord(
+                    school_year=record.school_year,
+                    agency_type=record.agency_type or "Unknown",
+                    cesa=record.cesa,
+                    county=key_record.county,
+                    district_code=key_record.district_code,
+                    school_code=key_record.school_code,
+                    grade_group=record.grade_group or "Unknown",
+                    charter_ind=record.charter_ind or "Unknown",
+                    district_name=record.district_name or "Unknown",
+                    school_name=record.school_name or "Unknown",
+                    group_by=key_record.group_by,
+                    group_by_value="Unknown",
+                    student_count=difference,
+                    percent_of_group=record.percent_of_group or "0",
+                    place=record.place or "",
+                    stratification=key_record.stratification,
+                ))
+        logger.info(f"****New unknown records count: {len(new_unknown_records)}")
+
+        combined_dataset.extend(new_unknown_records)
+
+        #Now in this combined data set list we need to loop through the group_by_map list and 
+        # check if the combined data set has a missing group_by record for every school code
+        # If it does not have a record then we need to add a new record with the group_by as 
+        # the one that is missing from the key of the map below which why is we are making the group_by_map a dictionary
+        group_by_map = inputs.group_by_map
+        logger.info(f"Stratification Mapping: {group_by_map}")
+
+        # Every school gets an "Unknown" record with its "All Students" total for each group_by of the
+        # catalog it has no record of, built from its first "All Students" record
+        missing_group_by_records = []
+        for position, missing_group_by_key, all_students_total in missing_group_by_fill(combined_dataset, group_by_map.keys()):
+            reference_record = combined_dataset[position]
+            # Create a new record for the missing group_by key
+            missing_group_by_records.append(LayerRecord(
+                school_year=reference_record.school_year,
+                agency_type=reference_record.agency_type or "Unknown",
+                cesa=reference_record.cesa,
+                county=reference_record.county,
+                district_code=reference_record.district_code,
+                school_code=reference_record.school_code,
+                grade_group=reference_record.grade_group or "Unknown",
+                charter_ind=reference_record.charter_ind or "Unknown",
+                district_name=reference_record.district_name or "Unknown",
+                school_name=reference_record.school_name or "Unknown",
+                group_by=missing_group_by_key,
+                group_by_value="Unknown",
+                student_count=all_students_total,
+                percent_of_group=reference_record.percent_of_group or "0",
+                place=reference_record.place or "",
+                stratification=reference_record.stratification,
+            ))
+        combined_dataset.extend(missing_group_by_records)
+        logger.info(f"Added {len(missing_group_by_records)} new records for the missing group_by keys")
+
+        # Debug spreadsheet of the records grouped by school, only when diagnostics are on
+        if diagnostics.enabled:
             # Create a dictionary to group records by school code
             school_code_groups_xlx_log = defaultdict(list)
             for record in combined_dataset:
-                school_code_groups_xlx_log[record.school_code, district_code].append(record)
+                school_code_groups_xlx_log[record.school_code, record.district_code].append(record)
 
             # Prepare data for export
             export_data = []
@@ -1342,186 +1698,141 @@ class DataTransformer:
                         "stratification": record.stratification.label_name if record.stratification else "Unknown",
                     })
 
-            # Create a DataFrame from the export data
-            df = pd.DataFrame(export_data)
-
-            # Export the DataFrame to an Excel file
-            df.to_excel("school_code_groups.xlsx", index=False)
-            logger.info("School code groups exported to school_code_groups.xlsx")
-
-            
-
+            diagnostics.write_excel(f"school_code_groups{geography_fields['diagnostics_suffix']}.xlsx", export_data)
 
-            #REALIGNING STRATIFICATIONS SINCE WE RE ADDED THE UNKNOWNS
-            strat_map = {
-                f"{strat.group_by}{strat.group_by_value}": strat
-                for strat in Stratification.objects.all()
-            }
-           
-            for record in combined_dataset:
-                combined_key = record.group_by + record.group_by_value
-                record.stratification = strat_map.get(combined_key)   #assigning the stratification for the data
-            #logger.info(f"Stratification for {combined_key} is {record.stratification.label_name}")
-
-            logger.info(f"#4 Combined dataset count After Stratification: {len(combined_dataset)}")
-
-           
-            #REALIGNING THE ZIP CODE
-            #Assign a Zip code to each record in the combined dataset
-            # Create a map to store the Zip Code for each (lea_code, school_code) tuple
-            # REALIGNING THE ZIP CODE
-            # Create a map to store the Zip Code for each (lea_code, school_code) tuple
-            zip_Code_Map = {
-                (d.lea_code.lstrip("0"), d.school_code.lstrip("0")): d.zip_code
-                for d in SchoolAddressFile.objects.all()
-            }
-            #logger.info(f"Zip Code Mapping: {zip_Code_Map}")
-            
-            # Convert zip_Code_Map to a list of dictionaries
-            zip_code_map_list = [
-                {"lea_code": key[0], "school_code": key[1], "zip_code": value}
-                for key, value in zip_Code_Map.items()
-            ]
+        #REALIGNING STRATIFICATIONS SINCE WE RE ADDED THE UNKNOWNS
+        strat_map = inputs.strat_map
+        for record in combined_dataset:
+            combined_key = record.group_by + record.group_by_value
+            record.stratification = strat_map.get(combined_key)   #assigning the stratification for the data
 
-            # Create a DataFrame from the list of dictionaries
-            zip_code_df = pd.DataFrame(zip_code_map_list)
+        logger.info(f"Combined dataset count after stratification: {len(combined_dataset)}")
 
-            # Export the DataFrame to an Excel file
-            zip_code_df.to_excel("zip_code_map.xlsx", index=False)
-            logger.info("Zip Code Map exported to zip_code_map.xlsx")
-                
-            
-            
-            # Assign a Zip code to each record in the combined dataset to view the records
-            # This is where the zip code gets added and will be used for the final layering logic
-            for record in combined_dataset:
-                record.district_code = str(record.district_code).strip().lstrip("0")
-                record.school_code = str(record.school_code).strip().lstrip("0")
+        #REALIGNING THE GEOGRAPHY
+        # Assign the zip code or city of each record and its GEOID, from the school geography crosswalk
+        # This is where the geography gets added and will be used for the final layering logic
+        geoid_field = geography_fields["geoid"]
+        for record in combined_dataset:
+            school = school_geography.get((record.district_code, record.school_code))
+            setattr(record, geography, getattr(school, geography) if school else "Not Found")
+            setattr(record, geoid_field, getattr(school, geoid_field) if school else None)
 
-                combined_key = (record.district_code, record.school_code)
-                zip_code = zip_Code_Map.get(combined_key, "Not Found")
-                record.zip_code = zip_code
-            
-            
-            #Sorting the COmbined data set to view how this look Just to Generate how the data looks until now
-            combined_dataset.sort(key=lambda x: (x.district_code, x.school_code, x.group_by,x.school_name))
-            
-            #THis is just for logging and debugging
-            # for record in combined_dataset:
-            #     logger.info(f"Record: {record.district_code:<{15}} {record.school_code:<{15}} {record.school_name:<{40}} {record.zip_code:<{15}} ")
+        #Sorting the COmbined data set to view how this look Just to Generate how the data looks until now
+        combined_dataset.sort(key=lambda x: (x.district_code, x.school_code, x.group_by,x.school_name))
 
+        # Debug spreadsheet of the records before the grouping, only when diagnostics are on
+        if diagnostics.enabled:
             # Collect log data into a list
             log_data = []
             for record in combined_dataset:
-                cleaned_district_code = record.district_code
-                cleaned_school_code = record.school_code
-
                 log_data.append({
-                    "district_code": cleaned_district_code,
-                    "school_code": cleaned_school_code,
+                    "district_code": record.district_code,
+                    "school_code": record.school_code,
                     "school_name": record.school_name,
                     "group_by": record.group_by,
                     "group_by_value": record.group_by_value,
-                    "Stratification": record.stratification.label_name,
-                    "student_count": int(record.student_count),
-                    "zip_code": record.zip_code
+                    "Stratification": record.stratification.label_name if record.stratification else "Unknown",
+                    "student_count": record.student_count,
+                    geography: getattr(record, geography),
                 })
+            diagnostics.write_excel(f"log_data{geography_fields['diagnostics_suffix']}.xlsx", log_data)
+
+        # Process records for transformation
+        grouped_data = {}
+        for record in combined_dataset:
+            period = f"{record.school_year.split('-')[0]}-20{record.school_year.split('-')[1]}" if "-" in record.school_year else record.school_year
+            strat_label = record.stratification.label_name if record.stratification else "Error"
+
+            # GEOID of the zip code or city, looked up when the crosswalk was built
+            geoid = getattr(record, geoid_field)
+            if geoid is None:
+                if geography_fields["log_missing_geoid"]:
+                    logger.warning(f"GEOID not found for {geography.replace('_', ' ')}: {getattr(record, geography)}")
+                continue
+
+            # Group by stratification and period
+            strat_key = (strat_label, geoid)
+
+            if strat_key not in grouped_data:
+                grouped_data[strat_key] = {
+                    "layer": geography_fields["layer"],
+                    "geoid": geoid,
+                    "topic": "FVDEYLCV",
+                    "stratification": strat_label,
+                    "period": period,
+                    "value": record.student_count or 0,
+                }
+            else:
+                grouped_data[strat_key]["value"] += record.student_count or 0
 
-                # logger.info(
-                #     f"Record: {cleaned_district_code:<{15}} {cleaned_school_code:<{15}} {record.school_name:<{40}} {record.zip_code:<{15}}"
-                # )
-                        # Create a DataFrame from the log data
-            df = pd.DataFrame(log_data)
+        return combined_dataset, grouped_data
 
-            # Export the DataFrame to an Excel file
-            df.to_excel("log_data.xlsx", index=False)
-            logger.info("Log data exported to log_data.xlsx")
+    @cached_layer("Zipcode", ZipCodeLayerTransformation)
+    def transforms_Metopio_ZipCodeLayer(self, inputs=None):
+        try:
+            logger.info("Starting Metopio ZipCode Layer Transformation...")
+            inputs = inputs or LayerInputs()
+            diagnostics = DiagnosticsRun("Zipcode")
+
+            combined_dataset, grouped_data = self._school_geography_layer(inputs, diagnostics, "zip_code")
+
+            # Debug spreadsheet of the zip code map, only when diagnostics are on
+            if diagnostics.enabled:
+                # Convert the crosswalk to a list of dictionaries
+                zip_code_map_list = [
+                    {"lea_code": key[0], "school_code": key[1], "zip_code": geography.zip_code}
+                    for key, geography in inputs.school_geography.items()
+                ]
+
+                diagnostics.write_excel("zip_code_map.xlsx", zip_code_map_list)
+
+            # Debug checks of the ZIP code 54915 totals, only when diagnostics are on
+            if diagnostics.enabled:
+                zip_54915_count=sum(
+                    1 for record in combined_dataset
+                    if record.zip_code == "54915" 
+                )
+                logger.info(f"Total records with ZIP code 54915: {zip_54915_count}")
 
-            
-            
-             # Process records for transformation
-            grouped_data = {}
-            for record in combined_dataset:
-                period = f"{record.school_year.split('-')[0]}-20{record.school_year.split('-')[1]}" if "-" in record.school_year else record.school_year
-                strat_label = record.stratification.label_name if record.stratification else "Error"
-                 # Ensure the zip_code attribute is present
-                
-                district_code = record.district_code
-                school_code = record.school_code
-                zip_code = record.zip_code
-                
-                # Map the zip code to its GEOID
-                geoid=zip_code_geoid_map.get(zip_code, "Error")
-                if geoid == "Error":
-                    #logger.warning(f"GEOID not found for zip code: {zip_code}")
-                    continue
 
-                # Group by stratification and period
-                strat_key = (strat_label,geoid)
 
-                if strat_key not in grouped_data:
-                        grouped_data[strat_key] = {
-                            "layer": "Zip code",
-                            "geoid": geoid,
-                            "topic": "FVDEYLCV",
-                            "stratification": strat_label,
-                            "period": period,
-                            "value": int(record.student_count) if record.student_count.isdigit() else 0,
-                        }
-                else:
-                    grouped_data[strat_key]["value"] += int(record.student_count) if record.student_count.isdigit() else 0
-               
-                    
+               # Check how many records exist with zip_code 54915 in the raw dataset
+                logger.info("=== DEBUG: Checking all records with ZIP Code 54915 ===")
+                count_54915 = 0
+                for record in combined_dataset:   
+                    if record.zip_code == "54915":
+                            count_54915 += 1
+                            #logger.info(f"Record: School {record.school_name}, District {record.district_name}, County {record.county}, Student Count {record.student_count}")
 
-            zip_54915_count=sum(
-                1 for record in combined_dataset
-                if record.zip_code == "54915" 
-            )
-            logger.info(f"Total records with ZIP code 54915: {zip_54915_count}")
-            
+                logger.info(f"Total raw records with ZIP 54915: {count_54915}")
 
-               
-           # Check how many records exist with zip_code 54915 in the raw dataset
-            logger.info("=== DEBUG: Checking all records with ZIP Code 54915 ===")
-            count_54915 = 0
-            for record in combined_dataset:   
-                if record.zip_code == "54915":
-                        count_54915 += 1
-                        #logger.info(f"Record: School {record.school_name}, District {record.district_name}, County {record.county}, Student Count {record.student_count}")
+                total_raw = 0
+                logger.info("=== DEBUG: Computing total_raw for ZIP Code 54915 ===")
 
-            logger.info(f"Total raw records with ZIP 54915: {count_54915}")
+                for record in combined_dataset:
+                        if record.zip_code == "54915":
+                            try:
+                                student_count = record.student_count or 0
+                                total_raw += student_count
+                                #logger.info(f"Adding {student_count} from School {record.school_name}, School Code {record.school_code} , District Code {record.district_code}")
+                            except Exception as e:
+                                logger.error(f"Error converting student_count for record {record.school_name}: {e}")
 
-            total_raw = 0
-            logger.info("=== DEBUG: Computing total_raw for ZIP Code 54915 ===")
+                logger.info(f"Raw Total: {total_raw}")
 
-            for record in combined_dataset:
-                    if record.zip_code == "54915":
-                        try:
-                            student_count = int(record.student_count) if str(record.student_count).isdigit() else 0
-                            total_raw += student_count
-                            #logger.info(f"Adding {student_count} from School {record.school_name}, School Code {record.school_code} , District Code {record.district_code}")
-                        except Exception as e:
-                            logger.error(f"Error converting student_count for record {record.school_name}: {e}")
 
-            logger.info(f"Raw Total: {total_raw}")
 
-                        
-            
-            #Identify the missing records
-            missing_records =[
-                record for record in combined_dataset
-                if getattr(record,"geoid",None) == "54915" and  record.student_count not in [data["value"] for data in grouped_data.values()]
-            ]
-            
-            if missing_records:
-                logger.warning(f"Missing records: {missing_records}")
-            else:
-                logger.info("No missing records found")
-            
-            
-            
-            
-            
+                #Identify the missing records
+                missing_records =[
+                    record for record in combined_dataset
+                    if getattr(record,"geoid",None) == "54915" and  record.student_count not in [data["value"] for data in grouped_data.values()]
+                ]
+
+                if missing_records:
+                    logger.warning(f"Missing records: {missing_records}")
+                else:
+                    logger.info("No missing records found")
+
             # Prepare transformed data for bulk insertion
             transformed_data = [
                 ZipCodeLayerTransformation(
@@ -1536,9 +1847,7 @@ class DataTransformer:
             ]
 
             # Insert transformed data in bulk
-            with transaction.atomic():
-                ZipCodeLayerTransformation.objects.all().delete()  # Clear existing data
-                ZipCodeLayerTransformation.objects.bulk_create(transformed_data)
+            self._write_layer(ZipCodeLayerTransformation, transformed_data)
 
             logger.info(f"Successfully transformed {len(transformed_data)} records.")
 
@@ -1552,305 +1861,14 @@ class DataTransformer:
             logger.error(f"Traceback: {traceback.format_exc()}")
             return False
     
-    def transform_Metopio_CityLayer(self):
+    @cached_layer("City-Town", MetopioCityLayerTransformation)
+    def transform_Metopio_CityLayer(self, inputs=None):
         try:
             logger.info("Starting Metopio City Layer Transformation...")
-    
-            # Fetch and filter County GEOID entries
-            county_geoid_entries = CountyGEOID.objects.filter(layer="City or town")
-            logger.info(f"Filtered County GEOID entries count: {county_geoid_entries.count()}")
-    
-            # Create a map to store the City and its corresponding GEOID from the County GEOID entries
-            city_geoid_map = {entry.name: entry.geoid for entry in county_geoid_entries}
-            #logger.info(f"City GEOID map: {city_geoid_map}")
-    
-            # Fetch and join SchoolData with SchoolAddressFile dynamically
-            school_data = (
-                SchoolData.objects.filter(
-                    ~Q(school_name__startswith='['),  # Exclude records with county names in square brackets
-                    county__in=['Outagamie', 'Winnebago', 'Calumet']  # Filter for specified counties
-                )
-                #.prefetch_related('address_details')  # Fetch related address details in a single query
-                .distinct()  # Ensure unique records
-            )
-            logger.info(f"Filtered school data count: {school_data.count()}")
-    
-            # HANDLE UNKNOWN
-            combined_dataset = list(school_data)  # Convert QuerySet to list
-            group_totals = defaultdict(int)
-            all_students_totals = defaultdict(int)
-            
-            #NORMALIZING AFTER FETCHING THE DATA
-            for record in combined_dataset:
-                record.school_code=record.school_code.lstrip("0")
-                record.district_code=record.district_code.lstrip("0")
-    
-            # Compute totals per GROUP_BY and track "All Students" total
-            # We have to do this groupBy total for each school code which is not null
-    
-            for record in combined_dataset:
-                if record.school_code is None:
-                    continue
-                key = (record.district_code, record.school_code, record.group_by)
-                group_totals[key] += int(record.student_count)
-                if record.group_by == "All Students":
-                    all_students_totals[record.district_code,record.school_code] += int(record.student_count)
-    
-            group_by_totals = {}
-    
-            # We are assigning this new group_totals dictionary to hold the objects of the remaining columns
-            for record in school_data:
-                key = (record.county, record.district_code, record.school_code, record.group_by, record.group_by_value,record.stratification)
-                group_by_totals[key] = group_totals[(record.district_code,record.school_code,record.group_by)]
-    
-            
-            #BUILDING THE UNKNOWN RECORDS
-            
-            new_unknown_records = []
-            unique_records = set()
-
-            for key, total in group_by_totals.items():
-                county, district_code, school_code, group_by, group_by_value,stratification = key
-                if total < all_students_totals[(district_code,school_code)]:
-                    difference = all_students_totals[(district_code,school_code)] - total
-                    #logger.info(f"****Difference {difference} for {school_code} {group_by} {group_by_value}= {all_students_totals[(district_code,school_code)]} - {total}")
-                    unique_key = (county, district_code, school_code, group_by, "Unknown")
-
-                    # Adjust the key structure to match unique_key
-                    if group_by_value == "Unknown":
-                            group_by_totals[key] += difference
-                            logger.info(f"Updated existing unknown record for {county}, {district_code}, {school_code}, {group_by} with difference {difference}")
-                            continue 
-                    
-                    # Only append if this combination hasn't been seen before
-                    if unique_key not in unique_records:
-                        unique_records.add(unique_key)
-                        # Create new "Unknown" record
-                        record = next((r for r in combined_dataset if r.district_code == district_code and r.school_code == school_code and r.group_by == group_by), None)
-                        if record:
-                            # Create new "Unknown" record
-                            new_record = SchoolData(
-                                school_year=record.school_year,
-                                agency_type=record.agency_type or "Unknown",
-                                cesa=record.cesa,
-                                county=county,
-                                district_code=str(district_code).lstrip("0"),
-                                school_code=str(school_code).lstrip("0"),
-                                grade_group=record.grade_group or "Unknown",
-                                charter_ind=record.charter_ind or "Unknown",
-                                district_name=record.district_name or "Unknown",
-                                school_name=record.school_name or "Unknown",
-                                group_by=group_by,
-                                group_by_value="Unknown",
-                                student_count=str(difference), 
-                                percent_of_group=record.percent_of_group or "0",
-                                place=record.place or "",
-                                stratification=stratification,
-                                
-                            )
-                                # Copy address details from the original record
-                            new_unknown_records.append(new_record)
-                        else:
-                            logger.error(f"Record not found for {district_code}, {school_code}, {group_by}")
-                    else:
-                        logger.info(f"Duplicate unknown record for {unique_key}")     
-            logger.info(f"****New unknown records count: {len(new_unknown_records)}")
-
-    
-                # Create a combined dataset in memory
-            combined_dataset.extend(new_unknown_records)  # Convert QuerySet to list
-            #Now in this combined data set list we need to loop through the group_by_map list and 
-            # check if the combined data set has a missing group_by record for every school code
-            # If it does not have a record then we need to add a new record with the group_by as 
-            # the one that is missing from the key of the map below which why is we are making the group_by_map a dictionary
-            group_by_map={
-                f"{strat.group_by}": strat
-                for strat in Stratification.objects.all()
-            }
-            logger.info(f"Stratification Mapping: {group_by_map}")
-
-            #loop through the combined data set and check for each school code if that record
-            #has missing group_by records and if it does then we need to add a new record for that group_by
-
-            #Create a dictionary to group records by school code and district code 
-            school_code_groups =defaultdict(list)
-            for record in combined_dataset:
-                school_code_groups[record.school_code,record.district_code].append(record)   ##Change Added the district code 
-      
-
-            #Loop through the grouped records and check for the missing group_by keys
-            for (school_code,district_code), records in school_code_groups.items():
-                existing_group_by_keys ={record.group_by for record in records}
-                missing_group_by_keys = set(group_by_map.keys()) - existing_group_by_keys
-
-                for missing_group_by_key in missing_group_by_keys:
-                    reference_record = next((r for r in records if r.group_by == "All Students"), None)
-                    # Create a new record for the missing group_by key
-                    new_record = SchoolData(
-                        school_year=reference_record.school_year,
-                        agency_type=reference_record.agency_type or "Unknown",
-                        cesa=reference_record.cesa,
-                        county=reference_record.county,
-                        district_code=reference_record.district_code,
-                        school_code=reference_record.school_code,
-                        grade_group=reference_record.grade_group or "Unknown",
-                        charter_ind=reference_record.charter_ind or "Unknown",
-                        district_name=reference_record.district_name or "Unknown",
-                        school_name=reference_record.school_name or "Unknown",
-                        group_by=missing_group_by_key,
-                        group_by_value="Unknown",
-                        student_count=str(all_students_totals[reference_record.district_code, reference_record.school_code]),
-                        percent_of_group=reference_record.percent_of_group or "0",
-                        place=reference_record.place or "",
-                        stratification=reference_record.stratification,
-                    )
-                    combined_dataset.append(new_record)
-                    logger.info(f"""Added new record for missing group_by: {missing_group_by_key} 
-                    #             for count {all_students_totals[(records[0].district_code,records[0].school_code)]}
-                    #             for school code: {school_code}
-                    #             for school name: {records[0].school_name}""")    
-
-            
-            
-            
-            
-            
-            logger.info(f"#3 Normalized the school_code and district_code for {len(combined_dataset)} records")   ##3422
-
-
-            # Create a dictionary to group records by school code
-            school_code_groups_xlx_log = defaultdict(list)
-            for record in combined_dataset:
-                school_code_groups_xlx_log[record.school_code, district_code].append(record)
-
-            # Prepare data for export
-            export_data = []
-            for (school_code,district_code), records in school_code_groups_xlx_log.items():
-                for record in records:
-                    export_data.append({
-                        "school_code": school_code,
-                        "school_year": record.school_year,
-                        "agency_type": record.agency_type,
-                        "cesa": record.cesa,
-                        "county": record.county,
-                        "district_code": record.district_code,
-                        "school_code": record.school_code,
-                        "grade_group": record.grade_group,
-                        "charter_ind": record.charter_ind,
-                        "district_name": record.district_name,
-                        "school_name": record.school_name,
-                        "group_by": record.group_by,
-                        "group_by_value": record.group_by_value,
-                        "student_count": record.student_count,
-                        "percent_of_group": record.percent_of_group,
-                        "place": record.place,
-                        "stratification": record.stratification.label_name if record.stratification else "Unknown",
-                    })
-
-            # Create a DataFrame from the export data
-            df = pd.DataFrame(export_data)
-
-            # Export the DataFrame to an Excel file
-            df.to_excel("school_code_groups_city.xlsx", index=False)
-            logger.info("School code groups exported to school_code_groups_city.xlsx")
-
-
-
-
-            #REALIGN STRATIFICATION SINCE WE ADDED NEW RECORDS
-            strat_map = {
-                f"{strat.group_by}{strat.group_by_value}": strat
-                for strat in Stratification.objects.all()
-            }
-            for record in combined_dataset:
-                combined_key = record.group_by + record.group_by_value
-                record.stratification = strat_map.get(combined_key) #assigning the stratification for the data
-                #logger.info(f"Stratification for {combined_key} is {record.stratification.label_name}")
-
-            logger.info(f"Combined dataset count: {len(combined_dataset)}")
-            
-            #REALIGNING THE CITY
-            # Assign a City to each record in the combined dataset
-            city_code_map = {
-                (d.lea_code.lstrip("0"), d.school_code.lstrip("0")): d.city
-                for d in SchoolAddressFile.objects.all()
-            }
-            
-            #Assign a city to each record in the combined dataset
-            for record in combined_dataset:
-                record.district_code = str(record.district_code).strip().lstrip("0")
-                record.school_code = str(record.school_code).strip().lstrip("0")
-                
-                combined_key = (record.district_code, record.school_code)
-                city = city_code_map.get(combined_key, "Not Found")
-                setattr(record, "city", city)
-
-            #Sorting the COmbined data set to view how this look Just to Generate how the data looks until now
-            combined_dataset.sort(key=lambda x: (x.district_code, x.school_code, x.group_by,x.school_name))
-            
-            #THis is just for logging and debugging
-            # for record in combined_dataset:
-            #     logger.info(f"Record: {record.district_code:<{15}} {record.school_code:<{15}} {record.school_name:<{40}} {record.zip_code:<{15}} ")
-
-            # Collect log data into a list
-            log_data = []
-            for record in combined_dataset:
-                cleaned_district_code = record.district_code
-                cleaned_school_code = record.school_code
-
-                log_data.append({
-                    "district_code": cleaned_district_code,
-                    "school_code": cleaned_school_code,
-                    "school_name": record.school_name,
-                    "group_by": record.group_by,
-                    "group_by_value": record.group_by_value,
-                    "Stratification": record.stratification.label_name,
-                    "student_count": int(record.student_count),
-                    "city": record.city
-                })
-
-                # logger.info(
-                #     f"Record: {cleaned_district_code:<{15}} {cleaned_school_code:<{15}} {record.school_name:<{40}} {record.zip_code:<{15}}"
-                # )
-                        # Create a DataFrame from the log data
-            df = pd.DataFrame(log_data)
-
-            # Export the DataFrame to an Excel file
-            df.to_excel("log_data_city.xlsx", index=False)
-            logger.info("Log data exported to log_data.xlsx")
-
-            # Process records for transformation
-            grouped_data = {}
-            for record in combined_dataset:
-            
-                period = f"{record.school_year.split('-')[0]}-20{record.school_year.split('-')[1]}" if "-" in record.school_year else record.school_year
-                strat_label = record.stratification.label_name if record.stratification else "Error"
-
-                # Extract the city
-                city = record.city + ", WI"  # Adding ", WI" to match the format in the CountyGEOID file
-
-                # Map the city from the SchoolAddressFile to its GEOID from the CountyGEOID file
-                geoid = city_geoid_map.get(city, "Error")
-                if geoid == "Error":
-                    logger.warning(f"GEOID not found for city: {city}")
-                    continue
-
-                # Group by stratification and period
-                strat_key = (strat_label, geoid)
-
-                if strat_key not in grouped_data:
-                    grouped_data[strat_key] = {
-                        "layer": "City or town",
-                        "geoid": geoid,
-                        "topic": "FVDEYLCV",
-                        "stratification": strat_label,
-                        "period": period,
-                        "value": int(record.student_count) if record.student_count.isdigit() else 0,
-                    }
-                else:
-                    grouped_data[strat_key]["value"] += int(record.student_count) if record.student_count.isdigit() else 0
-
+            inputs = inputs or LayerInputs()
+            diagnostics = DiagnosticsRun("City-Town")
 
+            combined_dataset, grouped_data = self._school_geography_layer(inputs, diagnostics, "city")
 
             # Prepare transformed data for bulk insertion
             transformed_data = [
@@ -1866,9 +1884,7 @@ class DataTransformer:
             ]
 
             # Insert transformed data in bulk
-            with transaction.atomic():
-                MetopioCityLayerTransformation.objects.all().delete()  # Clear existing data
-                MetopioCityLayerTransformation.objects.bulk_create(transformed_data)
+            self._write_layer(MetopioCityLayerTransformation, transformed_data)
             logger.info(f"Successfully transformed {len(transformed_data)} records.")
 
 
@@ -1879,3 +1895,17 @@ class DataTransformer:
             logger.error(f"Error during Metopio City Layer Transformation: {e} at line number {line_number}")
             logger.error(f"Traceback: {traceback.format_exc()}")
             return False
+
+
+def _init_layer_worker():
+    # Forked workers already have Django set up, spawned ones (macOS, Windows) import it afresh
+    django.setup()
+
+
+def _build_layer_in_process(layer, force):
+    """ Build one layer in a worker process of run_all_layers, returns its LayerResult with the rows to write """
+    try:
+        return getattr(DataTransformer(defer_writes=True), DataTransformer.LAYERS[layer])(force=force)
+    finally:
+        flush_diagnostics()
+        connections.close_all()
@@ -13,4 +13,6 @@ urlpatterns = [
     path('metopio_statewide/', views.metopio_statewide_view, name='metopio_statewide_layer_view'),
     path('metopio_zipcode/', views.metopio_zipcode_view, name='metopio_zipcode_layer_view'),
     path('city_town/', views.city_town_view, name='metopio_city_town_view'),
+    path('jobs/<int:job_id>/', views.job_detail, name='job_detail'),
+    path('jobs/<int:job_id>/status/', views.job_status, name='job_status'),
 ]
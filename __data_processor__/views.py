@@ -1,8 +1,12 @@
 from django.shortcuts import render, redirect
-from django.db.utils import OperationalError
-import time
 import os
 import csv
+import codecs
+import hashlib
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from django.urls import reverse  # For generating URLs
 from .models import (
     SchoolData,
@@ -13,21 +17,34 @@ from .models import (
     MetopioStateWideLayerTransformation,
     ZipCodeLayerTransformation,
     MetopioCityLayerTransformation,  # Add this line
+    IngestedFile,
+    SchoolGeography,
+    Job,
+    parse_student_count,
+    normalize_code,
+    input_generations,
+    bump_input_generation,
 )
 from .forms import UploadFileForm
 from .models import ZipCodeLayerTransformation
 from .models import SchoolAddressFile
 from .models import CountyGEOID
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
 import logging
 from django.conf import settings
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 import pandas as pd
-from django.db import transaction, connection
+from django.db import connection
+from django.db.models import Max
+from django.db.models.expressions import RawSQL
 from django.core.paginator import Paginator
 from django.contrib import messages  # For adding feedback messages
 from .transformers import DataTransformer
+from .db import bulk_load, write_transaction
+from . import jobs
 from collections import defaultdict
 
 
@@ -38,12 +55,21 @@ def data_processor_home(request):
         transformation_type = request.POST.get(
             "transformation_type", "Statewide V01"
         )  # Default to 'Statewide'
+        # Long transformations run as a background job, the job page polls until it is done
+        if jobs.background_jobs_enabled():
+            job = jobs.submit(
+                "transformation", f"{transformation_type} transformation", transformation_job,
+                transformation_type=transformation_type,
+            )
+            return redirect("job_detail", job_id=job.id)
+
         # Instantiate the DataTransformer and apply the transformation
-        transformer = DataTransformer(request)
-        success = transformer.apply_transformation(transformation_type)
+        transformer = DataTransformer()
+        result = transformer.apply_transformation(transformation_type)
+        add_result_messages(request, result)
 
         # If transformation was successful, redirect to success page
-        if success:
+        if result:
             return redirect(f"/data_processor/success/?type={transformation_type}")
 
         # If transformation failed, stay on the same page to display the error
@@ -64,36 +90,34 @@ def transformation_success(request):
     transformation_type = request.GET.get(
         "type", "Statewide V01"
     )  # Default to Statewide if not specified
-    # Instantiate DataTransformer properly with the request
-    # Transformer = DataTransformer(request)
     # Retrieve the appropriate transformed data based on the transformation type
     # Run the transformation explicitly
     if transformation_type == "Statewide V01":
-        transformer = DataTransformer(request)
-        transformer.apply_transformation("Statewide V01")
+        transformer = DataTransformer()
+        add_result_messages(request, transformer.apply_transformation("Statewide V01"))
         data_list = TransformedSchoolData.objects.filter(place="WI")
         return redirect(
             reverse("statewide_view")
         )  # Replace 'statewide_view' with the actual name of your URL
     elif transformation_type == "Tri-County":
-        transformer = DataTransformer(request)
-        transformer.apply_tri_county_layer_transformation()
+        transformer = DataTransformer()
+        add_result_messages(request, transformer.apply_tri_county_layer_transformation())
         data_list = MetopioTriCountyLayerTransformation.objects.all()
     elif transformation_type == "County-Layer":
-        transformer = DataTransformer(request)  # Apply County Layer transformation
-        transformer.apply_county_layer_transformation()
+        transformer = DataTransformer()  # Apply County Layer transformation
+        add_result_messages(request, transformer.apply_county_layer_transformation())
         data_list = CountyLayerTransformation.objects.all()
     elif transformation_type == "Metopio Statewide":
-        transformer = DataTransformer(request)
-        transformer.transform_Metopio_StateWideLayer()
+        transformer = DataTransformer()
+        add_result_messages(request, transformer.transform_Metopio_StateWideLayer())
         data_list = MetopioStateWideLayerTransformation.objects.all()
     elif transformation_type == "Zipcode":
-        transformer = DataTransformer(request)
-        transformer.transforms_Metopio_ZipCodeLayer()
+        transformer = DataTransformer()
+        add_result_messages(request, transformer.transforms_Metopio_ZipCodeLayer())
         data_list = ZipCodeLayerTransformation.objects.all()
     elif transformation_type == "City-Town":
-        transformer = DataTransformer(request)
-        transformer.transform_Metopio_CityLayer()
+        transformer = DataTransformer()
+        add_result_messages(request, transformer.transform_Metopio_CityLayer())
         data_list = MetopioCityLayerTransformation.objects.all()
     else:
         # Handle unknown transformation types
@@ -121,119 +145,551 @@ def transformation_success(request):
     )
 
 
+# Turns the rows of the main enrollment file into SchoolData value tuples, batch_size at a time
+# Rows with a redacted ('*') or zero STUDENT_COUNT are skipped and the "Grade" GROUP_BY is renamed to
+# "Grade Level" to match the stratification file, before the row is linked to its Stratification.
+# The tuples hold the SCHOOL_DATA_INSERT_FIELDS in order and are inserted as they are (see insert_school_data),
+# so the codes are normalized here
+SCHOOL_DATA_COLUMNS = {
+    "school_year": "SCHOOL_YEAR",
+    "agency_type": "AGENCY_TYPE",
+    "cesa": "CESA",
+    "county": "COUNTY",
+    "district_code": "DISTRICT_CODE",
+    "school_code": "SCHOOL_CODE",
+    "grade_group": "GRADE_GROUP",
+    "charter_ind": "CHARTER_IND",
+    "district_name": "DISTRICT_NAME",
+    "school_name": "SCHOOL_NAME",
+    "group_by": "GROUP_BY",
+    "group_by_value": "GROUP_BY_VALUE",
+    "student_count": "STUDENT_COUNT",
+    "percent_of_group": "PERCENT_OF_GROUP",
+}
+SCHOOL_DATA_INSERT_FIELDS = [*SCHOOL_DATA_COLUMNS, "stratification_id"]
+
+
+def school_data_batches(rows, strat_ids, batch_size):
+    """ Yield lists of at most batch_size SchoolData value tuples built from the CSV rows """
+    # The batches are held in memory until they are inserted (see handle_uploaded_file). Most values repeat
+    # from row to row (years, counties, districts, schools, group bys), the rows share one copy of each
+    shared = {}
+    batch = []
+    for row in rows:
+        if row["STUDENT_COUNT"] == "*" or row["STUDENT_COUNT"] == "0":
+            continue
+        group_by = "Grade Level" if row["GROUP_BY"] == "Grade" else row["GROUP_BY"]
+        combined_key = group_by + row["GROUP_BY_VALUE"]
+
+        batch.append(tuple(shared.setdefault(value, value) for value in (
+            row["SCHOOL_YEAR"],
+            row["AGENCY_TYPE"],
+            row["CESA"],
+            row["COUNTY"],
+            normalize_code(row["DISTRICT_CODE"]),
+            normalize_code(row["SCHOOL_CODE"]),
+            row["GRADE_GROUP"],
+            row["CHARTER_IND"],
+            row["DISTRICT_NAME"],
+            row["SCHOOL_NAME"],
+            group_by,
+            row["GROUP_BY_VALUE"],
+            parse_student_count(row["STUDENT_COUNT"]),
+            row["PERCENT_OF_GROUP"],
+            strat_ids.get(combined_key),
+        )))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# bulk_create is held back by the 999 parameters SQLite allows per statement: it builds a model
+# instance per row and sends the rows about 60 at a time. The value tuples are instead handed to
+# executemany, which runs one prepared INSERT over the whole batch. It does not go through the
+# SchoolData manager, so the caller bumps the generation of the table (see models.py) once the rows are in.
+def insert_school_data(cursor, batch):
+    """ Insert a batch of SchoolData value tuples with one executemany """
+    quote = connection.ops.quote_name
+    cursor.executemany(
+        f"INSERT INTO {quote(SchoolData._meta.db_table)} "
+        f"({', '.join(quote(field) for field in SCHOOL_DATA_INSERT_FIELDS)}) "
+        f"VALUES ({', '.join(['%s'] * len(SCHOOL_DATA_INSERT_FIELDS))})",
+        batch,
+    )
+
+
+# BULK LOADING OF THE STRATIFICATIONS
+# The main file is joined to the stratifications on group_by + group_by_value. The map of that key to the
+# Stratification id is built from the rows in id order, so when a key has several labels the last one wins.
+def stratification_id_map():
+    """ Map of group_by + group_by_value to the Stratification id, read in one query """
+    return {
+        f"{group_by}{group_by_value}": strat_id
+        for strat_id, group_by, group_by_value in Stratification.objects.order_by("id").values_list(
+            "id", "group_by", "group_by_value"
+        )
+    }
+
+
+def load_stratifications_file(file, upsert=False):
+    """ Load the stratifications file with one bulk_create and return the stratification id map.
+    The rows are deduplicated in memory on (group_by, group_by_value, label_name). In upsert mode the
+    existing stratifications are kept (the SchoolData rows left alone still point to them) and only
+    the missing ones are inserted """
+    # dict keeps the order of the file, the ids are then handed out in that order
+    strat_keys = {}
+    for row in read_uploaded_csv(file):
+        group_by = "Grade Level" if row["GROUP_BY"] == "Grade" else row["GROUP_BY"]
+        strat_keys.setdefault((group_by, row["GROUP_BY_VALUE"], row["Stratification"]))
+
+    with write_transaction():
+        if upsert:
+            existing = set(Stratification.objects.values_list("group_by", "group_by_value", "label_name"))
+        else:
+            Stratification.objects.all().delete()
+            existing = set()
+
+        new_strats = [
+            Stratification(group_by=group_by, group_by_value=group_by_value, label_name=label_name)
+            for group_by, group_by_value, label_name in strat_keys
+            if (group_by, group_by_value, label_name) not in existing
+        ]
+        Stratification.objects.bulk_create(new_strats)
+        logger.info(f"{len(new_strats)} Stratification records inserted into the database")
+
+        # The ids are read back from the table: bulk_create only sets them on the instances on databases
+        # that support RETURNING (SQLite 3.35 and later)
+        return stratification_id_map()
+
+
+# UPSERT INGESTION
+# In upsert mode the main file is merged into SchoolData instead of replacing it: a row is identified by
+# its (school_year, district_code, school_code, group_by, group_by_value) key, new keys are inserted,
+# rows whose values changed are updated and everything else (including rows missing from the file) is left alone.
+# The stored rows are looked up one batch at a time, only for the keys of that batch, so the memory used
+# depends on the batch size and not on the size of the table. The ids of the stored rows already matched
+# are kept in a temporary table (UPSERT_MATCHED_TABLE) rather than in memory.
+SCHOOL_DATA_KEY_FIELDS = ["school_year", "district_code", "school_code", "group_by", "group_by_value"]
+SCHOOL_DATA_VALUE_FIELDS = [
+    "agency_type", "cesa", "county", "grade_group", "charter_ind", "district_name", "school_name",
+    "student_count", "percent_of_group", "stratification",
+]
+SCHOOL_DATA_VALUE_COLUMNS = [f"{field}_id" if field == "stratification" else field for field in SCHOOL_DATA_VALUE_FIELDS]
+# Positions of the key and value columns in the value tuples of the main file
+SCHOOL_DATA_KEY_INDEXES = [SCHOOL_DATA_INSERT_FIELDS.index(field) for field in SCHOOL_DATA_KEY_FIELDS]
+SCHOOL_DATA_VALUE_INDEXES = [SCHOOL_DATA_INSERT_FIELDS.index(column) for column in SCHOOL_DATA_VALUE_COLUMNS]
+
+
+def school_data_key(values):
+    return tuple(values[index] for index in SCHOOL_DATA_KEY_INDEXES)
+
+
+UPSERT_MATCHED_TABLE = "data_processor_upsert_matched"
+
+
+def stored_school_data(batch, last_id):
+    """ Stored rows of the keys of a batch, up to last_id and not matched by an earlier batch:
+    key -> [(id, values)] in id order """
+    keys = {school_data_key(values) for values in batch}
+    school_year, district_code, school_code = (
+        {values[index] for values in batch} for index in SCHOOL_DATA_KEY_INDEXES[:3]
+    )
+    # The rows of the schools of the batch (the district and school codes are indexed), the exact keys are matched here
+    rows = SchoolData.objects.filter(
+        id__lte=last_id,
+        school_year__in=school_year,
+        district_code__in=district_code,
+        school_code__in=school_code,
+    ).exclude(
+        id__in=RawSQL(f"SELECT id FROM {UPSERT_MATCHED_TABLE}", ())
+    ).order_by("id").values_list("id", *SCHOOL_DATA_KEY_FIELDS, *SCHOOL_DATA_VALUE_COLUMNS)
+
+    key_length = len(SCHOOL_DATA_KEY_FIELDS)
+    existing = defaultdict(list)
+    for values in rows:
+        key = values[1:key_length + 1]
+        if key in keys:
+            existing[key].append((values[0], values[key_length + 1:]))
+    return existing
+
+
+def upsert_school_data(batches):
+    """ Merge the batches of SchoolData value tuples into SchoolData. Returns the ingest report with the keys that were inserted or updated """
+    # Only the rows stored before the upsert are matched, not the ones it inserts
+    last_id = SchoolData.objects.aggregate(last_id=Max("id"))["last_id"] or 0
+
+    report = {"inserted": 0, "updated": 0, "unchanged": 0, "changed_keys": set()}
+    with connection.cursor() as cursor:
+        cursor.execute(f"CREATE TEMP TABLE IF NOT EXISTS {UPSERT_MATCHED_TABLE} (id INTEGER PRIMARY KEY)")
+        cursor.execute(f"DELETE FROM {UPSERT_MATCHED_TABLE}")
+        try:
+            for batch in batches:
+                # A key can appear more than once in the export, the rows of a key are matched with
+                # its stored rows in order and the extra ones inserted
+                existing = stored_school_data(batch, last_id)
+                to_create, to_update, matched_ids = [], [], []
+                for values in batch:
+                    key = school_data_key(values)
+                    if not existing.get(key):
+                        to_create.append(SchoolData(**dict(zip(SCHOOL_DATA_INSERT_FIELDS, values))))
+                        report["changed_keys"].add(key)
+                        continue
+                    record_id, stored_values = existing[key].pop(0)
+                    matched_ids.append((record_id,))
+                    if tuple(values[index] for index in SCHOOL_DATA_VALUE_INDEXES) == stored_values:
+                        report["unchanged"] += 1
+                        continue
+                    to_update.append(SchoolData(id=record_id, **dict(zip(SCHOOL_DATA_INSERT_FIELDS, values))))
+                    report["changed_keys"].add(key)
+                SchoolData.objects.bulk_create(to_create)
+                SchoolData.objects.bulk_update(to_update, SCHOOL_DATA_VALUE_FIELDS)
+                cursor.executemany(f"INSERT INTO {UPSERT_MATCHED_TABLE} (id) VALUES (%s)", matched_ids)
+                report["inserted"] += len(to_create)
+                report["updated"] += len(to_update)
+        finally:
+            cursor.execute(f"DROP TABLE IF EXISTS {UPSERT_MATCHED_TABLE}")
+    return report
+
+
+# READING UPLOADS STRAIGHT FROM THE REQUEST
+# The uploaded files are decoded chunk by chunk straight into the csv parser instead of being written
+# to uploads/ and read back from the disk. Keeping a copy in uploads/ is optional
+# (DATA_PROCESSOR_ARCHIVE_UPLOADS) and runs on a background thread while the file is being parsed.
+# Archived copies get a unique name so two users uploading a file with the same name do not collide.
+_archiver = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload-archive")
+
+
+def read_uploaded_csv(f):
+    """ csv.DictReader over an uploaded file, decoded line by line from its chunks """
+    f.seek(0)
+    # utf-8-sig also accepts the byte order mark Excel puts at the start of a CSV export
+    return csv.DictReader(codecs.iterdecode(f, "utf-8-sig"))
+
+
+def _archive_copy(source, file_path):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    if isinstance(source, bytes):
+        with open(file_path, "wb") as destination:
+            destination.write(source)
+    else:
+        shutil.copyfile(source, file_path)
+    return file_path
+
+
+def archive_upload(f):
+    """ Start copying an uploaded file into uploads/ in the background. Returns the future of the copy,
+    or None when archiving is turned off """
+    if not getattr(settings, "DATA_PROCESSOR_ARCHIVE_UPLOADS", True):
+        return None
+    upload_dir = os.path.join(settings.BASE_DIR, "uploads")
+    file_name = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}-{os.path.basename(f.name)}"
+    # Large uploads are already spooled to a temporary file that can be copied on its own handle,
+    # small ones live in memory and are handed over as bytes
+    if hasattr(f, "temporary_file_path"):
+        source = f.temporary_file_path()
+    else:
+        source = f.file.getvalue()
+    return _archiver.submit(_archive_copy, source, os.path.join(upload_dir, file_name))
+
+
+def wait_for_archive(archived):
+    """ Wait for a background archive copy, the temporary upload is deleted once the request is over """
+    if archived is None:
+        return
+    try:
+        logger.info(f"File archived successfully to {archived.result()}")
+    except Exception as e:
+        logger.error(f"Error archiving uploaded file: {e}")
+
+
+# SKIPPING FILES THAT WERE ALREADY INGESTED
+# Every ingested file is recorded with its sha256 in IngestedFile. Uploading a byte-identical copy of the
+# last file of the same kind is a no-op as long as the tables it was loaded into were not changed since
+# (their generation, which every write bumps, is the one recorded with the file).
+# The main file is also stored with the Stratification table state because it links its rows to them.
+INGEST_TABLES = {
+    "main": [SchoolData, Stratification],
+    "stratifications": [Stratification],
+    "county_geoid": [CountyGEOID],
+    "school_address": [SchoolAddressFile],
+}
+
+
+def file_sha256(f):
+    """ sha256 of an uploaded file, read chunk by chunk """
+    digest = hashlib.sha256()
+    f.seek(0)
+    for chunk in f.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def ingest_table_state(kind):
+    return "|".join(input_generations(INGEST_TABLES[kind]))
+
+
+def already_ingested(kind, digest, mode="replace"):
+    """ True when the last file ingested for kind has the same content and its tables were not changed since """
+    if not getattr(settings, "DATA_PROCESSOR_SKIP_DUPLICATE_UPLOADS", True):
+        return False
+    last = IngestedFile.objects.filter(kind=kind).order_by("-id").first()
+    if last is None or last.sha256 != digest:
+        return False
+    # Replacing after an upsert of the same file could still drop rows the file does not have
+    if mode == "replace" and last.mode != "replace":
+        return False
+    return last.table_state == ingest_table_state(kind)
+
+
+def record_ingested(kind, f, digest, mode="replace"):
+    IngestedFile.objects.create(
+        kind=kind, name=f.name, sha256=digest, mode=mode, table_state=ingest_table_state(kind)
+    )
+
+
 # Key features of the Function Handle_uploaded_file
-# Handles two file upload : Saves the uploaded files to a consistent directory in the project
+# Handles two file upload : Parses the uploaded files straight from the request, optionally archiving them in uploads/
 # Processes two files : Supports the processing of a main data file and an optional stratification file
 # Uses Bulk Operations ; Employs bulk insertion to to efficiently save data
-# Handles the error gracefully : Implements the retry mechanism to handle database locking errors
+# Handles database locking : the writes queue on write_transaction() and SQLite's busy timeout (see db.py)
+# Reports what was committed : the stratification and the main file are committed one after the other,
+# the name of each file is appended to committed once its transaction is in
 # Links the data in the SchoolData and the Stratification using the foreign key
 #Addition of the Stratification file upload and processing
 
 # handling to load the main file and the stratification file
-def handle_uploaded_file(f, stratifications_file=None):
-    """ Handle file upload and process main and stratification files """
+def handle_uploaded_file(f, stratifications_file=None, upsert=False, committed=None):
+    """ Handle file upload and process main and stratification files.
+    Returns the ingest report: inserted, updated and unchanged row counts and the changed keys
+    (None when the whole table was replaced). The names of the files committed are appended to committed """
+    committed = [] if committed is None else committed
+    mode = "upsert" if upsert else "replace"
+    strat_digest = file_sha256(stratifications_file) if stratifications_file else None
+    if strat_digest and already_ingested("stratifications", strat_digest, mode):
+        logger.info(f"Stratification file {stratifications_file.name} was already ingested, skipping it")
+        stratifications_file = None
+    # A new stratification file replaces the Stratification rows, so the main file has to be linked again
+    digest = file_sha256(f)
+    if not stratifications_file and already_ingested("main", digest, mode):
+        logger.info(f"File {f.name} was already ingested, skipping it")
+        return {"inserted": 0, "updated": 0, "unchanged": 0, "changed_keys": set(), "skipped": True}
+
+    # Archive the uploaded files in the background while they are parsed
+    archived = [archive_upload(f)]
+    if stratifications_file:
+        archived.append(archive_upload(stratifications_file))
     try:
-        # Save uploaded files
-        upload_dir = os.path.join(settings.BASE_DIR, "uploads")
-        os.makedirs(upload_dir, exist_ok=True)
-        file_path = os.path.join(upload_dir, f.name)
-        
-        with open(file_path, "wb+") as destination:
-            for chunk in f.chunks():
-                destination.write(chunk)
-        logger.info(f"File uploaded successfully to {file_path}")
-
-        # Process stratification file if provided
-        strat_map = {}
-        if stratifications_file:
-            strat_file_path = os.path.join(upload_dir, stratifications_file.name)
-            with open(strat_file_path, "wb+") as destination:
-                for chunk in stratifications_file.chunks():
-                    destination.write(chunk)
-            logger.info(f"Stratification file uploaded successfully to {strat_file_path}")
-
-            # Load stratifications into the database
-            try:
-                with open(strat_file_path, "r") as strat_file:
-                    strat_reader = csv.DictReader(strat_file)
-                    Stratification.objects.all().delete()
-                    for row in strat_reader:
-                        group_by = "Grade Level" if row["GROUP_BY"] == "Grade" else row["GROUP_BY"]
-                        group_by_value = row["GROUP_BY_VALUE"]
-                        label_name = row["Stratification"]
-                        
-                        # Create a Stratification object and save it to the database
-                        strat, created = Stratification.objects.get_or_create(
-                            group_by=group_by,
-                            group_by_value=group_by_value,
-                            label_name=label_name,
-                        )
-                        # Create a mapping of group_by and group_by_value to the Stratification object
-                        strat_map[f"{group_by}{group_by_value}"] = strat
-            except Exception as e:
-                logger.error(f"Error processing stratifications file: {e}")
-                raise
-
-        # Process the main file
-        retries = 5
-        while retries > 0:
-            try:
-                with open(file_path, "r") as file:
-                    reader = csv.DictReader(file)
-                    SchoolData.objects.all().delete()
-                    data = []
-
-                    strat_map = {
-                        f"{strat.group_by}{strat.group_by_value}": strat
-                        for strat in Stratification.objects.all()
-                    }
-
-                    for row in reader:
-                        if row["STUDENT_COUNT"] == "*" or row["STUDENT_COUNT"] == "0":
-                            continue
-                        group_by = "Grade Level" if row["GROUP_BY"] == "Grade" else row["GROUP_BY"]
-                        combined_key = group_by + row["GROUP_BY_VALUE"]
-                        stratification = strat_map.get(combined_key)
-                        unknown_key = (group_by, "Unknown")
-                        
-                        data.append(
-                            SchoolData(
-                                school_year=row["SCHOOL_YEAR"],
-                                agency_type=row["AGENCY_TYPE"],
-                                cesa=row["CESA"],
-                                county=row["COUNTY"],
-                                district_code=row["DISTRICT_CODE"],
-                                school_code=row["SCHOOL_CODE"],
-                                grade_group=row["GRADE_GROUP"],
-                                charter_ind=row["CHARTER_IND"],
-                                district_name=row["DISTRICT_NAME"],
-                                school_name=row["SCHOOL_NAME"],
-                                group_by=group_by,
-                                group_by_value=row["GROUP_BY_VALUE"],
-                                student_count=row["STUDENT_COUNT"],
-                                percent_of_group=row["PERCENT_OF_GROUP"],
-                                stratification=stratification,
-                            )
-                        )
+        with bulk_load():
+            # Process stratification file if provided
+            strat_ids = None
+            if stratifications_file:
+                # Load stratifications into the database
+                try:
+                    with write_transaction():
+                        strat_ids = load_stratifications_file(stratifications_file, upsert=upsert)
+                        record_ingested("stratifications", stratifications_file, strat_digest, mode)
+                    committed.append(stratifications_file.name)
+                except Exception as e:
+                    logger.error(f"Error processing stratifications file: {e}")
+                    raise
 
-                            
-                    
-                    # Insert new data into the database
-                    SchoolData.objects.bulk_create(data)
-                    logger.info(f"{len(data)} records inserted into the database")
-                    break
-            except OperationalError as e:
-                if "database is locked" in str(e):
-                    retries -= 1
-                    logger.warning(f"Database is locked, retrying... ({5 - retries} retries left)")
-                    time.sleep(1)
+            # Process the main file
+            # Like the other loads, the file is parsed and validated before write_transaction() is taken,
+            # so a malformed file fails without holding up the other writers and they only queue behind
+            # the inserts. The rows are then inserted in fixed-size batches inside one transaction
+            batch_size = getattr(settings, "DATA_PROCESSOR_INGEST_BATCH_SIZE", 5000)
+            # Without a new stratification file the main file is joined to the stored ones
+            if strat_ids is None:
+                strat_ids = stratification_id_map()
+
+            batches = list(school_data_batches(read_uploaded_csv(f), strat_ids, batch_size))
+            with write_transaction():
+                if upsert:
+                    report = upsert_school_data(batches)
                 else:
-                    logger.error(f"Error processing file: {e}")
-                    raise
+                    SchoolData.objects.all().delete()
+                    report = {"inserted": 0, "updated": 0, "unchanged": 0, "changed_keys": None}
+                    with connection.cursor() as cursor:
+                        for batch in batches:
+                            insert_school_data(cursor, batch)
+                            report["inserted"] += len(batch)
+                    bump_input_generation(SchoolData)
+                record_ingested("main", f, digest, mode)
+            committed.append(f.name)
+            report["skipped"] = False
+            logger.info(
+                f"{report['inserted']} records inserted, {report['updated']} updated and "
+                f"{report['unchanged']} unchanged in the database"
+            )
+            return report
     except Exception as e:
         logger.error(f"Error handling file upload: {e}")
         raise
+    finally:
+        for archive in archived:
+            wait_for_archive(archive)
+
+
+# PARALLEL INGESTION OF THE UPLOADS
+# The County GEOID and School Address files do not depend on the main file, they are loaded on worker threads
+# while the request thread loads the stratifications and then the main file (which needs the stratification ids).
+# Every thread has its own database connection, the parsing overlaps and the writes take turns (see db.py).
+# Every file is committed on its own, so when one load fails the others may already be in: the
+# IngestError raised then names the files that failed and the files that were committed.
+_ingest_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ingest")
+
+
+class IngestError(Exception):
+    """ A load of an upload failed, failed and committed are the names of the files in either case
+    and error the first error raised """
+
+    def __init__(self, failed, committed, error):
+        self.failed = failed
+        self.committed = committed
+        message = f"Loading {', '.join(failed)} failed: {error}."
+        if committed:
+            message += f" These files were loaded and committed: {', '.join(committed)}."
+        else:
+            message += " No file was committed."
+        super().__init__(message)
+
+
+def _load_in_worker(loader, file):
+    try:
+        return loader(file)
+    finally:
+        # The worker threads are reused, do not keep their connection open between uploads
+        connection.close()
+
+
+def ingest_uploads(file=None, stratifications_file=None, county_geoid_file=None, school_address_file=None, upsert=False):
+    """ Load the uploaded files concurrently. Returns the main file ingest report (None without a main file),
+    raises an IngestError once every load has finished when one of them failed """
+    futures = []
+    if county_geoid_file:
+        futures.append((county_geoid_file, _ingest_pool.submit(_load_in_worker, load_county_geoid_file, county_geoid_file)))
+    if school_address_file:
+        futures.append((school_address_file, _ingest_pool.submit(_load_in_worker, load_school_address_file, school_address_file)))
+
+    report = None
+    failed, committed = [], []
+    error = None
+    try:
+        if file:
+            report = handle_uploaded_file(file, stratifications_file=stratifications_file, upsert=upsert, committed=committed)
+    except Exception as e:
+        error = e
+        failed.extend(upload.name for upload in (stratifications_file, file) if upload and upload.name not in committed)
+    for upload, future in futures:
+        try:
+            if future.result():
+                committed.append(upload.name)
+        except Exception as e:
+            error = error or e
+            failed.append(upload.name)
+    if error:
+        raise IngestError(failed, committed, error) from error
+    return report
+
+
+def ingest_message(report):
+    """ What the user is told about a main file load, empty for a plain replace """
+    if report and report["skipped"]:
+        return "This file was already ingested, the data was left as it is."
+    if report and report["changed_keys"] is not None:
+        # Upsert: tell the user what actually changed
+        return (
+            f"Upsert finished: {report['inserted']} rows inserted, {report['updated']} updated, "
+            f"{report['unchanged']} unchanged ({len(report['changed_keys'])} keys changed)."
+        )
+    return ""
+
 
+def run_transformation(transformer, transformation_type):
+    """ Run the transformation selected on the upload page, returns its LayerResult """
+    if transformation_type == "Tri-County":
+        return transformer.apply_tri_county_layer_transformation()  # Apply the Tri-County Layer transformation
+    elif transformation_type == "County-Layer":
+        return transformer.apply_county_layer_transformation()      # Apply County Layer transformation
+    elif transformation_type == "Metopio Statewide":
+        return transformer.transform_Metopio_StateWideLayer()       # Apply Metopio Statewide transformation
+    elif transformation_type == "Zipcode":
+        return transformer.transforms_Metopio_ZipCodeLayer()        # Apply Metopio Zipcode transformation
+    elif transformation_type == "City-Town":
+        return transformer.transform_Metopio_CityLayer()            # Apply Metopio City-Town transformation
+    elif transformation_type == "All Layers":
+        # Build every Metopio layer, in DATA_PROCESSOR_LAYER_WORKERS worker processes when it is above 1
+        return transformer.run_all_layers(jobs=getattr(settings, "DATA_PROCESSOR_LAYER_WORKERS", 1))
+    return transformer.apply_transformation(transformation_type)    # Apply the transformation
+
+
+def add_result_messages(request, result):
+    """ Show the messages of a LayerResult (see transformers.py) to the user """
+    for level, text in result.messages:
+        messages.add_message(request, level, text)
+
+
+def transformation_success_url(transformation_type):
+    if transformation_type == "All Layers":
+        # Stay on the upload page, there is no single layer to show
+        return f"{reverse('upload')}?message=All layers were built successfully."
+    return f"{reverse('transformation_success')}?type={transformation_type}"
+
+
+# BACKGROUND JOB TARGETS (see jobs.py)
+def ingest_job(file=None, stratifications_file=None, county_geoid_file=None, school_address_file=None, upsert=False):
+    report = ingest_uploads(
+        file,
+        stratifications_file=stratifications_file,
+        county_geoid_file=county_geoid_file,
+        school_address_file=school_address_file,
+        upsert=upsert,
+    )
+    message = ingest_message(report) or "File uploaded successfully."
+    return {
+        "message": message,
+        "next_url": f"{reverse('upload')}?message={message} Now you can run the transformation.",
+    }
+
+
+def transformation_job(transformation_type):
+    result = run_transformation(DataTransformer(), transformation_type)
+    message = " ".join(text for level, text in result.messages)
+    if not result:
+        return {"success": False, "message": message or "Transformation failed. Please try again."}
+    return {
+        "message": message or (
+            f"{transformation_type} transformation completed successfully: "
+            f"{result.records} records in {result.seconds:.1f} s."
+        ),
+        "next_url": transformation_success_url(transformation_type),
+    }
+
+
+def job_detail(request, job_id):
+    """ Page of a background job, it polls job_status until the job is done """
+    # After a restart, fails the jobs the stopped server left behind before they are shown
+    jobs.start_workers()
+    job = get_object_or_404(Job, id=job_id)
+    return render(request, "__data_processor__/job.html", {"job": job})
+
+
+def job_status(request, job_id):
+    jobs.start_workers()
+    job = get_object_or_404(Job, id=job_id)
+    end = job.finished_at or timezone.now()
+    return JsonResponse({
+        "id": job.id,
+        "kind": job.kind,
+        "description": job.description,
+        "status": job.status,
+        "done": job.status in (Job.SUCCEEDED, Job.FAILED),
+        "message": job.message,
+        "next_url": job.next_url,
+        "elapsed": round((end - job.started_at).total_seconds(), 1) if job.started_at else None,
+    })
 
 
 # data_processor/views.py
@@ -251,19 +707,54 @@ def upload_file(request):
         
         #Get the stratification file if provided
 
-        if file:  # Check if a file is uploaded
+        report = None
+        if jobs.background_jobs_enabled() and (file or county_geoid_file or school_address_file):
             form = UploadFileForm(request.POST, request.FILES)
-            if form.is_valid():
-                handle_uploaded_file(
-                    file, 
-                    stratifications_file=stratifications_file,
-                    )   # Process the main file and the stratification uploaded file
-            
-        #Process the COunty GEOID file if provided
-        if county_geoid_file:
-            load_county_geoid_file(county_geoid_file)
+            main_file_valid = bool(file) and form.is_valid()
+            if main_file_valid or county_geoid_file or school_address_file:
+                # Load the files in a background job, the job page polls until it is done
+                uploads = {
+                    "file": file if main_file_valid else None,
+                    "stratifications_file": stratifications_file if main_file_valid else None,
+                    "county_geoid_file": county_geoid_file,
+                    "school_address_file": school_address_file,
+                }
+                job = jobs.submit(
+                    "ingest",
+                    ", ".join(upload.name for upload in uploads.values() if upload),
+                    ingest_job,
+                    uploads=uploads,
+                    upsert=main_file_valid and form.cleaned_data["upsert"],
+                )
+                return redirect("job_detail", job_id=job.id)
+
+        try:
+            if file:  # Check if a file is uploaded
+                form = UploadFileForm(request.POST, request.FILES)
+                if form.is_valid():
+                    # Process the main file and the stratification uploaded file,
+                    # the County GEOID and School Address files are loaded at the same time
+                    report = ingest_uploads(
+                        file,
+                        stratifications_file=stratifications_file,
+                        county_geoid_file=county_geoid_file,
+                        school_address_file=school_address_file,
+                        upsert=form.cleaned_data["upsert"],
+                        )
+                    message = ingest_message(report)
+
+            #Process the COunty GEOID file if provided (on its own when there is no valid main file)
+            if county_geoid_file or school_address_file:
+                if not (file and form.is_valid()):
+                    ingest_uploads(county_geoid_file=county_geoid_file, school_address_file=school_address_file)
+        except IngestError as e:
+            # Some of the files may be in already, the message names the ones that failed and the ones committed
+            return render(
+                request,
+                "__data_processor__/upload.html",
+                {"form": form, "message": str(e), "details": "Upload your file and select the transformation type."},
+            )
         if school_address_file:
-            load_school_address_file(school_address_file)
             # after loading the school_address_file we are going to  update the SchoolData model
             # to take care of the Many-to-Many relationship
             # We will be tryng to handle the Many to Many relationship population of the SchoolData model
@@ -344,7 +835,7 @@ def upload_file(request):
             # # Redirect to the success page or back to upload with a success message
 
             return redirect(
-                f"{reverse('upload')}?message=File uploaded successfully. Now you can run the transformation."
+                f"{reverse('upload')}?message={message or 'File uploaded successfully.'} Now you can run the transformation."
             )
         # After this step in the rendered page we have the transformation forms from where we can get the tranformation type
         # since we called the handle_uploaded_file function to process the file and save it to the database
@@ -352,25 +843,22 @@ def upload_file(request):
         # Handle transformation actions
         transformation_type = request.POST.get("transformation_type")
         if transformation_type:
-            transformer = DataTransformer(request)  # Create an instance of the DataTransformer class
-            if transformation_type == "Tri-County":
-                success = (transformer.apply_tri_county_layer_transformation())  # Apply the Tri-County Layer transformation
-            elif transformation_type == "County-Layer":
-                success = transformer.apply_county_layer_transformation()        # Apply County Layer transformation
-            elif transformation_type == "Metopio Statewide":
-                success = transformer.transform_Metopio_StateWideLayer()         # Apply Metopio Statewide transformation
-            elif transformation_type == "Zipcode":
-                success = transformer.transforms_Metopio_ZipCodeLayer()          # Apply Metopio Zipcode transformation 
-            elif transformation_type == "City-Town":
-                success = transformer.transform_Metopio_CityLayer()              # Apply Metopio City-Town transformation
-            else:
-                success = transformer.apply_transformation(transformation_type ) # Apply the transformation
+            # Long transformations run as a background job, the job page polls until it is done
+            if jobs.background_jobs_enabled():
+                job = jobs.submit(
+                    "transformation", f"{transformation_type} transformation", transformation_job,
+                    transformation_type=transformation_type,
+                )
+                return redirect("job_detail", job_id=job.id)
+
+            transformer = DataTransformer()  # Create an instance of the DataTransformer class
+            result = run_transformation(transformer, transformation_type)
+            add_result_messages(request, result)
 
             # If transformation was successful, redirect to the success page
-            if success:
-                return redirect(
-                    f"{reverse('transformation_success')}?type={transformation_type}"
-                )
+            # (All Layers goes back to the upload page)
+            if result:
+                return redirect(transformation_success_url(transformation_type))
             else:
                 # If transformation failed, display an error message
                 message = "Transformation failed. Please try again."
@@ -388,116 +876,164 @@ def upload_file(request):
     )
     
 
-# handle the county geoid file upload
+# SCHOOL -> GEOGRAPHY CROSSWALK
+# SchoolGeography joins every school of the address file to its zip code, city and county GEOIDs.
+# It depends on both files, so it is rebuilt at the end of either load, inside the load's transaction.
+# As in the layers, the last address row of a school and the last GEOID entry of a name win.
+def rebuild_school_geography():
+    """ Rebuild the SchoolGeography crosswalk from the stored school addresses and GEOID entries """
+    geoids = defaultdict(dict)
+    for layer, name, geoid in CountyGEOID.objects.order_by("id").values_list("layer", "name", "geoid"):
+        geoids[layer][name] = geoid
+    county_geoids = {name.split(" County, WI")[0].strip(): geoid for name, geoid in geoids["County"].items()}
+
+    schools = {}
+    addresses = SchoolAddressFile.objects.order_by("id").values_list("lea_code", "school_code", "zip_code", "city", "county")
+    for lea_code, school_code, zip_code, city, county in addresses:
+        schools[lea_code, school_code] = SchoolGeography(
+            lea_code=lea_code,
+            school_code=school_code,
+            zip_code=zip_code,
+            city=city,
+            county=county,
+            zip_geoid=geoids["Zip code"].get(zip_code),
+            city_geoid=geoids["City or town"].get(f"{city}, WI"),  # The GEOID file names the cities "<city>, WI"
+            county_geoid=county_geoids.get(county),
+        )
 
-def load_county_geoid_file(file):
-    # Save the file to the uploads directory
-    upload_dir = os.path.join(settings.BASE_DIR, "uploads")
-    os.makedirs(upload_dir, exist_ok=True)
-    file_path = os.path.join(upload_dir, file.name)
+    SchoolGeography.objects.all().delete()
+    SchoolGeography.objects.bulk_create(schools.values())
+    logger.info(f"{len(schools)} school geography records rebuilt")
 
-    with open(file_path, "wb+") as destination:
-        for chunk in file.chunks():
-            destination.write(chunk)
-    logger.info(f"County GEOID file uploaded successfully to {file_path}")
+
+# handle the county geoid file upload
+# The file is parsed and validated before the write transaction, which then only swaps the rows
+def load_county_geoid_file(file):
+    """ Load the County GEOID file. Returns False when an identical file was already ingested """
+    digest = file_sha256(file)
+    if already_ingested("county_geoid", digest):
+        logger.info(f"County GEOID file {file.name} was already ingested, skipping it")
+        return False
+    # Archive the file to the uploads directory in the background while it is parsed
+    archived = archive_upload(file)
 
     try:
-        with open(file_path, "r") as csvfile:
-            reader = csv.DictReader(csvfile)
-            CountyGEOID.objects.all().delete()  # Clear existing records
-            # Validate required columns
-            required_columns = {"Layer", "Name", "GEOID"}
-            if not required_columns.issubset(reader.fieldnames):
-                raise ValueError(f"Missing required columns: {required_columns - set(reader.fieldnames)}")
-
-           
-
-            # Filter rows where Layer = 'County' and prepare data
-            data = [
-                CountyGEOID(
-                    layer=row["Layer"],  # Use the "Layer" field
-                    name=row["Name"],    # Use the "Name" field
-                    geoid=row["GEOID"]   # Use the "GEOID" field
-                )
-                for row in reader 
-            ]
+        reader = read_uploaded_csv(file)
+        # Validate required columns
+        required_columns = {"Layer", "Name", "GEOID"}
+        if not required_columns.issubset(reader.fieldnames):
+            raise ValueError(f"Missing required columns: {required_columns - set(reader.fieldnames)}")
+
+        # Prepare the records of every row
+        data = [
+            CountyGEOID(
+                layer=row["Layer"],  # Use the "Layer" field
+                name=row["Name"],    # Use the "Name" field
+                geoid=row["GEOID"]   # Use the "GEOID" field
+            )
+            for row in reader
+        ]
 
-            # Bulk insert filtered data
+        # One write transaction, the old records stay visible to the readers until the new ones are in
+        with bulk_load(), write_transaction():
+            CountyGEOID.objects.all().delete()  # Clear existing records
             CountyGEOID.objects.bulk_create(data)
             logger.info(f"{len(data)} County GEOID records inserted into the database")
+            rebuild_school_geography()
+            record_ingested("county_geoid", file, digest)
+        return True
 
     except Exception as e:
         logger.error(f"Error processing County GEOID file: {e}")
         raise
+    finally:
+        wait_for_archive(archived)
 
 # handle the school AddressFile upload
+# As for the GEOID file, only the writes run inside the transaction
 def load_school_address_file(file):
-    # Save the file to the uploads directory
-    upload_dir = os.path.join(settings.BASE_DIR, "uploads")
-    os.makedirs(upload_dir, exist_ok=True)
-    file_path = os.path.join(upload_dir, file.name)
-
-    with open(file_path, "wb+") as destination:
-        for chunk in file.chunks():
-            destination.write(chunk)
-    logger.info(f"School Address file uploaded successfully to {file_path}")
+    """ Load the school address file. Returns False when an identical file was already ingested """
+    digest = file_sha256(file)
+    if already_ingested("school_address", digest):
+        logger.info(f"School Address file {file.name} was already ingested, skipping it")
+        return False
+    # Archive the file to the uploads directory in the background while it is parsed
+    archived = archive_upload(file)
 
     try:
-        with open(file_path, "r") as csvfile:
-            reader = csv.DictReader(csvfile)
-            SchoolAddressFile.objects.all().delete()  # Clear existing records
-            # Validate required columns
-            required_columns = {
-                "LEA Code", "District Name", "School Code", "School Name",
-                "Organization Type", "School Type", "Low Grade", "High Grade",
-                "Address", "City", "State", "Zip", "CESA", "Locale",
-                "County", "Current Status", "Categories And Programs",
-                "Virtual School", "IB Program", "Phone Number",
-                "Fax Number", "Charter Status", "Website Url"
-            }
-            if not required_columns.issubset(reader.fieldnames):
-                raise ValueError(f"Missing required columns: {required_columns - set(reader.fieldnames)}")
-            
-            with transaction.atomic():
-                
+        reader = read_uploaded_csv(file)
+        # Validate required columns
+        required_columns = {
+            "LEA Code", "District Name", "School Code", "School Name",
+            "Organization Type", "School Type", "Low Grade", "High Grade",
+            "Address", "City", "State", "Zip", "CESA", "Locale",
+            "County", "Current Status", "Categories And Programs",
+            "Virtual School", "IB Program", "Phone Number",
+            "Fax Number", "Charter Status", "Website Url"
+        }
+        if not required_columns.issubset(reader.fieldnames):
+            raise ValueError(f"Missing required columns: {required_columns - set(reader.fieldnames)}")
+
+        # Prepare data for bulk insertion
+        data = [
+            SchoolAddressFile(
+                lea_code=normalize_code(row["LEA Code"]),
+                district_name=row["District Name"],
+                school_code=normalize_code(row["School Code"]),
+                school_name=row["School Name"],
+                organization_type=row["Organization Type"],
+                school_type=row["School Type"],
+                low_grade=row["Low Grade"],
+                high_grade=row["High Grade"],
+                address=row["Address"],
+                city=row["City"],
+                state=row["State"],
+                zip_code=row["Zip"],
+                cesa=row["CESA"],
+                locale=row["Locale"],
+                county=row["County"],
+                current_status=row["Current Status"],
+                categories_and_programs=row.get("Categories And Programs", ""),
+                virtual_school=row.get("Virtual School", ""),
+                ib_program=row.get("IB Program", ""),
+                phone_number=row["Phone Number"],
+                fax_number=row.get("Fax Number", ""),
+                charter_status=row["Charter Status"].lower() == "true",
+                website_url=row.get("Website Url", ""),
+            )
+            for row in reader
+        ]
 
-                # Prepare data for bulk insertion
-                data = [
-                    SchoolAddressFile(
-                        lea_code=row["LEA Code"],
-                        district_name=row["District Name"],
-                        school_code=row["School Code"],
-                        school_name=row["School Name"],
-                        organization_type=row["Organization Type"],
-                        school_type=row["School Type"],
-                        low_grade=row["Low Grade"],
-                        high_grade=row["High Grade"],
-                        address=row["Address"],
-                        city=row["City"],
-                        state=row["State"],
-                        zip_code=row["Zip"],
-                        cesa=row["CESA"],
-                        locale=row["Locale"],
-                        county=row["County"],
-                        current_status=row["Current Status"],
-                        categories_and_programs=row.get("Categories And Programs", ""),
-                        virtual_school=row.get("Virtual School", ""),
-                        ib_program=row.get("IB Program", ""),
-                        phone_number=row["Phone Number"],
-                        fax_number=row.get("Fax Number", ""),
-                        charter_status=row["Charter Status"].lower() == "true",
-                        website_url=row.get("Website Url", ""),
-                    )
-                    for row in reader
-                ]
-
-                # Bulk insert data
-                SchoolAddressFile.objects.bulk_create(data)
+        # One write transaction, the old records stay visible to the readers until the new ones are in
+        with bulk_load(), write_transaction():
+            SchoolAddressFile.objects.all().delete()  # Clear existing records
+            # Bulk insert data
+            SchoolAddressFile.objects.bulk_create(data)
             logger.info(f"{len(data)} School Address records inserted into the database")
+            rebuild_school_geography()
+            record_ingested("school_address", file, digest)
+        return True
 
     except Exception as e:
         logger.error(f"Error processing School Address file: {e}")
         raise
+    finally:
+        wait_for_archive(archived)
+
+# MATERIALIZED READS FOR THE LAYER VIEWS
+# The layer views below read the already-built *LayerTransformation tables.
+# The layer methods are cached on a fingerprint of their inputs (see cached_layer in transformers.py),
+# so a GET only recomputes when the inputs changed since the last build, and paging never rebuilds anything.
+# The Refresh button (a POST back to the view) forces a rebuild regardless of the fingerprint.
+# Set DATA_PROCESSOR_MATERIALIZED_VIEWS = False in the settings to go back to rebuilding on every request.
+def _materialize_layer(request, build):
+    """ Rebuild a layer on an explicit refresh or when its inputs changed since the last build.
+    Returns True for a refresh (POST) so the view can redirect back to a plain GET """
+    refresh = request.method == "POST"
+    materialized = getattr(settings, "DATA_PROCESSOR_MATERIALIZED_VIEWS", True)
+    add_result_messages(request, build(force=refresh or not materialized))
+    return refresh
+
 
 def statewide_view(request):
     transformation_type = request.GET.get(
@@ -527,8 +1063,9 @@ def tri_county_view(request):
         "type", "Tri-County"
     )  # Default to the TriCountry Layer if not specified
     print(f"Query Parameters: {request.GET}")  # Log query parameters
-    # Fetch the data from the Metopio Data Transformation model
-    DataTransformer.apply_tri_county_layer_transformation(request)
+    # Rebuild only on refresh or when the inputs changed, then read the materialized Metopio Data Transformation model
+    if _materialize_layer(request, DataTransformer().apply_tri_county_layer_transformation):
+        return redirect(f"{reverse('tri_county_view')}?type={transformation_type}")
     data_list = MetopioTriCountyLayerTransformation.objects.all()
     """ View to display the Tri-County data """
 
@@ -555,8 +1092,9 @@ def county_layer_view(request):
     )  # Default to County Layer if not specified
     print(f"Query Parameters: {request.GET}")  # Log query parameters
 
-    # Apply the County Layer Transformation
-    DataTransformer(request).apply_county_layer_transformation()
+    # Rebuild the County Layer only on refresh or when its inputs changed, otherwise just read the materialized table
+    if _materialize_layer(request, DataTransformer().apply_county_layer_transformation):
+        return redirect(f"{reverse('county_layer_view')}?type={transformation_type}")
 
     # Fetch the transformed data from the CountyLayerTransformation model
     data_list = CountyLayerTransformation.objects.all()
@@ -581,8 +1119,9 @@ def metopio_statewide_view(request):
     )  # Default to 'Statewide' if not specified
     print(f"Query Parameters: {request.GET}")  # Log query parameters
 
-    # Apply the Metopio Statewide Transformation
-    DataTransformer(request).transform_Metopio_StateWideLayer()
+    # Rebuild the Metopio Statewide Layer only on refresh or when its inputs changed, otherwise just read the materialized table
+    if _materialize_layer(request, DataTransformer().transform_Metopio_StateWideLayer):
+        return redirect(f"{reverse('metopio_statewide_layer_view')}?type={transformation_type}")
 
     # Fetch the transformed data from the MetopioStateWideLayerTransformation model
     data_list = MetopioStateWideLayerTransformation.objects.all()
@@ -607,8 +1146,9 @@ def metopio_zipcode_view(request):
     )  # Default to 'Zipcode' if not specified
     print(f"Query Parameters: {request.GET}")  # Log query parameters
 
-    # Apply the Metopio Zipcode Transformation
-    DataTransformer(request).transforms_Metopio_ZipCodeLayer()
+    # Rebuild the Metopio Zipcode Layer only on refresh or when its inputs changed, otherwise just read the materialized table
+    if _materialize_layer(request, DataTransformer().transforms_Metopio_ZipCodeLayer):
+        return redirect(f"{reverse('metopio_zipcode_layer_view')}?type={transformation_type}")
 
     # Fetch the transformed data from the MetopioZipCodeLayerTransformation model
     data_list = ZipCodeLayerTransformation.objects.all()
@@ -632,8 +1172,9 @@ def city_town_view(request):
         "type", "City-Town"
     )  # Default to 'City-Town' if not specified
     print(f"Query Parameters: {request.GET}")  # Log query parameters
-    # Fetch the data from the Metopio Data Transformation model
-    DataTransformer.transform_Metopio_CityLayer(request)
+    # Rebuild only on refresh or when the inputs changed, then read the materialized Metopio City Layer model
+    if _materialize_layer(request, DataTransformer().transform_Metopio_CityLayer):
+        return redirect(f"{reverse('metopio_city_town_view')}?type={transformation_type}")
     data_list = MetopioCityLayerTransformation.objects.all()
     """ View to display the City-Town data """
 
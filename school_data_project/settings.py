@@ -79,6 +79,16 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        # WAL lets the layer views read while a file is being loaded, writers wait up to "timeout"
+        # seconds for the lock (busy timeout) and take it when their transaction begins (IMMEDIATE)
+        "OPTIONS": {
+            "init_command": "PRAGMA journal_mode=WAL;",
+            "timeout": 30,
+            "transaction_mode": "IMMEDIATE",
+        },
+        # The tests run on a database file like the site: the uploads and the jobs write from worker threads,
+        # which the shared in-memory test database would fail with "database table is locked"
+        "TEST": {"NAME": BASE_DIR / "test_db.sqlite3"},
     }
 }
 
@@ -149,3 +159,38 @@ LOGGING = {
     },
 }
 
+
+
+# Data processor settings
+
+# Layer views only read the stored *LayerTransformation tables and rebuild on an explicit refresh
+# or when the layer inputs changed since the last build.
+# Set to False to rebuild the layer on every request (the old behaviour).
+DATA_PROCESSOR_MATERIALIZED_VIEWS = True
+
+# Debug spreadsheets of the intermediate layer data (before_grouping_county.xlsx, zip_code_map.xlsx, ...).
+# Off by default. When on, every layer run writes them in the background into its own
+# directory under DATA_PROCESSOR_DIAGNOSTICS_DIR.
+DATA_PROCESSOR_DIAGNOSTICS = False
+DATA_PROCESSOR_DIAGNOSTICS_DIR = BASE_DIR / "diagnostics"
+
+# Number of SchoolData rows built and inserted at a time when the main enrollment file is loaded
+DATA_PROCESSOR_INGEST_BATCH_SIZE = 5000
+# Keep a copy of every uploaded file in uploads/ (written in the background under a unique name)
+# Set to False to only parse the uploads from the request without archiving them
+DATA_PROCESSOR_ARCHIVE_UPLOADS = True
+# Skip uploads that are byte-identical to the last ingested file of the same kind
+# (as long as the data they were loaded into was not changed since). Set to False to always reload
+DATA_PROCESSOR_SKIP_DUPLICATE_UPLOADS = True
+# Run the uploads and the transformations as background jobs on a local pool of worker threads,
+# the POST returns at once and the job page polls the job status. Set to False to run them inside the request
+DATA_PROCESSOR_BACKGROUND_JOBS = True
+DATA_PROCESSOR_JOB_WORKERS = 2
+# Where the files of a queued upload are kept until its job has loaded them
+DATA_PROCESSOR_JOBS_DIR = BASE_DIR / "uploads" / "jobs"
+# Worker processes building the layers of the All Layers transformation side by side (1 builds them one
+# after the other in the request or job). The build_layers command takes the same number as --jobs
+DATA_PROCESSOR_LAYER_WORKERS = 1
+# The Metopio Statewide and Tri-County layers group the SchoolData rows in Python.
+# Set to True to sum them in the database instead (GROUP BY on the stratification label)
+DATA_PROCESSOR_SQL_AGGREGATION = False